@@ -0,0 +1,999 @@
+"""Scheduling of the sub-jobs of batch CLI jobs."""
+import datetime
+import itertools
+import json
+import math
+import threading
+import time
+import uuid
+
+import cherrypy
+from bson.objectid import ObjectId
+from girder import events, logger
+from girder.api.rest import RestException
+from girder.constants import AccessType
+from girder.exceptions import ValidationException
+from girder.models.file import File
+from girder.models.folder import Folder
+from girder.models.item import Item
+from girder.models.token import Token
+from girder_jobs.constants import JobStatus
+from girder_jobs.models.job import Job
+
+from .cli_utils import can_be_swept
+from .config import PluginSettings
+from .models.docker_image import subfolderIds
+from .prepare_task import FOLDER_SUFFIX
+
+BATCH_CONCURRENCY_PARAM = '_concurrency'
+BATCH_INCREMENTAL_PARAM = '_incremental'
+BATCH_RECURSIVE_PARAM = '_recursive'
+# A batch input can list its items in <param>_manifest instead of matching
+# names in <param>_folder.
+BATCH_MANIFEST_SUFFIX = '_manifest'
+BATCH_SWEEP_PARAM = '_sweep'
+BATCH_SWEEP_MODE_PARAM = '_sweep_mode'
+# Sweeps are either combined with each other and the batch inputs in every
+# combination or zipped with them
+SWEEP_MODES = ('product', 'zip')
+# The most values a sweep range can have
+MAX_SWEEP_RANGE = 10000
+# The most sub-jobs a batch can have, counting every combination of batch
+# input entries and swept values
+MAX_BATCH_ENTRIES = 100000
+# Parameters of batch jobs that aren't passed to their sub-jobs
+BATCH_ONLY_PARAMS = (
+    BATCH_CONCURRENCY_PARAM, BATCH_INCREMENTAL_PARAM, BATCH_RECURSIVE_PARAM,
+    BATCH_SWEEP_PARAM, BATCH_SWEEP_MODE_PARAM)
+# Every batch is checked this often, in seconds, even if none of its jobs
+# have been updated in this process.
+SWEEP_INTERVAL = 10
+# A scheduler records a heartbeat in each of its batches every sweep.  If a
+# batch's heartbeat is older than this, in seconds, its scheduler is assumed
+# to have stopped and another process can resume the batch.
+HEARTBEAT_TIMEOUT = 6 * SWEEP_INTERVAL
+
+# The batch job fields with the resolved values of each batch input and the
+# parameter identifier of each list of values
+BATCH_INPUTS_FIELD = 'batchInputs'
+BATCH_INPUT_KEYS_FIELD = 'batchInputKeys'
+# The batch job field with the swept values and sweep mode.  The values of
+# each sub-job are computed from these and the batch inputs rather than
+# stored.
+BATCH_SWEEP_FIELD = 'batchSweep'
+# The batch job field with the indices of the entries that are processed
+# when an incremental batch skips some of them
+BATCH_ENTRIES_FIELD = 'batchEntries'
+# The sub-job field with its index within its batch.  Sub-jobs also have the
+# id of the batch job in parentId.
+BATCH_INDEX_FIELD = 'batchIndex'
+# The batch job field with the checkpoint of its progress.  This has the
+# number of sub-jobs in total, that were scheduled, and that finished, the
+# ids of the sub-jobs that haven't finished, and the scheduler that owns the
+# batch and its last heartbeat.
+BATCH_PROGRESS_FIELD = 'batchProgress'
+BATCH_HEARTBEAT_FIELD = BATCH_PROGRESS_FIELD + '.heartbeat'
+# The job field with a hash of the CLI digest and input parameters of a job
+JOB_FINGERPRINT_FIELD = 'slicerCLIFingerprint'
+# The number of fingerprints that are looked up per query
+FINGERPRINT_CHUNK = 1000
+
+_finishedStatuses = {JobStatus.CANCELED, JobStatus.ERROR, JobStatus.SUCCESS}
+_waitingStatuses = {JobStatus.QUEUED, JobStatus.INACTIVE}
+_statusNames = {
+    getattr(JobStatus, name): name.lower()
+    for name in ('INACTIVE', 'QUEUED', 'RUNNING', 'SUCCESS', 'ERROR', 'CANCELED')}
+
+_scheduler = None
+_schedulerLock = threading.Lock()
+
+
+def batchConcurrency(params):
+    """
+    Get the maximum number of sub-jobs of a batch job that are queued or
+    running at once.
+
+    :param params: parameter dictionary passed to the endpoint.  If this has a
+        positive _concurrency value, that is used.  Otherwise, the
+        slicer_cli_web.batch_concurrency setting is used.
+    :returns: the maximum number of sub-jobs, or 0 to only schedule a sub-job
+        once the previous one is no longer waiting to start.
+    """
+    try:
+        concurrency = int(params.get(BATCH_CONCURRENCY_PARAM) or 0)
+    except ValueError:
+        raise RestException('%s must be an integer.' % BATCH_CONCURRENCY_PARAM)
+    if concurrency < 0:
+        raise RestException('%s must not be negative.' % BATCH_CONCURRENCY_PARAM)
+    return concurrency or PluginSettings.get_batch_concurrency()
+
+
+def batchIncremental(params):
+    """
+    Check if a batch job should skip entries that were already processed.
+
+    :param params: parameter dictionary passed to the endpoint.
+    :returns: True if the _incremental parameter is set.
+    """
+    return str(params.get(BATCH_INCREMENTAL_PARAM)).lower() == 'true'
+
+
+def batchRecursive(params):
+    """
+    Check if batch inputs should match items in subfolders.
+
+    :param params: parameter dictionary passed to the endpoint.
+    :returns: True if the _recursive parameter is set.
+    """
+    return str(params.get(BATCH_RECURSIVE_PARAM)).lower() == 'true'
+
+
+def _sweepValue(value):
+    """
+    Convert a sweep value to the string that is passed to the endpoint.
+
+    :param value: a value from a sweep specification.
+    :returns: a string.
+    """
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+def _sweepRange(key, spec):
+    """
+    Get the values of a sweep range.
+
+    :param key: the identifier of the swept parameter.
+    :param spec: a dictionary with start, stop, and an optional step, which
+        defaults to 1.  The stop value is included if it is reached.
+    :returns: a list of numbers.
+    """
+    start, stop, step = spec.get('start'), spec.get('stop'), spec.get('step', 1)
+    if not all(isinstance(value, (int, float)) and not isinstance(value, bool)
+               for value in (start, stop, step)) or not step:
+        raise RestException(
+            'The sweep range of %s must have numeric start, stop, and nonzero step '
+            'values.' % key)
+    # allow for floating point error in the number of steps
+    count = math.floor((stop - start) / step + 1e-9) + 1
+    if count < 1 or count > MAX_SWEEP_RANGE:
+        raise RestException(
+            'The sweep range of %s must have between 1 and %d values.' % (
+                key, MAX_SWEEP_RANGE))
+    values = [start + idx * step for idx in range(count)]
+    if not all(isinstance(value, int) for value in (start, stop, step)):
+        values = [round(value, 12) for value in values]
+    return values
+
+
+def batchSweep(params, table):
+    """
+    Get the values of the parameters a batch job sweeps over.
+
+    :param params: parameter dictionary passed to the endpoint.  _sweep is a
+        JSON object with the identifiers of scalar or enumeration parameters
+        as keys.  Each value is either a list of values or an object with
+        start, stop, and step.  _sweep_mode is one of SWEEP_MODES.
+    :param table: the CLI's ParameterTable.
+    :returns: a dictionary of parameter identifiers to lists of string
+        values, which is empty if there is no sweep, and the sweep mode.
+    """
+    mode = params.get(BATCH_SWEEP_MODE_PARAM) or SWEEP_MODES[0]
+    if mode not in SWEEP_MODES:
+        raise RestException('%s must be one of %s.' % (
+            BATCH_SWEEP_MODE_PARAM, ', '.join(SWEEP_MODES)))
+    sweep = params.get(BATCH_SWEEP_PARAM)
+    if not sweep:
+        return {}, mode
+    if isinstance(sweep, str):
+        try:
+            sweep = json.loads(sweep)
+        except ValueError:
+            sweep = None
+    if not isinstance(sweep, dict):
+        raise RestException('%s must be a JSON object.' % BATCH_SWEEP_PARAM)
+    cliParams = {param.identifier(): param
+                 for param in itertools.chain(table.index_params, table.opt_params)}
+    values = {}
+    for key, spec in sweep.items():
+        param = cliParams.get(key)
+        if param is None or not can_be_swept(param):
+            raise RestException('Parameter %s cannot be swept.' % key)
+        if isinstance(spec, dict):
+            spec = _sweepRange(key, spec)
+        if not isinstance(spec, list) or not len(spec):
+            raise RestException(
+                'The sweep of %s must be a non-empty list or a range.' % key)
+        values[key] = [_sweepValue(value) for value in spec]
+        if param.typ.endswith('-enumeration'):
+            elements = {_sweepValue(value) for value in param.elements}
+            invalid = [value for value in values[key] if value not in elements]
+            if invalid:
+                raise RestException('%s is not a valid value of %s.' % (invalid[0], key))
+    if mode == 'zip' and len({len(value) for value in values.values()}) > 1:
+        raise RestException('Zipped sweeps must all have the same number of values.')
+    if sweepEntryCount([], values, mode) > MAX_BATCH_ENTRIES:
+        raise RestException('A sweep can have at most %d combinations.' % MAX_BATCH_ENTRIES)
+    return values, mode
+
+
+def sweepEntryCount(inputs, sweep, mode):
+    """
+    Count the entries of a batch once its inputs are combined with a sweep.
+
+    :param inputs: a list with the values of each batch input.  These are
+        all the same length.
+    :param sweep: a dictionary of swept parameter identifiers to lists of
+        values, as returned by batchSweep.
+    :param mode: the sweep mode.  With 'product', each entry of the batch
+        inputs is repeated for every combination of the sweep values.  With
+        'zip', each entry gets the corresponding value of each sweep.
+    :returns: the number of entries.
+    """
+    count = len(inputs[0]) if inputs else None
+    if not sweep:
+        return count or 0
+    lengths = [len(sweep[key]) for key in sorted(sweep)]
+    if mode == 'zip':
+        if count is not None and count != lengths[0]:
+            raise ValueError(
+                'zipped sweeps have %d values, but the batch inputs have %d '
+                'entries' % (lengths[0], count))
+        return lengths[0]
+    return (1 if count is None else count) * math.prod(lengths)
+
+
+def batchEntry(inputs, sweep, mode, index):
+    """
+    Get the values of one entry of a batch whose inputs are combined with a
+    sweep, without listing every combination.  In product mode, the swept
+    values vary fastest, the last swept parameter first.
+
+    :param inputs: a list with the values of each batch input.
+    :param sweep: a dictionary of swept parameter identifiers to lists of
+        values.
+    :param mode: the sweep mode.
+    :param index: the index of the entry.
+    :returns: a list of the values of each batch input followed by those of
+        each swept parameter in sorted order.
+    """
+    columns = [sweep[key] for key in sorted(sweep or {})]
+    if mode == 'zip' or not columns:
+        return [values[index] for values in inputs + columns]
+    swept = []
+    for values in reversed(columns):
+        index, digit = divmod(index, len(values))
+        swept.insert(0, values[digit])
+    return [values[index] for values in inputs] + swept
+
+
+def loadBatchEntries(job, indices):
+    """
+    Get the values of some entries of a batch job.  Only the values of these
+    entries are read from the database, not the whole list of batch inputs.
+
+    :param job: the batch job.  This must have its input keys and sweep.
+    :param indices: a list of the batch indices of sub-jobs.
+    :returns: a dictionary of batch indices to lists of values in the order
+        of the batch input keys.
+    """
+    indices = sorted(set(indices))
+    if not indices:
+        return {}
+    sweep = job.get(BATCH_SWEEP_FIELD) or {}
+    swept, mode = sweep.get('values') or {}, sweep.get('mode')
+    numInputs = len(job.get(BATCH_INPUT_KEYS_FIELD) or []) - len(swept)
+    combos = math.prod(len(values) for values in swept.values()) if mode != 'zip' else 1
+    # Incremental batches store which entries are processed
+    doc = next(Job().collection.aggregate([
+        {'$match': {'_id': job['_id']}},
+        {'$project': {'_id': False, **{
+            'e%d' % idx: {'$ifNull': [
+                {'$arrayElemAt': ['$' + BATCH_ENTRIES_FIELD, idx]}, idx]}
+            for idx in indices}}},
+    ]), {})
+    entries = {idx: doc.get('e%d' % idx, idx) for idx in indices}
+    bases = {entry // combos for entry in entries.values()}
+    doc = next(Job().collection.aggregate([
+        {'$match': {'_id': job['_id']}},
+        {'$project': {'_id': False, **{
+            'v%d_%d' % (col, base): {'$arrayElemAt': [
+                {'$arrayElemAt': ['$' + BATCH_INPUTS_FIELD, col]}, base]}
+            for col in range(numInputs) for base in bases}}},
+    ]), {})
+    results = {}
+    for idx, entry in entries.items():
+        values = [doc.get('v%d_%d' % (col, entry // combos)) for col in range(numInputs)]
+        results[idx] = values + batchEntry(
+            [], swept, mode, entry if mode == 'zip' else entry % combos)
+    return results
+
+
+def planNameQuery(pattern):
+    """
+    Convert a regular expression for item names to a query that can use the
+    item name indices.  Patterns that are anchored at the start and begin
+    with literal text are matched with a range query on that prefix.  If the
+    range query is equivalent to the pattern, the regular expression is
+    omitted.
+
+    :param pattern: a regular expression.
+    :returns: a query dictionary for the name and a description of the plan.
+    """
+    if pattern in {'', '.*', '^', '^.*'}:
+        return {}, 'all items'
+    regex = {'name': {'$regex': pattern}}
+    ignoreCase = pattern.startswith('(?i)')
+    body = pattern[4:] if ignoreCase else pattern
+    if not body.startswith('^') or '|' in body:
+        return regex, 'regular expression %r' % pattern
+    prefix = []
+    pos = 1
+    while pos < len(body):
+        char = body[pos]
+        if char == '\\' and pos + 1 < len(body) and not body[pos + 1].isalnum():
+            prefix.append(body[pos + 1])
+            pos += 2
+        elif char in '.^$*+?()[]{}|\\':
+            break
+        else:
+            prefix.append(char)
+            pos += 1
+    rest = body[pos:]
+    if rest[:1] in {'*', '?', '{'}:
+        # the last character is optional or repeated
+        prefix = prefix[:-1]
+    prefix = ''.join(prefix)
+    if not prefix:
+        return regex, 'regular expression %r' % pattern
+    field = 'name'
+    if ignoreCase:
+        field, prefix = 'lowerName', prefix.lower()
+    if rest == '$':
+        query, plan = {field: prefix}, 'exact %s %r' % (field, prefix)
+    else:
+        query = {field: {'$gte': prefix, '$lt': prefix[:-1] + chr(ord(prefix[-1]) + 1)}}
+        plan = 'index range on %s starting with %r' % (field, prefix)
+    if ignoreCase or rest not in {'', '.*', '$', '.*$'}:
+        query['name'] = dict(query.get('name', {}), **regex['name'])
+        plan += ' and regular expression %r' % pattern
+    return query, plan
+
+
+def readManifest(manifest, user):
+    """
+    Get the item ids listed in a batch manifest.
+
+    :param manifest: either a JSON list of item ids or the id of a file with
+        a JSON list of item ids or one item id per line.
+    :param user: the user that must be able to read the manifest file.
+    :returns: a list of item ids and a description of the manifest.
+    """
+    try:
+        ids = json.loads(manifest)
+        source = 'listed'
+    except ValueError:
+        ids = None
+    if not isinstance(ids, list):
+        file = File().load(manifest, user=user, level=AccessType.READ, exc=True)
+        with File().open(file) as fptr:
+            contents = fptr.read().decode()
+        try:
+            ids = json.loads(contents)
+        except ValueError:
+            ids = [line.strip() for line in contents.splitlines() if line.strip()]
+        source = 'in manifest %s' % file['name']
+    try:
+        return [ObjectId(itemId) for itemId in ids], source
+    except Exception:
+        raise ValueError('the manifest must be a list of item ids')
+
+
+def validateBatchInputs(batchParams, params, user):
+    """
+    Check that the manifest or folder of each batch input can be read, so
+    that a bad request fails before its batch job is created.
+
+    :param batchParams: the CLI parameters that are batched.
+    :param params: parameter dictionary passed to the endpoint.
+    :param user: the user that must be able to read the manifests and
+        folders.
+    """
+    for param in batchParams:
+        manifest = params.get(param.identifier() + BATCH_MANIFEST_SUFFIX)
+        try:
+            if manifest:
+                readManifest(manifest, user)
+            else:
+                Folder().load(
+                    params.get(param.identifier() + FOLDER_SUFFIX), user=user,
+                    level=AccessType.READ, exc=True)
+        except (ValueError, ValidationException) as exc:
+            raise RestException('Batch input %s: %s' % (param.identifier(), exc))
+
+
+def _batchValueStages(param):
+    """
+    Get the aggregation stages that find the value of a batch input from its
+    item.
+
+    :param param: the CLI parameter that is batched.
+    :returns: a list of pipeline stages.
+    """
+    if param.typ == 'file':
+        # Only the id of the first file of each item is looked up
+        return [
+            {'$lookup': {
+                'from': 'file',
+                'let': {'itemId': '$_id'},
+                'pipeline': [
+                    {'$match': {'$expr': {'$eq': ['$itemId', '$$itemId']}}},
+                    {'$limit': 1},
+                    {'$project': {'_id': 1}},
+                ],
+                'as': 'files',
+            }},
+            {'$match': {'files': {'$ne': []}}},
+            {'$project': {
+                'folderId': 1, 'value': {'$arrayElemAt': ['$files._id', 0]}}},
+        ]
+    return [{'$project': {
+        'folderId': 1, 'value': '$largeImage.fileId' if param.typ == 'image' else '$_id'}}]
+
+
+def resolveBatchInput(param, params, user):
+    """
+    Get the values that a batch input takes, in the order they are processed.
+    The items are either those in <param>_folder whose names match the
+    regular expression in <param>, sorted by lower case name, or those listed
+    in <param>_manifest, in the listed order.  If _recursive is set, items in
+    all readable subfolders of <param>_folder are also matched.
+
+    :param param: the CLI parameter that is batched.
+    :param params: parameter dictionary passed to the endpoint.
+    :param user: the user that must be able to read the items.
+    :returns: a list of id strings and a description of how the items were
+        found.  The ids are of the first file of each item for files, the
+        large image file of each item for images, and of the items otherwise.
+    """
+    manifest = params.get(param.identifier() + BATCH_MANIFEST_SUFFIX)
+    if manifest:
+        ids, plan = readManifest(manifest, user)
+        match = {'_id': {'$in': ids}}
+    else:
+        folder = Folder().load(
+            params.get(param.identifier() + FOLDER_SUFFIX), user=user,
+            level=AccessType.READ, exc=True)
+        query, plan = planNameQuery(params.get(param.identifier()) or '')
+        match = dict(query, folderId=folder['_id'])
+        if batchRecursive(params):
+            folderIds = subfolderIds(folder, user)
+            match['folderId'] = {'$in': folderIds}
+    if param.typ == 'image':
+        match['largeImage.fileId'] = {'$exists': True}
+    pipeline = [{'$match': match}]
+    if not manifest:
+        pipeline.append({'$sort': {'lowerName': 1, '_id': 1}})
+    entries = list(Item().collection.aggregate(pipeline + _batchValueStages(param)))
+    if not manifest:
+        plan = '%s in folder %s' % (plan, folder['_id'])
+        if batchRecursive(params):
+            plan += ' and %d subfolders' % (len(folderIds) - 1)
+        return [str(entry['value']) for entry in entries], plan
+    # Item access follows from folder access, so check each folder once
+    for folderId in {entry['folderId'] for entry in entries}:
+        Folder().load(folderId, user=user, level=AccessType.READ, exc=True)
+    values = {entry['_id']: str(entry['value']) for entry in entries}
+    missing = [str(itemId) for itemId in ids if itemId not in values]
+    if missing:
+        raise ValueError('%d manifest entries are not usable %s items, such as %s' % (
+            len(missing), param.typ, missing[0]))
+    return [values[itemId] for itemId in ids], '%d items %s' % (len(ids), plan)
+
+
+def batchStatusCounts(jobId):
+    """
+    Count the sub-jobs of a batch job by status.
+
+    :param jobId: the id of the batch job.
+    :returns: a dictionary of job statuses to the number of sub-jobs.
+    """
+    return {entry['_id']: entry['count'] for entry in Job().collection.aggregate([
+        {'$match': {'parentId': jobId}},
+        {'$group': {'_id': '$status', 'count': {'$sum': 1}}},
+    ])}
+
+
+class BatchJob:
+    """
+    The state of a running batch job.  The job parameters contain the id of
+    the cli item, the parameters, including those for batching, and the user
+    id.
+    """
+
+    def __init__(self, job, cliItem, handler, user):
+        """
+        :param job: the batch job model.
+        :param cliItem: the CLIItem model of the cli that is run.
+        :param handler: the cli's run handler.
+        :param user: the user model of the owner of the batch job.
+        """
+        self.jobId = job['_id']
+        self.params = job['kwargs']['params']
+        self.cliTitle = job['kwargs']['cliTitle']
+        self.cliItem = cliItem
+        self.handler = handler
+        self.user = user
+        self.token = Token().createToken(user=user)
+        self.batchParams = handler.getBatchParams(self.params)
+        self.concurrency = batchConcurrency(self.params)
+        self.incremental = batchIncremental(self.params)
+        self.sweep, self.sweepMode = batchSweep(self.params, handler.parameterTable)
+        # the parameter of each list of input values
+        self.inputKeys = [param.identifier() for param in self.batchParams] + sorted(self.sweep)
+        # the values of each batch input, in the same order
+        self.inputs = job.get(BATCH_INPUTS_FIELD)
+        # the indices of the entries that are processed, if not all of them
+        self.entries = job.get(BATCH_ENTRIES_FIELD)
+        self.count = None
+        if self.inputs is not None:
+            self.count = len(self.entries) if self.entries is not None else sweepEntryCount(
+                self.inputs, self.sweep, self.sweepMode)
+        self.started = self.inputs is not None and job['status'] == JobStatus.RUNNING
+        # resume from the last checkpoint, if any
+        progress = job.get(BATCH_PROGRESS_FIELD) or {}
+        self.owner = progress.get('owner')
+        self.scheduled = progress.get('scheduled', 0)
+        self.completed = progress.get('completed', 0)
+        self.done = False
+        # the status of each sub-job that hasn't finished, by id.  The
+        # statuses of resumed sub-jobs are unknown until they are refreshed.
+        self.inFlight = {subJobId: None for subJobId in progress.get('inFlight', [])}
+        self.lastSubJobId = progress['inFlight'][-1] if progress.get('inFlight') else None
+        # a resumed batch may have sub-jobs submitted after its checkpoint
+        self.recover = bool(progress)
+
+    def start(self):
+        """
+        Mark the batch job as running and resolve its inputs.  The inputs are
+        stored with the batch job, so later changes to the folders don't
+        affect which items are processed.
+
+        :returns: False if the batch cannot be run.
+        """
+        self.started = True
+        job = self.loadJob()
+        if job['status'] != JobStatus.RUNNING:
+            job = Job().updateJob(
+                job, log='Started batch processing %s\n' % self.cliTitle,
+                status=JobStatus.RUNNING)
+        if self.inputs is None:
+            inputs = []
+            for param in self.batchParams:
+                try:
+                    values, plan = resolveBatchInput(param, self.params, self.user)
+                except ValueError as exc:
+                    Job().updateJob(
+                        job, log='Failed batch processing %s - %s\n' % (self.cliTitle, exc),
+                        status=JobStatus.ERROR)
+                    return False
+                job = Job().updateJob(job, log='Batch input %s: %d entries from %s\n' % (
+                    param.identifier(), len(values), plan))
+                inputs.append(values)
+            if any(len(values) != len(inputs[0]) for values in inputs):
+                Job().updateJob(
+                    job, log='Failed batch processing %s - different number '
+                    'of entries on batch inputs\n' % self.cliTitle,
+                    status=JobStatus.ERROR)
+                return False
+            try:
+                count = sweepEntryCount(inputs, self.sweep, self.sweepMode)
+                if count > MAX_BATCH_ENTRIES:
+                    raise ValueError('%d entries is more than the limit of %d' % (
+                        count, MAX_BATCH_ENTRIES))
+            except ValueError as exc:
+                Job().updateJob(
+                    job, log='Failed batch processing %s - %s\n' % (self.cliTitle, exc),
+                    status=JobStatus.ERROR)
+                return False
+            self.inputs, self.count = inputs, count
+            if self.sweep:
+                job = Job().updateJob(job, log='Batch sweep of %s (%s): %d entries\n' % (
+                    ', '.join(sorted(self.sweep)), self.sweepMode, self.count))
+            fields = {BATCH_INPUTS_FIELD: self.inputs, BATCH_INPUT_KEYS_FIELD: self.inputKeys}
+            if self.sweep:
+                fields[BATCH_SWEEP_FIELD] = {'mode': self.sweepMode, 'values': self.sweep}
+            if self.incremental:
+                self.entries = self.unprocessed()
+                Job().updateJob(
+                    job, log='Skipping %d of %d entries that were already '
+                    'processed\n' % (self.count - len(self.entries), self.count))
+                self.count = len(self.entries)
+                fields[BATCH_ENTRIES_FIELD] = self.entries
+            Job().updateJob(job, otherFields=fields)
+            self.checkpoint()
+        return True
+
+    def claim(self, owner):
+        """
+        Take ownership of the batch.  A batch owned by another scheduler is
+        only taken over if that scheduler's heartbeat is stale.
+
+        :param owner: a value identifying the new owner.
+        :returns: True if the batch was claimed.  This is False if the batch
+            was claimed by another scheduler since it was loaded or if its
+            scheduler is still running.
+        """
+        now = datetime.datetime.utcnow()
+        query = {'_id': self.jobId, BATCH_PROGRESS_FIELD + '.owner': self.owner}
+        if self.owner is not None and self.owner != owner:
+            query['$or'] = [
+                {BATCH_HEARTBEAT_FIELD: {'$exists': False}},
+                {BATCH_HEARTBEAT_FIELD: {
+                    '$lt': now - datetime.timedelta(seconds=HEARTBEAT_TIMEOUT)}}]
+        result = Job().collection.update_one(query, {'$set': {
+            BATCH_PROGRESS_FIELD + '.owner': owner,
+            BATCH_HEARTBEAT_FIELD: now,
+            'updated': now,
+        }})
+        if not result.matched_count:
+            return False
+        self.owner = owner
+        return True
+
+    def checkpoint(self):
+        """
+        Record the progress of the batch in its job so that it can be resumed.
+        The number of scheduled sub-jobs is also the index of the next one, so
+        it is recorded before that sub-job is submitted.
+
+        :returns: False if another scheduler has claimed the batch.
+        """
+        now = datetime.datetime.utcnow()
+        result = Job().collection.update_one({
+            '_id': self.jobId,
+            BATCH_PROGRESS_FIELD + '.owner': self.owner,
+        }, {'$set': {
+            BATCH_PROGRESS_FIELD + '.total': self.count,
+            BATCH_PROGRESS_FIELD + '.scheduled': self.scheduled,
+            BATCH_PROGRESS_FIELD + '.completed': self.completed,
+            BATCH_PROGRESS_FIELD + '.inFlight': list(self.inFlight),
+            BATCH_HEARTBEAT_FIELD: now,
+            'updated': now,
+        }})
+        return bool(result.matched_count)
+
+    def recoverSubmitted(self, scheduler=None):
+        """
+        Adopt sub-jobs that were submitted after the last checkpoint, such as
+        when Girder stopped before it could be recorded, rather than
+        submitting them again.  These have the checkpointed index of the next
+        sub-job or a later one.
+
+        :param scheduler: if not None, the BatchScheduler to tell about the
+            adopted sub-jobs.
+        """
+        for subjob in Job().find({
+                'parentId': self.jobId, BATCH_INDEX_FIELD: {'$gte': self.scheduled}},
+                sort=[(BATCH_INDEX_FIELD, 1)], fields=['status', BATCH_INDEX_FIELD]):
+            self.inFlight[subjob['_id']] = subjob['status']
+            self.lastSubJobId = subjob['_id']
+            self.scheduled = subjob[BATCH_INDEX_FIELD] + 1
+            if scheduler is not None:
+                scheduler.watch(subjob['_id'], self.jobId)
+
+    def unprocessed(self):
+        """
+        Find the entries of the batch that don't have a successful job of
+        this user with the same CLI digest and inputs.
+
+        :returns: a list of the indices of the entries to process.
+        """
+        fingerprints = [
+            self.handler.fingerprint(self.cliItem, self.subJobParams(idx))
+            for idx in range(self.count)]
+        done = set()
+        for start in range(0, len(fingerprints), FINGERPRINT_CHUNK):
+            done.update(entry[JOB_FINGERPRINT_FIELD] for entry in Job().find({
+                JOB_FINGERPRINT_FIELD: {
+                    '$in': fingerprints[start:start + FINGERPRINT_CHUNK]},
+                'status': JobStatus.SUCCESS,
+                'userId': self.user['_id'],
+            }, fields=[JOB_FINGERPRINT_FIELD]))
+        return [idx for idx, fingerprint in enumerate(fingerprints) if fingerprint not in done]
+
+    def loadJob(self):
+        """
+        Load the batch job without its log and resolved inputs.
+
+        :returns: the job model or None.
+        """
+        return Job().load(self.jobId, force=True, fields={
+            'log': False, BATCH_INPUTS_FIELD: False, BATCH_ENTRIES_FIELD: False})
+
+    def ready(self):
+        """
+        Check if another sub-job can be scheduled.
+
+        :returns: True if there is room for another sub-job.
+        """
+        if self.done:
+            return False
+        if self.concurrency:
+            return len(self.inFlight) < self.concurrency
+        return self.inFlight.get(self.lastSubJobId) not in _waitingStatuses
+
+    def nextParams(self):
+        """
+        Get the parameters of the next sub-job.
+
+        :returns: the parameters or None if there are no more sub-jobs.
+        """
+        if self.scheduled >= self.count:
+            return None
+        return self.subJobParams(self.scheduled)
+
+    def subJobParams(self, index):
+        """
+        Get the parameters of a sub-job.
+
+        :param index: the index of the sub-job within the batch.
+        :returns: the parameters.
+        """
+        jobParams = self.params.copy()
+        for key in BATCH_ONLY_PARAMS:
+            jobParams.pop(key, None)
+        if self.entries is not None:
+            index = self.entries[index]
+        values = batchEntry(self.inputs, self.sweep, self.sweepMode, index)
+        for key, value in zip(self.inputKeys, values):
+            jobParams.pop(key + FOLDER_SUFFIX, None)
+            jobParams.pop(key + BATCH_MANIFEST_SUFFIX, None)
+            jobParams[key] = value
+        return jobParams
+
+    def step(self, scheduler=None):
+        """
+        Check on the sub-jobs of the batch and schedule more if there is room.
+
+        :param scheduler: if not None, the BatchScheduler to tell about new
+            sub-jobs.
+        :returns: True if the batch is finished.
+        """
+        if not self.started and not self.start():
+            return True
+        job = self.loadJob()
+        if not job or job['status'] in {JobStatus.CANCELED, JobStatus.ERROR}:
+            return True
+        if job.get(BATCH_PROGRESS_FIELD, {}).get('owner') != self.owner:
+            logger.info('Batch job %s is handled by another scheduler' % self.jobId)
+            return True
+        progress = (self.scheduled, self.completed)
+        if self.recover:
+            self.recover = False
+            self.recoverSubmitted(scheduler)
+        if self.inFlight:
+            inFlight = {subjob['_id']: subjob['status'] for subjob in Job().find({
+                '_id': {'$in': list(self.inFlight)},
+                'status': {'$nin': list(_finishedStatuses)},
+            }, fields=['status'])}
+            self.completed += len(self.inFlight) - len(inFlight)
+            self.inFlight = inFlight
+        while self.ready():
+            jobParams = self.nextParams()
+            if jobParams is None:
+                self.done = True
+                break
+            # We are running in a girder context, but girder_worker uses
+            # cherrypy.request.app to detect this, so we have to fake it.
+            _before = cherrypy.request.app
+            cherrypy.request.app = 'fake_context'
+            try:
+                subjob = self.handler.subHandler(
+                    self.cliItem, jobParams, self.user, self.token, otherFields={
+                        'parentId': self.jobId, BATCH_INDEX_FIELD: self.scheduled}).job
+            finally:
+                cherrypy.request.app = _before
+            self.lastSubJobId = subjob['_id']
+            self.inFlight[subjob['_id']] = subjob['status']
+            if scheduler is not None:
+                scheduler.watch(subjob['_id'], self.jobId)
+            self.scheduled += 1
+            if not self.checkpoint():
+                return True
+        if (self.scheduled, self.completed) != progress and not self.checkpoint():
+            return True
+        if self.done and not self.inFlight:
+            counts = batchStatusCounts(self.jobId)
+            Job().updateJob(
+                job, log='Finished batch processing %s - %d jobs: %s\n' % (
+                    self.cliTitle, self.scheduled, ', '.join(
+                        '%d %s' % (count, _statusNames.get(status, status))
+                        for status, count in sorted(counts.items()))),
+                status=JobStatus.SUCCESS)
+            return True
+        return False
+
+    def fail(self, exc):
+        """
+        Mark the batch job as failed.
+
+        :param exc: the exception that stopped the batch.
+        """
+        logger.exception('Error batch processing %s\n' % self.cliTitle)
+        job = self.loadJob()
+        if not job:
+            return
+        job = Job().updateJob(
+            job, log='Error batch processing %s\n' % self.cliTitle,
+            status=JobStatus.ERROR)
+        Job().updateJob(job, log='Exception: %r\n' % exc)
+
+
+class BatchScheduler(threading.Thread):
+    """
+    A single thread that schedules the sub-jobs of all running batch jobs.  A
+    batch is checked when it is added, when it is canceled, and when one of
+    its sub-jobs changes status.  Every batch is also checked each
+    SWEEP_INTERVAL, since jobs can be updated by other processes.
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        self.daemon = True
+        self.terminate = False
+        # identifies this scheduler as the owner of its batches
+        self.owner = uuid.uuid4().hex
+        self.cond = threading.Condition()
+        # batches by job id
+        self.batches = {}
+        # the batch job id of each watched sub-job
+        self.subJobs = {}
+        # the ids of batches that need to be checked
+        self.pending = set()
+        # if not None, a function called every sweep to resume batches whose
+        # scheduler has stopped
+        self.resume = None
+
+    def run(self):
+        nextSweep = time.time() + SWEEP_INTERVAL
+        while not self.terminate:
+            with self.cond:
+                if not self.pending:
+                    self.cond.wait(max(nextSweep - time.time(), 0))
+                # Sweep on a timer so that a steady stream of sub-job updates
+                # can't delay it.
+                sweep = time.time() >= nextSweep
+                if sweep:
+                    self.pending |= set(self.batches)
+                    nextSweep = time.time() + SWEEP_INTERVAL
+                pending, self.pending = self.pending, set()
+            if sweep:
+                try:
+                    self.heartbeat()
+                    if self.resume is not None:
+                        self.resume()
+                except Exception:
+                    logger.exception('Error checking for batch jobs to resume')
+            for batchId in pending:
+                try:
+                    self.process(batchId)
+                except Exception:
+                    logger.exception('Error checking batch job %s' % batchId)
+
+    def heartbeat(self):
+        """
+        Record that this scheduler is still running in each of its batches.
+        """
+        with self.cond:
+            batchIds = list(self.batches)
+        if batchIds:
+            Job().collection.update_many({
+                '_id': {'$in': batchIds},
+                BATCH_PROGRESS_FIELD + '.owner': self.owner,
+            }, {'$set': {BATCH_HEARTBEAT_FIELD: datetime.datetime.utcnow()}})
+
+    def process(self, batchId):
+        """
+        Check on a batch.
+
+        :param batchId: the id of the batch job.
+        """
+        batch = self.batches.get(batchId)
+        if batch is None:
+            return
+        try:
+            finished = batch.step(self)
+        except Exception as exc:
+            try:
+                batch.fail(exc)
+            except Exception:
+                logger.exception('Failed to mark batch job %s as failed' % batchId)
+            finished = True
+        with self.cond:
+            for subJobId in [key for key, value in self.subJobs.items()
+                             if value == batchId and (finished or key not in batch.inFlight)]:
+                del self.subJobs[subJobId]
+            if finished:
+                del self.batches[batchId]
+
+    def add(self, batch):
+        """
+        Start scheduling a batch.
+
+        :param batch: a BatchJob.
+        :returns: False if the batch was claimed by another scheduler.
+        """
+        if not batch.claim(self.owner):
+            return False
+        with self.cond:
+            self.batches[batch.jobId] = batch
+            for subJobId in batch.inFlight:
+                self.subJobs[subJobId] = batch.jobId
+            self.pending.add(batch.jobId)
+            self.cond.notify()
+        return True
+
+    def watch(self, subJobId, batchId):
+        """
+        Check a batch when a sub-job changes status.
+
+        :param subJobId: the id of the sub-job.
+        :param batchId: the id of the batch job.
+        """
+        with self.cond:
+            self.subJobs[subJobId] = batchId
+
+    def onJobUpdate(self, event):
+        """
+        Handle a job update event.  If this is a status change of a watched
+        sub-job or the cancelation of a batch job, check that batch.
+        """
+        job = event.info.get('job') or {}
+        jobId = job.get('_id')
+        with self.cond:
+            batchId = self.subJobs.get(jobId)
+            if batchId is not None:
+                batch = self.batches.get(batchId)
+                if batch is None or batch.inFlight.get(jobId) == job.get('status'):
+                    return
+            elif jobId in self.batches and job.get('status') in {
+                    JobStatus.CANCELED, JobStatus.ERROR}:
+                batchId = jobId
+            else:
+                return
+            self.pending.add(batchId)
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.terminate = True
+            self.cond.notify()
+
+
+def getScheduler():
+    """
+    Get the batch scheduler, starting it if needed.  If the scheduler thread
+    has stopped, a new one takes over its batches.
+
+    :returns: the BatchScheduler.
+    """
+    global _scheduler
+
+    with _schedulerLock:
+        if _scheduler is None or not _scheduler.is_alive():
+            previous = _scheduler
+            _scheduler = BatchScheduler()
+            if previous is not None:
+                logger.warning('Restarting the batch scheduler')
+                with previous.cond:
+                    _scheduler.owner = previous.owner
+                    _scheduler.batches = previous.batches
+                    _scheduler.subJobs = previous.subJobs
+                    _scheduler.pending = set(previous.batches)
+                    _scheduler.resume = previous.resume
+                events.unbind('jobs.job.update.after', 'slicer_cli_web_batch')
+            _scheduler.start()
+            events.bind('jobs.job.update.after', 'slicer_cli_web_batch',
+                        _scheduler.onJobUpdate)
+    return _scheduler
@@ -1,7 +1,16 @@
 """utils for CLI spec handling."""
+import collections
+import hashlib
 import io
+import json
+import threading
+import time
+import types
+import weakref
 
-from .ctk_cli_adjustment import CLIModule
+import ctk_cli
+
+from .ctk_cli_adjustment import CLIModule, CLIParameter
 
 return_parameter_file_name = 'returnparameterfile'
 
@@ -18,6 +27,83 @@ SLICER_SUPPORTED_TYPES = set(['boolean', 'integer', 'float', 'double', 'string',
                               'string-enumeration',
                               'region'] + list(SLICER_TYPE_TO_GIRDER_MODEL_MAP.keys()))
 
+SLICER_SWEEPABLE_TYPES = {'boolean', 'integer', 'float', 'double', 'string',
+                          'integer-enumeration', 'float-enumeration', 'double-enumeration',
+                          'string-enumeration'}
+
+
+class LRUCache:
+    """
+    A small thread-safe cache that discards the least recently used entries
+    once it holds more than ``maxsize`` values.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > max(self.maxsize, 0):
+                self._data.popitem(last=False)
+        return value
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class TTLCache(LRUCache):
+    """
+    An LRUCache whose entries also expire ``ttl`` seconds after they were
+    set.  The ttl of an entry can be given when it is set.
+    """
+
+    def __init__(self, maxsize=128, ttl=300):
+        super().__init__(maxsize)
+        self.ttl = ttl
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def get(self, key, default=None):
+        entry = super().get(key)
+        if entry is None:
+            return default
+        if entry[0] < time.time():
+            self.pop(key)
+            return default
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        super().set(key, (time.time() + (self.ttl if ttl is None else ttl), value))
+        return value
+
+    def pop(self, key, default=None):
+        entry = super().pop(key)
+        return default if entry is None else entry[1]
+
 
 def generate_description(clim):
     """Create CLI description string."""
@@ -38,14 +124,39 @@ def generate_description(clim):
     return '<br/><br/>'.join(str_description)
 
 
+def xml_digest(cliXML):
+    """Return the hex digest used to identify a cli xml spec."""
+    return hashlib.sha256(
+        cliXML if isinstance(cliXML, bytes) else cliXML.encode('utf8')).hexdigest()
+
+
+# Parsed cli models keyed by the digest of their xml.  Many docker images ship
+# byte-identical specs, so these are shared across items; the models and
+# parameters must be treated as read-only.
+_modelCache = LRUCache(256)
+# Classified parameters keyed by the id of the parsed model.  Each entry holds
+# the model itself so that an id cannot be reused while its entry exists.
+_parameterCache = LRUCache(256)
+
+
 def as_model(cliXML):
-    """Parses cli xml spec."""
-    stream = io.BytesIO(cliXML if isinstance(cliXML, bytes) else cliXML.encode('utf8'))
-    return CLIModule(stream=stream)
+    """Parses cli xml spec.  Identical specs are only parsed once."""
+    cliXML = cliXML if isinstance(cliXML, bytes) else cliXML.encode('utf8')
+    digest = xml_digest(cliXML)
+    clim = _modelCache.get(digest)
+    if clim is None:
+        clim = _modelCache.set(digest, CLIModule(stream=io.BytesIO(cliXML)))
+    return clim
 
 
 def get_cli_parameters(clim):
+    entry = _parameterCache.get(id(clim))
+    if entry is None or entry[0] is not clim:
+        entry = _parameterCache.set(id(clim), (clim, _classify_cli_parameters(clim)))
+    return tuple(list(params) for params in entry[1])
+
 
+def _classify_cli_parameters(clim):
     # get parameters
     index_params, opt_params, simple_out_params = clim.classifyParameters()
 
@@ -73,6 +184,160 @@ def get_cli_parameters(clim):
     return index_params, opt_params, simple_out_params
 
 
+# Increment this whenever the content of a parameter plan or the way
+# parameters are classified changes; older plans are then ignored.
+PARAMETER_PLAN_VERSION = 1
+
+_PLAN_MODULE_FIELDS = ('title', 'description', 'version', 'license', 'contributor',
+                       'acknowledgements')
+_PLAN_PARAMETER_FIELDS = tuple(
+    key for key in CLIParameter.__slots__ if key not in {'_pythonType', 'constraints'})
+
+
+def _plan_parameter_entry(param):
+    entry = {key: getattr(param, key, None) for key in _PLAN_PARAMETER_FIELDS}
+    entry = {key: value for key, value in entry.items() if value is not None}
+    if getattr(param, 'constraints', None) is not None:
+        entry['constraints'] = {
+            key: getattr(param.constraints, key, None)
+            for key in ctk_cli.module.CLIConstraints.__slots__}
+    return entry
+
+
+def _plan_parameter(entry):
+    param = CLIParameter()
+    for key in _PLAN_PARAMETER_FIELDS:
+        setattr(param, key, entry.get(key))
+    param.constraints = None
+    if entry.get('constraints') is not None:
+        param.constraints = ctk_cli.module.CLIConstraints()
+        for key in ctk_cli.module.CLIConstraints.__slots__:
+            setattr(param.constraints, key, entry['constraints'].get(key))
+    # this mirrors CLIParameter.parse
+    elementType = param.typ
+    if param.typ in ('point', 'region'):
+        param._pythonType = float
+    else:
+        if elementType.endswith('-vector'):
+            elementType = elementType[:-7]
+        elif elementType.endswith('-enumeration'):
+            elementType = elementType[:-12]
+        param._pythonType = CLIParameter.PYTHON_TYPE_MAPPING.get(elementType, str)
+    return param
+
+
+def build_parameter_plan(cliXML):
+    """
+    Build the parameter plan of a cli xml spec.  This is a json-serializable
+    record of the module information and the classified, sorted, and
+    validated parameters, so that handlers can be generated without parsing
+    the xml.
+
+    :param cliXML: the cli xml spec.
+    :returns: the parameter plan.
+    """
+    clim = as_model(cliXML)
+    index_params, opt_params, simple_out_params = get_cli_parameters(clim)
+    return {
+        'version': PARAMETER_PLAN_VERSION,
+        'digest': xml_digest(cliXML),
+        'module': {key: getattr(clim, key, None) for key in _PLAN_MODULE_FIELDS},
+        'index': [_plan_parameter_entry(param) for param in index_params],
+        'optional': [_plan_parameter_entry(param) for param in opt_params],
+        'simpleOutput': [_plan_parameter_entry(param) for param in simple_out_params],
+        'batchable': [
+            param.identifier() for param in index_params + opt_params
+            if can_be_batched(param)],
+    }
+
+
+def load_parameter_plan(cliXML, plan=None):
+    """
+    Get the module information and classified parameters of a cli.  These
+    are taken from a parameter plan if it is current and matches the xml;
+    otherwise the xml is parsed.
+
+    :param cliXML: the cli xml spec.
+    :param plan: a parameter plan as generated by build_parameter_plan or
+        None.
+    :returns: module information with the attributes used by
+        generate_description, a list of index parameters, a list of optional
+        parameters, a list of simple output parameters, and a set of the
+        identifiers of parameters that can be batched.
+    """
+    if (not plan or plan.get('version') != PARAMETER_PLAN_VERSION or
+            plan.get('digest') != xml_digest(cliXML)):
+        clim = as_model(cliXML)
+        index_params, opt_params, simple_out_params = get_cli_parameters(clim)
+        batchable = {
+            param.identifier() for param in index_params + opt_params
+            if can_be_batched(param)}
+        return clim, index_params, opt_params, simple_out_params, batchable
+    return (
+        types.SimpleNamespace(**plan['module']),
+        [_plan_parameter(entry) for entry in plan['index']],
+        [_plan_parameter(entry) for entry in plan['optional']],
+        [_plan_parameter(entry) for entry in plan['simpleOutput']],
+        set(plan['batchable']),
+    )
+
+
+class ParameterTable:
+    """
+    The classified parameters of a cli and the module information needed to
+    describe it.  Tables are shared by all clis with the same spec, so they
+    and their parameters must be treated as read-only.
+    """
+
+    __slots__ = ('title', 'notes', 'index_params', 'opt_params', 'simple_out_params',
+                 'batchable', '__weakref__')
+
+    def __init__(self, clim, index_params, opt_params, simple_out_params, batchable):
+        self.title = clim.title
+        self.notes = generate_description(clim)
+        self.index_params = tuple(index_params)
+        self.opt_params = tuple(opt_params)
+        self.simple_out_params = tuple(simple_out_params)
+        self.batchable = frozenset(batchable)
+
+
+# Parameter tables keyed by the digest of their xml.  A table is kept as long
+# as a handler uses it.
+_parameterTables = weakref.WeakValueDictionary()
+
+
+def get_parameter_table(cliXML, plan=None):
+    """
+    Get the shared parameter table of a cli.
+
+    :param cliXML: the cli xml spec.
+    :param plan: a parameter plan as generated by build_parameter_plan or
+        None.
+    :returns: a ParameterTable.
+    """
+    digest = xml_digest(cliXML)
+    table = _parameterTables.get(digest)
+    if table is None:
+        table = _parameterTables.setdefault(
+            digest, ParameterTable(*load_parameter_plan(cliXML, plan)))
+    return table
+
+
+def can_be_batched(param):
+    return (
+        param.isExternalType() and
+        param.typ != 'directory' and
+        not getattr(param, 'multiple', None) and
+        param.channel != 'output')
+
+
+def can_be_swept(param):
+    return (
+        param.typ in SLICER_SWEEPABLE_TYPES and
+        not is_girder_api(param) and
+        param.channel != 'output')
+
+
 def is_on_girder(param):
     if param.reference == '_girder_id_':
         return False
@@ -81,3 +346,33 @@ def is_on_girder(param):
 
 def is_girder_api(param):
     return param.name in {'girderApiUrl', 'girderToken'}
+
+
+def normalize_param_value(param, value):
+    """
+    Convert a parameter value to the python value it stands for, so that
+    equivalent values, such as "1" and "1.0" for a float parameter or "true"
+    and "True" for a boolean, compare equal.  Values that can't be converted
+    are returned unchanged.
+
+    :param param: the CLI parameter.
+    :param value: a value as passed to an endpoint or the parameter's
+        default.
+    :returns: the normalized value.
+    """
+    if value is None or is_on_girder(param):
+        return value
+    if param.typ == 'boolean':
+        return value.strip().lower() == 'true' if isinstance(value, str) else bool(value)
+    pythonType = getattr(param, '_pythonType', None) or str
+    try:
+        if isinstance(value, str) and (pythonType is not str or param.isVector()):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                value = param.parseValue(value)
+        if isinstance(value, (list, tuple)):
+            return [pythonType(entry) for entry in value]
+        return pythonType(value)
+    except (TypeError, ValueError):
+        return value
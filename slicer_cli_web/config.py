@@ -23,11 +23,23 @@ from girder.models.setting import Setting
 from girder.settings import SettingDefault
 from girder.utility import setting_utilities
 
+# How CLI specs are read from docker images: by running the image's
+# entrypoint, or from files in the image, falling back to running it.
+SPEC_EXTRACTION_MODES = ('run', 'files')
+
 
 # Constants representing the setting keys for this plugin
 class PluginSettings:
     SLICER_CLI_WEB_TASK_FOLDER = 'slicer_cli_web.task_folder'
     SLICER_CLI_WEB_WORKER_CONFIG_ITEM = 'slicer_cli_web.worker_config_item'
+    SLICER_CLI_WEB_LAZY_ENDPOINTS = 'slicer_cli_web.lazy_endpoints'
+    SLICER_CLI_WEB_ENDPOINT_CACHE_SIZE = 'slicer_cli_web.endpoint_cache_size'
+    SLICER_CLI_WEB_DISPATCH_ENDPOINTS = 'slicer_cli_web.dispatch_endpoints'
+    SLICER_CLI_WEB_BATCH_CONCURRENCY = 'slicer_cli_web.batch_concurrency'
+    SLICER_CLI_WEB_DATALIST_CACHE_TTL = 'slicer_cli_web.datalist_cache_ttl'
+    SLICER_CLI_WEB_PULL_CONCURRENCY = 'slicer_cli_web.pull_concurrency'
+    SLICER_CLI_WEB_SPEC_EXTRACTION = 'slicer_cli_web.spec_extraction'
+    SLICER_CLI_WEB_RUN_MANY_MAX = 'slicer_cli_web.run_many_max'
 
     @staticmethod
     def has_task_folder():
@@ -51,6 +63,38 @@ class PluginSettings:
             return None
         return Item().load(item, force=True, exc=False)
 
+    @staticmethod
+    def get_lazy_endpoints():
+        return bool(Setting().get(PluginSettings.SLICER_CLI_WEB_LAZY_ENDPOINTS))
+
+    @staticmethod
+    def get_endpoint_cache_size():
+        return Setting().get(PluginSettings.SLICER_CLI_WEB_ENDPOINT_CACHE_SIZE)
+
+    @staticmethod
+    def get_dispatch_endpoints():
+        return bool(Setting().get(PluginSettings.SLICER_CLI_WEB_DISPATCH_ENDPOINTS))
+
+    @staticmethod
+    def get_batch_concurrency():
+        return Setting().get(PluginSettings.SLICER_CLI_WEB_BATCH_CONCURRENCY)
+
+    @staticmethod
+    def get_datalist_cache_ttl():
+        return Setting().get(PluginSettings.SLICER_CLI_WEB_DATALIST_CACHE_TTL)
+
+    @staticmethod
+    def get_pull_concurrency():
+        return Setting().get(PluginSettings.SLICER_CLI_WEB_PULL_CONCURRENCY)
+
+    @staticmethod
+    def get_spec_extraction():
+        return Setting().get(PluginSettings.SLICER_CLI_WEB_SPEC_EXTRACTION)
+
+    @staticmethod
+    def get_run_many_max():
+        return Setting().get(PluginSettings.SLICER_CLI_WEB_RUN_MANY_MAX)
+
 
 @setting_utilities.validator({
     PluginSettings.SLICER_CLI_WEB_TASK_FOLDER
@@ -78,6 +122,51 @@ def validateItem(doc):
         raise ValidationException('invalid folder selected')
 
 
+@setting_utilities.validator({
+    PluginSettings.SLICER_CLI_WEB_LAZY_ENDPOINTS,
+    PluginSettings.SLICER_CLI_WEB_DISPATCH_ENDPOINTS,
+})
+def validateBoolean(doc):
+    if not isinstance(doc['value'], bool):
+        raise ValidationException('%s must be a boolean.' % doc['key'], 'value')
+
+
+@setting_utilities.validator({
+    PluginSettings.SLICER_CLI_WEB_ENDPOINT_CACHE_SIZE,
+    PluginSettings.SLICER_CLI_WEB_PULL_CONCURRENCY,
+    PluginSettings.SLICER_CLI_WEB_RUN_MANY_MAX,
+})
+def validatePositiveInteger(doc):
+    try:
+        doc['value'] = int(doc['value'])
+    except (TypeError, ValueError):
+        raise ValidationException('%s must be an integer.' % doc['key'], 'value')
+    if doc['value'] < 1:
+        raise ValidationException('%s must be a positive integer.' % doc['key'], 'value')
+
+
+@setting_utilities.validator({
+    PluginSettings.SLICER_CLI_WEB_BATCH_CONCURRENCY,
+    PluginSettings.SLICER_CLI_WEB_DATALIST_CACHE_TTL,
+})
+def validateNonNegativeInteger(doc):
+    try:
+        doc['value'] = int(doc['value'])
+    except (TypeError, ValueError):
+        raise ValidationException('%s must be an integer.' % doc['key'], 'value')
+    if doc['value'] < 0:
+        raise ValidationException('%s must not be negative.' % doc['key'], 'value')
+
+
+@setting_utilities.validator({
+    PluginSettings.SLICER_CLI_WEB_SPEC_EXTRACTION
+})
+def validateSpecExtraction(doc):
+    if doc['value'] not in SPEC_EXTRACTION_MODES:
+        raise ValidationException('%s must be one of %s.' % (
+            doc['key'], ', '.join(SPEC_EXTRACTION_MODES)), 'value')
+
+
 # Defaults
 
 # Defaults that have fixed values can just be added to the system defaults
@@ -85,4 +174,12 @@ def validateItem(doc):
 SettingDefault.defaults.update({
     PluginSettings.SLICER_CLI_WEB_TASK_FOLDER: None,
     PluginSettings.SLICER_CLI_WEB_WORKER_CONFIG_ITEM: None,
+    PluginSettings.SLICER_CLI_WEB_LAZY_ENDPOINTS: False,
+    PluginSettings.SLICER_CLI_WEB_ENDPOINT_CACHE_SIZE: 256,
+    PluginSettings.SLICER_CLI_WEB_DISPATCH_ENDPOINTS: False,
+    PluginSettings.SLICER_CLI_WEB_BATCH_CONCURRENCY: 0,
+    PluginSettings.SLICER_CLI_WEB_DATALIST_CACHE_TTL: 300,
+    PluginSettings.SLICER_CLI_WEB_PULL_CONCURRENCY: 4,
+    PluginSettings.SLICER_CLI_WEB_SPEC_EXTRACTION: 'run',
+    PluginSettings.SLICER_CLI_WEB_RUN_MANY_MAX: 1000,
 })
@@ -21,7 +21,8 @@ import re
 import time
 
 import pymongo
-from girder.api import access
+from girder import logger
+from girder.api import access, docs
 from girder.api.describe import Description, autoDescribeRoute, describeRoute
 from girder.api.rest import setRawResponse, setResponseHeader
 from girder.api.v1.resource import Resource, RestException
@@ -33,9 +34,18 @@ from girder.utility.model_importer import ModelImporter
 from girder_jobs.constants import JobStatus
 from girder_jobs.models.job import Job
 
+from .batch_job import (BATCH_ENTRIES_FIELD, BATCH_INDEX_FIELD, BATCH_INPUT_KEYS_FIELD,
+                        BATCH_INPUTS_FIELD, BATCH_PROGRESS_FIELD, batchStatusCounts,
+                        loadBatchEntries)
+from .cli_utils import LRUCache
 from .config import PluginSettings
 from .models import CLIItem, DockerImageItem, DockerImageNotFoundError
-from .rest_slicer_cli import genRESTEndPointsForSlicerCLIsForItem
+from .models.docker_image import imageItemName
+from .rest_slicer_cli import (DATALIST_DEFAULT_WAIT, DATALIST_KEY_FIELD, DATALIST_MAX_WAIT,
+                              datalistResponse, datalistWait,
+                              genDispatchRESTEndPointsForSlicerCLIsForItem,
+                              genLazyRESTEndPointsForSlicerCLIsForItem,
+                              genRESTEndPointsForSlicerCLIsForItem)
 
 
 class DockerResource(Resource):
@@ -51,6 +61,19 @@ class DockerResource(Resource):
         self.currentEndpoints = {}
         self.resourceName = name
         self.jobType = 'slicer_cli_web_job'
+        # When lazy, the handlers for a CLI are only generated when it is
+        # first used and are then kept in a bounded cache.
+        self.lazyEndpoints = PluginSettings.get_lazy_endpoints()
+        self.handlerCache = LRUCache(PluginSettings.get_endpoint_cache_size())
+        # When dispatching, a fixed set of parametric routes looks up the
+        # handlers of each CLI by item id or by image and cli name.
+        self.dispatchEndpoints = PluginSettings.get_dispatch_endpoints()
+        self.dispatchHandlers = {}
+        self.dispatchNames = {}
+        # The API documentation of CLI routes is only built when it is
+        # requested.  This maps (method, route) to the handler of routes that
+        # have not been documented yet.
+        self.deferredDocs = {}
         self.route('PUT', ('docker_image',), self.setImages)
         self.route('DELETE', ('docker_image',), self.deleteImage)
         self.route('GET', ('docker_image',), self.getDockerImages)
@@ -63,6 +86,17 @@ class DockerResource(Resource):
 
         self.route('GET', ('path_match', ), self.getMatchingResource)
 
+        self.route('GET', ('batch', ':id', 'jobs'), self.getBatchJobs)
+        self.route('GET', ('batch', ':id', 'status'), self.getBatchStatus)
+        self.route('GET', ('datalist', ':id'), self.getDatalistValues)
+
+        if self.dispatchEndpoints:
+            self.route('POST', ('cli', ':id', ':action'), self.dispatchItemAction)
+            self.route('POST', ('cli', ':id', 'datalist', ':key'), self.dispatchItemDatalist)
+            self.route('POST', (':image', ':cli', ':action'), self.dispatchNamedAction)
+            self.route('POST', (':image', ':cli', 'datalist', ':key'),
+                       self.dispatchNamedDatalist)
+
         self._generateAllItemEndPoints()
 
     @access.public
@@ -124,7 +158,7 @@ class DockerResource(Resource):
         if removed != names:
             rest = [name for name in names if name not in removed]
             raise RestException('Some docker images could not be removed. %s' % (rest))
-        self.deleteImageEndpoints(removed)
+        self.refreshImageEndpoints(removed)
 
         try:
             if deleteImage:
@@ -195,6 +229,12 @@ class DockerResource(Resource):
                     level=AccessType.WRITE, required=False)
         .param('pull', 'If True, try to repull all images', paramType='query',
                required=False)
+        .param('pull_concurrency', 'The maximum number of images to pull at '
+               'once.  If not set, the slicer_cli_web.pull_concurrency setting '
+               'is used.', paramType='query', dataType='integer', required=False)
+        .param('force', 'If True, extract and save the CLIs of images even if '
+               'they are unchanged since they were last added.', paramType='query',
+               dataType='boolean', required=False, default=False)
         .errorResponse('You are not a system administrator.', 403)
         .errorResponse('Failed to set system setting.', 500)
     )
@@ -209,9 +249,22 @@ class DockerResource(Resource):
         folder = params.get('folder', PluginSettings.get_task_folder())
         if not folder:
             raise RestException('no upload folder given or defined by default')
-        return self._createPutImageJob(nameList, folder, params.get('pull', None))
+        pullConcurrency = params.get('pull_concurrency')
+        if pullConcurrency not in (None, ''):
+            try:
+                pullConcurrency = int(pullConcurrency)
+            except ValueError:
+                raise RestException('pull_concurrency must be an integer.')
+            if pullConcurrency < 1:
+                raise RestException('pull_concurrency must be a positive integer.')
+        else:
+            pullConcurrency = None
+        return self._createPutImageJob(
+            nameList, folder, params.get('pull', None), pullConcurrency,
+            str(params.get('force')).lower() == 'true')
 
-    def _createPutImageJob(self, nameList, baseFolder, pull=False):
+    def _createPutImageJob(self, nameList, baseFolder, pull=False, pullConcurrency=None,
+                           force=False):
         job = Job().createLocalJob(
             module='slicer_cli_web.image_job',
             function='jobPullAndLoad',
@@ -219,6 +272,8 @@ class DockerResource(Resource):
                 'nameList': nameList,
                 'folder': baseFolder['_id'] if isinstance(baseFolder, dict) else baseFolder,
                 'pull': pull,
+                'pullConcurrency': pullConcurrency,
+                'force': force,
             },
             title='Pulling and caching docker images',
             type=self.jobType,
@@ -244,41 +299,187 @@ class DockerResource(Resource):
         :type cliName: string
         """
         img = self.currentEndpoints.setdefault(imgName, {})
-        img[cliName] = undoFunction
+        # the same image may be loaded into more than one folder, so keep the
+        # undo functions of every item with this cli name
+        img.setdefault(cliName, []).append(undoFunction)
 
     def deleteImageEndpoints(self, imageList=None):
 
         if imageList is None:
             imageList = self.currentEndpoints.keys()
         for imageName in list(imageList):
-            for undoFunction in self.currentEndpoints.pop(imageName, {}).values():
-                undoFunction()
+            for undoFunctions in self.currentEndpoints.pop(imageName, {}).values():
+                for undoFunction in undoFunctions:
+                    undoFunction()
 
-    def _generateAllItemEndPoints(self):
+    def deferRouteDocs(self, method, route, handler):
+        """
+        Document a route the next time the API description is requested.
+
+        :param method: the HTTP method of the route.
+        :param route: the route as a tuple of path components.
+        :param handler: the route handler.  This must have a describe function
+            that returns its Description.
+        """
+        self.deferredDocs[(method, tuple(route))] = handler
+
+    def removeRouteDocs(self, method, route):
+        """
+        Remove the documentation of a route, whether or not it has been built.
+
+        :param method: the HTTP method of the route.
+        :param route: the route as a tuple of path components.
+        """
+        self.deferredDocs.pop((method, tuple(route)), None)
+        docs.removeRouteDocs(self.resourceName, route, method, None, None)
+
+    def describeDeferredRoutes(self, event=None):
+        """
+        Build the API documentation of routes that have not been documented
+        yet.  This is bound to the event fired before the API description is
+        returned.
+
+        :param event: the event, which is not used.
+        """
+        while self.deferredDocs:
+            try:
+                (method, route), handler = self.deferredDocs.popitem()
+            except KeyError:
+                break
+            try:
+                docs.removeRouteDocs(self.resourceName, route, method, None, handler)
+                docs.addRouteDocs(
+                    self.resourceName, route, method, handler.describe().asDict(), handler)
+            except Exception:
+                logger.exception('Failed to describe route %s', '/'.join(route))
+
+    def _generateItemEndPoints(self, items):
         # sort by name and creation date desc
-        items = sorted(CLIItem.findAllItems(), key=lambda x: (x.restPath, x.item['created']),
-                       reverse=True)
+        items = sorted(items, key=lambda x: (x.restPath, x.item['created']), reverse=True)
 
+        if self.dispatchEndpoints:
+            genEndPoints = genDispatchRESTEndPointsForSlicerCLIsForItem
+        elif self.lazyEndpoints:
+            genEndPoints = genLazyRESTEndPointsForSlicerCLIsForItem
+        else:
+            genEndPoints = genRESTEndPointsForSlicerCLIsForItem
         seen = set()
         for item in items:
             # default if not seen yet
-            genRESTEndPointsForSlicerCLIsForItem(self, item, item.restPath not in seen)
+            genEndPoints(self, item, item.restPath not in seen)
             seen.add(item.restPath)
 
+    def _generateAllItemEndPoints(self):
+        self._generateItemEndPoints(CLIItem.findAllItems())
+
+    def refreshImageEndpoints(self, imageList):
+        """
+        Regenerate the endpoints of the CLIs of some docker images.  The
+        endpoints of other images are left in place.  Since all of the items
+        of an image share its rest paths, the default named routes are
+        recomputed from the items of the listed images.
+
+        :param imageList: a list of docker image names.
+        """
+        imageList = {imageItemName(name) for name in imageList}
+        self.deleteImageEndpoints(imageList)
+        self._generateItemEndPoints(CLIItem.findImageItems(imageList))
+
     def addRestEndpoints(self, event):
         """
         Determines if the job event being triggered is due to the caching of
         new docker images or deleting a docker image off the local machine.  If
-        a new image is being loaded all old rest endpoints are deleted and
-        endpoints for all cached docker images are regenerated.
+        so, the rest endpoints of the images listed in the job are regenerated.
+        If the job doesn't list its images, all rest endpoints are regenerated.
 
         :param event: An event dictionary
         """
         job = event.info['job']
 
         if job['type'] == self.jobType and job['status'] == JobStatus.SUCCESS:
-            self.deleteImageEndpoints()
-            self._generateAllItemEndPoints()
+            kwargs = job.get('kwargs') or {}
+            if isinstance(kwargs, str):
+                kwargs = json.loads(kwargs)
+            imageList = kwargs.get('nameList', []) + kwargs.get('deleteList', [])
+            if imageList:
+                self.refreshImageEndpoints(imageList)
+            else:
+                self.deleteImageEndpoints()
+                self._generateAllItemEndPoints()
+
+    def _getDispatchHandlers(self, id=None, image=None, cli=None):
+        """
+        Get the handlers of a CLI from the dispatch tables.
+
+        :param id: the id of the CLI item.  If None, the image and cli names
+            are used.
+        :param image: the rest base path of the CLI's image.
+        :param cli: the name of the CLI.
+        :returns: the CLI's handler dictionary.
+        """
+        if id is None:
+            id = self.dispatchNames.get((image, cli))
+        getHandlers = self.dispatchHandlers.get(id)
+        if getHandlers is None:
+            raise RestException('No such CLI: %s.' % (id or '%s/%s' % (image, cli)), 404)
+        return getHandlers()
+
+    def _dispatchAction(self, handlers, action, params):
+        if action not in ('run', 'rerun', 'run_many'):
+            raise RestException('Unknown CLI action: %s.' % action, 404)
+        return handlers[action](self, params)
+
+    def _dispatchDatalist(self, handlers, key, params):
+        dlHandler = handlers['datalist'].get(key)
+        if dlHandler is None:
+            raise RestException('Parameter %s does not have a datalist.' % key, 404)
+        return dlHandler(self, params)
+
+    @access.token
+    @describeRoute(
+        Description('Run or rerun a CLI')
+        .notes('The parameters of each CLI are documented on its own endpoints.')
+        .param('id', 'The ID of the CLI item.', paramType='path')
+        .param('action', 'One of run, rerun, or run_many.', paramType='path',
+               enum=['run', 'rerun', 'run_many'])
+    )
+    def dispatchItemAction(self, id, action, params):
+        return self._dispatchAction(self._getDispatchHandlers(id), action, params)
+
+    @access.user
+    @describeRoute(
+        Description('List values for a parameter of a CLI')
+        .param('id', 'The ID of the CLI item.', paramType='path')
+        .param('key', 'The name of the parameter with a datalist.', paramType='path')
+        .produces('text/plain')
+    )
+    def dispatchItemDatalist(self, id, key, params):
+        return self._dispatchDatalist(self._getDispatchHandlers(id), key, params)
+
+    @access.token
+    @describeRoute(
+        Description('Run or rerun a CLI by image and name')
+        .notes('The parameters of each CLI are documented on its own endpoints.')
+        .param('image', 'The image name with :, /, and @ replaced by _.', paramType='path')
+        .param('cli', 'The name of the CLI.', paramType='path')
+        .param('action', 'One of run, rerun, or run_many.', paramType='path',
+               enum=['run', 'rerun', 'run_many'])
+    )
+    def dispatchNamedAction(self, image, cli, action, params):
+        return self._dispatchAction(
+            self._getDispatchHandlers(image=image, cli=cli), action, params)
+
+    @access.user
+    @describeRoute(
+        Description('List values for a parameter of a CLI by image and name')
+        .param('image', 'The image name with :, /, and @ replaced by _.', paramType='path')
+        .param('cli', 'The name of the CLI.', paramType='path')
+        .param('key', 'The name of the parameter with a datalist.', paramType='path')
+        .produces('text/plain')
+    )
+    def dispatchNamedDatalist(self, image, cli, key, params):
+        return self._dispatchDatalist(
+            self._getDispatchHandlers(image=image, cli=cli), key, params)
 
     def _dump(self, item, details=False):
         r = {
@@ -336,6 +537,80 @@ class DockerResource(Resource):
         setRawResponse()
         return CLIItem(item).xml
 
+    @access.user
+    @autoDescribeRoute(
+        Description('List the jobs scheduled by a batch job')
+        .notes('Each entry has the batch index of the job and the values of '
+               'the batch inputs it was run with.')
+        .modelParam('id', 'The batch job', model=Job, level=AccessType.ADMIN,
+                    fields={'log': False, BATCH_INPUTS_FIELD: False,
+                            BATCH_ENTRIES_FIELD: False})
+        .param('status', 'Only list jobs with this status.', dataType='integer',
+               required=False)
+        .pagingParams(defaultSort=BATCH_INDEX_FIELD)
+        .errorResponse('You are not logged in.', 403)
+        .errorResponse('Only the owner of the job or an admin may see its jobs.', 403)
+    )
+    def getBatchJobs(self, job, status, limit, offset, sort):
+        query = {'parentId': job['_id']}
+        if status is not None:
+            query['status'] = status
+        subjobs = list(Job().find(query, limit=limit, offset=offset, sort=sort, fields=[
+            'title', 'status', 'created', 'updated', BATCH_INDEX_FIELD]))
+        # Only the inputs of the listed jobs are loaded
+        entries = loadBatchEntries(job, [
+            subjob[BATCH_INDEX_FIELD] for subjob in subjobs
+            if subjob.get(BATCH_INDEX_FIELD) is not None])
+        keys = job.get(BATCH_INPUT_KEYS_FIELD) or []
+        results = []
+        for subjob in subjobs:
+            subjob['inputs'] = dict(zip(keys, entries.get(subjob.get(BATCH_INDEX_FIELD), [])))
+            results.append(subjob)
+        return results
+
+    @access.user
+    @autoDescribeRoute(
+        Description('Get the progress of a batch job')
+        .notes('This has the total number of jobs in the batch, the number '
+               'that were scheduled and finished, and the number of scheduled '
+               'jobs with each status.')
+        .modelParam('id', 'The batch job', model=Job, level=AccessType.ADMIN,
+                    fields={'log': False, BATCH_INPUTS_FIELD: False,
+                            BATCH_ENTRIES_FIELD: False})
+        .errorResponse('You are not logged in.', 403)
+        .errorResponse('Only the owner of the job or an admin may see its jobs.', 403)
+    )
+    def getBatchStatus(self, job):
+        progress = job.get(BATCH_PROGRESS_FIELD) or {}
+        return {
+            'status': job['status'],
+            'total': progress.get('total'),
+            'scheduled': progress.get('scheduled', 0),
+            'completed': progress.get('completed', 0),
+            'statuses': {
+                str(status): count for status, count in batchStatusCounts(job['_id']).items()},
+        }
+
+    @access.user
+    @autoDescribeRoute(
+        Description('Get the values listed by a datalist job')
+        .notes('If the job has not finished within the wait time, its id and '
+               'status are returned instead.')
+        .modelParam('id', 'The datalist job', model=Job, level=AccessType.READ,
+                    fields={'log': False})
+        .param('wait', 'The longest time in seconds to wait for the values (at '
+               'most %d).' % DATALIST_MAX_WAIT, dataType='number', required=False,
+               default=DATALIST_DEFAULT_WAIT)
+        .produces('text/plain')
+        .errorResponse('The job is not a datalist job.')
+        .errorResponse('You are not logged in.', 403)
+        .errorResponse('Read access was denied for the job.', 403)
+    )
+    def getDatalistValues(self, job, wait):
+        if not job.get(DATALIST_KEY_FIELD):
+            raise RestException('Job %s is not a datalist job.' % job['_id'])
+        return datalistResponse(job, datalistWait(wait))
+
     @access.public
     @autoDescribeRoute(
         Description(
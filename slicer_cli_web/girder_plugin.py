@@ -15,17 +15,21 @@
 ###############################################################################
 
 import datetime
+import functools
 import json
 
 from girder import events, logger
 from girder.constants import AccessType
+from girder.models.item import Item
 from girder.plugin import GirderPlugin, getPlugin
 from girder_jobs.constants import JobStatus
 from girder_jobs.models.job import Job
 
 from . import worker_tools
+from .batch_job import BATCH_INDEX_FIELD, JOB_FINGERPRINT_FIELD, getScheduler
 from .docker_resource import DockerResource
 from .models import DockerImageItem
+from .rest_slicer_cli import resumeBatchJobs
 
 
 def _onUpload(event):
@@ -62,11 +66,18 @@ class SlicerCLIWebPlugin(GirderPlugin):
         info['apiRoot'].slicer_cli_web = resource
 
         Job().exposeFields(level=AccessType.READ, fields={'slicerCLIBindings'})
+        Job().ensureIndex([JOB_FINGERPRINT_FIELD, {'sparse': True}])
+        Job().ensureIndex(([('parentId', 1), (BATCH_INDEX_FIELD, 1)], {}))
+        # batch inputs match item names by lowerName ranges within a folder
+        Item().ensureIndex(([('folderId', 1), ('lowerName', 1)], {}))
 
         events.bind('jobs.job.update.after', resource.resourceName,
                     resource.addRestEndpoints)
+        events.bind('rest.get.describe.before', resource.resourceName,
+                    resource.describeDeferredRoutes)
         events.bind('data.process', 'slicer_cli_web', _onUpload)
 
+        staleCutoff = datetime.datetime.utcnow() - datetime.timedelta(days=7)
         count = 0
         for job in Job().find({
             'status': {'$in': [
@@ -75,7 +86,7 @@ class SlicerCLIWebPlugin(GirderPlugin):
                 # existence
                 820, 821, 822, 823, 824,
             ]},
-            'updated': {'$lt': datetime.datetime.utcnow() - datetime.timedelta(days=7)}
+            'updated': {'$lt': staleCutoff}
         }, force=True):
             try:
                 Job().updateJob(job, log='Canceled stale job.', status=JobStatus.CANCELED)
@@ -84,4 +95,13 @@ class SlicerCLIWebPlugin(GirderPlugin):
                 pass
         if count:
             logger.info('Marking %d old job(s) as cancelled' % count)
+
+        # Stale batch jobs were canceled above; resume the rest.  Batches
+        # whose scheduler was still recording heartbeats are resumed later if
+        # the heartbeats stop.
+        count = resumeBatchJobs(updatedAfter=staleCutoff)
+        if count:
+            logger.info('Resumed %d batch job(s)' % count)
+        getScheduler().resume = functools.partial(resumeBatchJobs, updatedAfter=staleCutoff)
+
         worker_tools.start()
@@ -16,7 +16,13 @@
 #  limitations under the License.
 ###############################################################################
 
+import concurrent.futures
+import contextlib
+import io
 import json
+import os
+import tarfile
+import threading
 import time
 
 import docker
@@ -27,8 +33,16 @@ from girder.models.user import User
 from girder_jobs.constants import JobStatus
 from girder_jobs.models.job import Job
 
+from .config import PluginSettings
 from .models import DockerImageError, DockerImageItem, DockerImageNotFoundError
 
+# Containers used to run several commands are removed when they are done, but
+# stop on their own after this many seconds in case that fails.
+COMMAND_CONTAINER_LIFETIME = 3600
+# When reading specs from image files, the list of CLIs is read from the first
+# of these files that is in the image's working directory.
+CLI_LIST_FILES = ('slicer_cli_list.json', 'cli_list.json')
+
 
 def deleteImage(job):
     """
@@ -160,7 +174,8 @@ def jobPullAndLoad(job):
 
         try:
             stage = 'pulling'
-            pullDockerImage(docker_client, pullList, job)
+            pullDockerImage(
+                docker_client, pullList, job, job['kwargs'].get('pullConcurrency'))
         except DockerImageNotFoundError as err:
             errorState = True
             notExistSet = set(err.imageName)
@@ -170,8 +185,28 @@ def jobPullAndLoad(job):
                     notExistSet) + '\n',
             )
         stage = 'metadata'
-        images, loadingError = loadMetadata(job, docker_client, pullList,
-                                            loadList, notExistSet)
+        # Images that match what was saved before don't need their CLIs
+        # extracted or saved again unless this is forced.  If an image can't
+        # be checked, it is treated as changed.
+        unchanged = set()
+        force = str(job['kwargs'].get('force')).lower() == 'true'
+        for name in pullList + loadList:
+            if name in notExistSet or force:
+                continue
+            try:
+                if DockerImageItem.findUnchanged(
+                        name, docker_client.images.get(name), user, baseFolder):
+                    unchanged.add(name)
+            except Exception:
+                logger.exception('Could not check if %s is unchanged', name)
+        if unchanged:
+            job = Job().updateJob(
+                job,
+                log='Skipping unchanged images\n' + '\n'.join(sorted(unchanged)) + '\n',
+            )
+        images, loadingError = loadMetadata(
+            job, docker_client, [name for name in pullList if name not in unchanged],
+            [name for name in loadList if name not in unchanged], notExistSet)
         for name, cli_dict in images:
             docker_image = docker_client.images.get(name)
             stage = 'parsing'
@@ -294,46 +329,260 @@ def getDockerOutput(imgName, command, client):
     return logs
 
 
-def getCliData(name, client, job):
+def startCommandContainer(imgName, client):
+    """
+    Start a container of a docker image that idles so that the image's
+    entrypoint can be run repeatedly in it with exec_run.
+
+    :param imgName: The name of the docker image
+    :param client: The docker python client
+    :returns: the running container and the image's entrypoint, or None if
+        the image has no entrypoint or the container could not be started.
+    """
+    cont = None
+    try:
+        image = client.images.get(imgName)
+        entrypoint = (image.attrs.get('Config') or {}).get('Entrypoint')
+        if not entrypoint:
+            return None
+        if isinstance(entrypoint, str):
+            entrypoint = [entrypoint]
+        cont = client.containers.create(
+            image=imgName, entrypoint=['sleep'], command=[str(COMMAND_CONTAINER_LIFETIME)])
+        cont.start()
+        cont.reload()
+        if cont.status != 'running':
+            raise DockerImageError('The command container exited', imgName)
+        return cont, list(entrypoint)
+    except Exception:
+        logger.info('Could not start a command container for %s', imgName)
+        if cont:
+            try:
+                cont.remove(force=True)
+            except Exception:
+                pass
+        return None
+
+
+def getExecOutput(imgName, cont, entrypoint, command):
+    """
+    Run the entrypoint of an image in a container started with
+    startCommandContainer and collect the output to standard output.
+
+    :param imgName: The name of the docker image
+    :param cont: The running container
+    :param entrypoint: The image's entrypoint as a list
+    :param command: The arguments to be passed to the entrypoint
+    """
+    command = [command] if isinstance(command, str) else list(command)
+    try:
+        ret_code, logs = cont.exec_run(entrypoint + command, stdout=True, stderr=False)
+    except Exception as err:
+        logger.exception('Attempt to docker exec %s %s failed', imgName, command)
+        raise DockerImageError(
+            'Attempt to docker exec %s %s failed ' % (imgName, command) + str(err), imgName)
+    if ret_code != 0:
+        raise DockerImageError(
+            'Attempt to docker exec %s %s failed' % (imgName, command), imgName)
+    return logs
+
+
+@contextlib.contextmanager
+def imageCommandRunner(imgName, client):
+    """
+    Provide a function that runs the entrypoint of a docker image with some
+    arguments and returns its standard output.  When possible, all commands
+    are run in a single container, which is started when the first command is
+    run; otherwise each command is run in a new container.
+
+    :param imgName: The name of the docker image
+    :param client: The docker python client
+    """
+    state = {}
+
+    def runCommand(command):
+        if 'started' not in state:
+            state['started'] = startCommandContainer(imgName, client)
+        if not state['started']:
+            return getDockerOutput(imgName, command, client)
+        cont, entrypoint = state['started']
+        return getExecOutput(imgName, cont, entrypoint, command)
+
     try:
-        cli_dict = getDockerOutput(name, '--list_cli', client)
-        # contains nested dict
-        # {<cliname>:{type:<type>}}
+        yield runCommand
+    finally:
+        if state.get('started'):
+            try:
+                state['started'][0].remove(force=True)
+            except Exception:
+                logger.exception('Failed to remove the command container for %s', imgName)
+
+
+def readArchiveFile(cont, path):
+    """
+    Read a regular file from a container with get_archive.
+
+    :param cont: The container
+    :param path: The absolute path of the file
+    :returns: the contents of the file or None if it isn't a regular file.
+    """
+    try:
+        stream, _ = cont.get_archive(path)
+        with tarfile.open(fileobj=io.BytesIO(b''.join(stream))) as archive:
+            member = archive.next()
+            if member is None or not member.isfile():
+                return None
+            return archive.extractfile(member).read()
+    except docker.errors.NotFound:
+        return None
+
+
+@contextlib.contextmanager
+def imageFileReader(imgName, client):
+    """
+    Provide a function that reads a file from a docker image without running
+    the image.  Files are copied from a container that is created but never
+    started.  Relative paths are relative to the image's working directory.
+
+    :param imgName: The name of the docker image
+    :param client: The docker python client
+    """
+    cont = None
+    try:
+        image = client.images.get(imgName)
+        workdir = (image.attrs.get('Config') or {}).get('WorkingDir') or '/'
+        cont = client.containers.create(image=imgName, entrypoint=['true'], command=[])
+    except Exception:
+        logger.info('Could not create a container to read files from %s', imgName)
+
+    def readFile(path):
+        if not cont:
+            return None
         try:
-            if isinstance(cli_dict, bytes):
-                cli_dict = cli_dict.decode('utf8')
-            cli_dict = json.loads(cli_dict)
+            return readArchiveFile(cont, os.path.join(workdir, path))
         except Exception:
-            job = Job().updateJob(
-                job,
-                log='Failed to parse cli list.  Output of list_cli was\n%r\n' % cli_dict)
-            raise
-        for key, info in cli_dict.items():
-            desc_type = info.get('desc-type', 'xml')
-            cli_desc = getDockerOutput(name, [key, f'--{desc_type}'], client)
-
-            if isinstance(cli_desc, bytes):
-                cli_desc = cli_desc.decode('utf8')
-
-            # For --xml, strip text before the first < and after the last >
-            if desc_type == 'xml':
-                cli_desc = '<' + cli_desc.split('<', 1)[1].rsplit('>', 1)[0] + '>'
-            # For --json, strip text before the first { and after the last }
-            elif desc_type == 'json':
-                cli_desc = '{' + cli_desc.split('{', 1)[1].rsplit('}', 1)[0] + '}'
-
-            cli_dict[key][desc_type] = cli_desc
-            job = Job().updateJob(
-                job,
-                log='Got image %s, cli %s metadata\n' % (name, key),
-            )
+            logger.info('Could not read %s from %s', path, imgName)
+            return None
+
+    try:
+        yield readFile
+    finally:
+        if cont:
+            try:
+                cont.remove(force=True)
+            except Exception:
+                logger.exception('Failed to remove the file container for %s', imgName)
+
+
+def readCliListFile(name, job, readFile):
+    """
+    Read the list of CLIs of an image from slicer_cli_list.json or
+    cli_list.json in its working directory.
+
+    :param name: The name of the docker image
+    :param job: The job to log to
+    :param readFile: a function from imageFileReader
+    :returns: the contents of the cli list file or None if there isn't one.
+    """
+    for path in CLI_LIST_FILES:
+        cli_list = readFile(path)
+        if cli_list is not None:
+            Job().updateJob(job, log='Read the cli list of image %s from %s\n' % (name, path))
+            return cli_list
+    return None
+
+
+def getCliData(name, client, job):
+    try:
+        fromFiles = PluginSettings.get_spec_extraction() == 'files'
+        with imageFileReader(name, client) if fromFiles else contextlib.nullcontext(
+                lambda path: None) as readFile, imageCommandRunner(name, client) as runCommand:
+            cli_dict = readCliListFile(name, job, readFile)
+            # Spec files are only looked for if the image has a cli list file
+            fromFiles = cli_dict is not None
+            if not fromFiles:
+                cli_dict = runCommand('--list_cli')
+            # contains nested dict
+            # {<cliname>:{type:<type>}}
+            try:
+                if isinstance(cli_dict, bytes):
+                    cli_dict = cli_dict.decode('utf8')
+                cli_dict = json.loads(cli_dict)
+            except Exception:
+                job = Job().updateJob(
+                    job,
+                    log='Failed to parse cli list.  Output of list_cli was\n%r\n' % cli_dict)
+                raise
+            for key, info in cli_dict.items():
+                desc_type = info.get('desc-type', 'xml')
+                # CLIs are in <cli>/<cli>.py and have their spec next to them
+                cli_path = os.path.normpath(info.get('alias', key))
+                cli_desc = readFile(os.path.join(
+                    cli_path, '%s.%s' % (os.path.basename(cli_path), desc_type))) \
+                    if fromFiles else None
+                if cli_desc is None:
+                    cli_desc = runCommand([key, f'--{desc_type}'])
+
+                if isinstance(cli_desc, bytes):
+                    cli_desc = cli_desc.decode('utf8')
+
+                # For --xml, strip text before the first < and after the last >
+                if desc_type == 'xml':
+                    cli_desc = '<' + cli_desc.split('<', 1)[1].rsplit('>', 1)[0] + '>'
+                # For --json, strip text before the first { and after the last }
+                elif desc_type == 'json':
+                    cli_desc = '{' + cli_desc.split('{', 1)[1].rsplit('}', 1)[0] + '}'
+
+                cli_dict[key][desc_type] = cli_desc
+                job = Job().updateJob(
+                    job,
+                    log='Got image %s, cli %s metadata\n' % (name, key),
+                )
         return cli_dict
     except Exception as err:
         logger.exception('Error getting %s cli data from image', name)
         raise DockerImageError('Error getting %s cli data from image ' % (name) + str(err))
 
 
-def pullDockerImage(client, names, job=None):
+def _pullProgressMessage(names, stats):
+    """
+    Describe the progress of one or more concurrent image pulls.
+
+    :param names: the names of the images that are being pulled.
+    :param stats: a dictionary of the most recent progress record of each
+        layer, keyed by layer id.
+    :returns: a message or None if the total size isn't known yet.
+    """
+    total = sum(record['total'] for record in stats.values())
+    if not total:
+        return None
+    downloaded = sum(
+        record['total'] for record in stats.values()
+        if record['status'] != 'Downloading')
+    downloaded += sum(
+        record['current'] for record in stats.values()
+        if record['status'] == 'Downloading')
+    extracted = sum(
+        record['total'] for record in stats.values()
+        if record['status'] == 'Pull complete')
+    extracted += sum(
+        record['current'] for record in stats.values()
+        if record['status'] == 'Extracting')
+    if len(names) == 1:
+        msg = f'Pulling {names[0]} image: '
+    else:
+        msg = f'Pulling {len(names)} images ({", ".join(names)}): '
+    if downloaded < total:
+        val = downloaded
+        msg += 'downloaded '
+    else:
+        val = extracted
+        msg += 'extracted '
+    msg += f'{val}/{total} ({val * 100 / total:4.2f}%)'
+    return msg
+
+
+def pullDockerImage(client, names, job=None, concurrency=None):
     """
     Attempt to pull the docker images listed in names. Failure results in a
     DockerImageNotFoundError being raised
@@ -341,46 +590,39 @@ def pullDockerImage(client, names, job=None):
     :param client: The docker python client
     :param names: A list of docker images to be pulled from the Dockerhub
     :param job: A job to update with status.
+    :param concurrency: The maximum number of images to pull at once.  If
+        None, the slicer_cli_web.pull_concurrency setting is used.
     """
-    imgNotExistList = []
-    for name in names:
+    if concurrency is None:
+        concurrency = PluginSettings.get_pull_concurrency()
+    # Progress is shared by all pulls.  Layers are keyed by id, so a layer
+    # that is used by several images is only counted once.
+    lock = threading.Lock()
+    progress = {'job': job, 'lastlog': time.time(), 'pulling': [], 'stats': {}}
+
+    def logProgress(line):
+        line.update(line.get('progressDetail', {}))
+        if 'id' not in line or ('total' not in line and line['id'] not in progress['stats']):
+            return
+        with lock:
+            progress['stats'].setdefault(line['id'], line).update(line)
+            if time.time() - progress['lastlog'] < 10:
+                return
+            msg = _pullProgressMessage(progress['pulling'], progress['stats'])
+            if msg:
+                logger.info(msg)
+                if progress['job']:
+                    progress['job'] = Job().updateJob(progress['job'], log=msg + '\n')
+            progress['lastlog'] = time.time()
+
+    def pull(name):
+        with lock:
+            progress['pulling'].append(name)
         try:
             logger.info('Pulling %s image', name)
-            lastlog = time.time()
-            stats = {}
             for line in client.api.pull(name, stream=True, decode=True):
                 try:
-                    line.update(line.get('progressDetail', {}))
-                    if 'id' not in line or ('total' not in line and line['id'] not in stats):
-                        continue
-                    stats.setdefault(line['id'], line).update(line)
-                    if time.time() - lastlog >= 10:
-                        total = sum(record['total'] for record in stats.values())
-                        downloaded = sum(
-                            record['total'] for record in stats.values()
-                            if record['status'] != 'Downloading')
-                        downloaded += sum(
-                            record['current'] for record in stats.values()
-                            if record['status'] == 'Downloading')
-                        extracted = sum(
-                            record['total'] for record in stats.values()
-                            if record['status'] == 'Pull complete')
-                        extracted += sum(
-                            record['current'] for record in stats.values()
-                            if record['status'] == 'Extracting')
-                        if total:
-                            msg = f'Pulling {name} image: '
-                            if downloaded < total:
-                                val = downloaded
-                                msg += 'downloaded '
-                            else:
-                                val = extracted
-                                msg += 'extracted '
-                            msg += f'{val}/{total} ({val * 100 / total:4.2f}%)'
-                            logger.info(msg)
-                            if job:
-                                job = Job().updateJob(job, log=msg + '\n')
-                        lastlog = time.time()
+                    logProgress(line)
                 except Exception:
                     # Don't fail if the log code has an issue
                     pass
@@ -389,7 +631,18 @@ def pullDockerImage(client, names, job=None):
             # succeeded is to attempt a docker inspect on the image
             client.images.get(name)
         except Exception:
-            imgNotExistList.append(name)
+            return False
+        finally:
+            with lock:
+                progress['pulling'].remove(name)
+        return True
+
+    if not names:
+        return
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, min(concurrency or 1, len(names)))) as pool:
+        pulled = list(pool.map(pull, names))
+    imgNotExistList = [name for name, success in zip(names, pulled) if not success]
     if len(imgNotExistList) != 0:
         raise DockerImageNotFoundError('Could not find multiple images ',
                                        image_name=imgNotExistList)
@@ -32,6 +32,61 @@ def _split(name):
     return name.rsplit('@', 1)
 
 
+def imageItemName(name):
+    """
+    Get the image name as it is recorded in the metadata of CLI items.  This
+    is the image folder and tag folder names joined by a colon.
+
+    :param name: image name (user/repo:tag or user/repo@digest).
+    :returns: the image name used by CLI items.
+    """
+    parts = _split(name)
+    if len(parts) != 2:
+        return name
+    return '%s:%s' % tuple(parts)
+
+
+def subfolderIds(baseFolder, user=None):
+    """
+    Get the ids of a folder and all of its descendant folders.
+
+    :param baseFolder: the folder model at the root of the tree.
+    :param user: if specified, only include folders this user can read.
+        Folders within folders the user can't read are also excluded.
+    :returns: a list of folder ids, starting with the base folder.
+    """
+    folderModel = Folder()
+    graphLookup = {
+        'from': 'folder',
+        'startWith': '$_id',
+        'connectFromField': '_id',
+        'connectToField': 'parentId',
+        'as': 'children'
+    }
+
+    if user and not user['admin']:
+        graphLookup['restrictSearchWithMatch'] = folderModel.permissionClauses(user,
+                                                                               AccessType.READ)
+
+    # see https://docs.mongodb.com/manual/reference/operator/aggregation/graphLookup
+    r = folderModel.collection.aggregate([
+        {
+            '$match': dict(_id=baseFolder['_id'])
+        },
+        {
+            '$graphLookup': graphLookup
+        },
+        {
+            '$project': {
+                'leaves': '$children._id',
+            }
+        }
+    ])
+
+    leaves = next(r)['leaves']
+    return [baseFolder['_id']] + leaves
+
+
 class CLIItem:
     def __init__(self, item):
         self.item = item
@@ -74,43 +129,26 @@ class CLIItem:
 
         return [CLIItem(item) for item in items]
 
+    @staticmethod
+    def findImageItems(names, user=None):
+        """
+        Find the CLI items of a list of docker images.
+
+        :param names: a list of docker image names (user/repo:tag or
+            user/repo@digest).
+        :param user: if specified, only return items this user can read.
+        :returns: a list of CLIItems.
+        """
+        images = [imageItemName(name) for name in names]
+        return CLIItem._findAllItemImpl(user, {'meta.image': {'$in': images}})
+
     @staticmethod
     def findAllItems(user=None, baseFolder=None):
         if not baseFolder:
             return CLIItem._findAllItemImpl(user)
 
-        folderModel = Folder()
-        graphLookup = {
-            'from': 'folder',
-            'startWith': '$_id',
-            'connectFromField': '_id',
-            'connectToField': 'parentId',
-            'as': 'children'
-        }
-
-        if user and not user['admin']:
-            graphLookup['restrictSearchWithMatch'] = folderModel.permissionClauses(user,
-                                                                                   AccessType.READ)
-
-        # see https://docs.mongodb.com/manual/reference/operator/aggregation/graphLookup
-        r = folderModel.collection.aggregate([
-            {
-                '$match': dict(_id=baseFolder['_id'])
-            },
-            {
-                '$graphLookup': graphLookup
-            },
-            {
-                '$project': {
-                    'leaves': '$children._id',
-                }
-            }
-        ])
-
-        leaves = next(r)['leaves']
-
         return CLIItem._findAllItemImpl(user, {
-            'folderId': {'$in': [baseFolder['_id']] + leaves}
+            'folderId': {'$in': subfolderIds(baseFolder, user)}
         })
 
 
@@ -240,6 +278,7 @@ class DockerImageItem:
             digest = docker_image.attrs['RepoDigests'][0]
 
         labels['digest'] = digest
+        labels['imageId'] = docker_image.id
         folderModel.setMetadata(tag, labels)
 
         folderModel.setMetadata(tag, dict(slicerCLIType='tag'))
@@ -284,6 +323,42 @@ class DockerImageItem:
         for item in existingItems.values():
             itemModel.remove(item)
 
+    @staticmethod
+    def findUnchanged(name, docker_image, user, baseFolder):
+        """
+        Find the tag folder of an image if it was saved from the same docker
+        image, in which case its CLIs don't need to be extracted again.  The
+        image ids are compared; tag folders saved before image ids were
+        recorded are compared by repo digest.
+
+        :param name: image name (user/repo:tag or user/repo@digest).
+        :param docker_image: the docker image object.
+        :param user: the user saving the image.
+        :param baseFolder: the folder that contains the image folders.
+        :returns: a DockerImageItem or None if the image has changed or was
+            never saved.
+        """
+        folderModel = Folder()
+        imageName, tagName = _split(name)
+        image = folderModel.findOne({
+            'parentId': baseFolder['_id'], 'name': imageName, 'meta.slicerCLIType': 'image'})
+        if not image:
+            return None
+        tag = folderModel.findOne({
+            'parentId': image['_id'], 'name': tagName, 'meta.slicerCLIType': 'tag'})
+        if not tag:
+            return None
+        meta = tag['meta']
+        if meta.get('imageId'):
+            unchanged = meta['imageId'] == docker_image.id
+        else:
+            unchanged = bool(meta.get('digest')) and meta['digest'] in (
+                docker_image.attrs.get('RepoDigests') or [])
+        if not unchanged or not Item().findOne(
+                {'folderId': tag['_id'], 'meta.slicerCLIType': 'task'}, fields=['_id']):
+            return None
+        return DockerImageItem(image, tag, user)
+
     @staticmethod
     def saveImage(name, cli_dict, docker_image, user, baseFolder):
         """
@@ -2,10 +2,11 @@ import json
 from os.path import dirname, join
 
 import yaml
+from girder import logger
 from girder.models.file import File
 from jsonschema import validate
 
-from ..cli_utils import as_model
+from ..cli_utils import as_model, build_parameter_plan
 from .json_to_xml import json_to_xml
 
 with open(join(dirname(__file__), 'schema.json')) as f:
@@ -20,6 +21,12 @@ def _parse_xml_desc(item, user, xml):
     # parse and inject advanced meta data and description
     clim = as_model(xml)
     item['description'] = '**%s**\n\n%s' % (clim.title, clim.description)
+    try:
+        meta_data['parameterPlan'] = build_parameter_plan(xml)
+    except Exception:
+        # Unsupported parameters are reported when the endpoints are
+        # generated; without a plan, handlers are built from the xml.
+        logger.warning('Could not build a parameter plan for %s', item['name'])
 
     if clim.category:
         meta_data['category'] = clim.category
@@ -1,7 +1,10 @@
+import collections
 import json
 import os
+import threading
 
 import jinja2
+from bson.objectid import ObjectId
 from girder import logger
 from girder.api.rest import RestException
 from girder.constants import AccessType
@@ -11,11 +14,20 @@ from girder.models.folder import Folder
 from girder.models.setting import Setting
 from girder.utility.model_importer import ModelImporter
 
-from .cli_utils import (SLICER_TYPE_TO_GIRDER_MODEL_MAP, is_girder_api, is_on_girder,
+from .cli_utils import (SLICER_TYPE_TO_GIRDER_MODEL_MAP, LRUCache, is_girder_api, is_on_girder,
                         return_parameter_file_name)
 
 OPENAPI_DIRECT_TYPES = {'boolean', 'integer', 'float', 'double', 'string'}
 FOLDER_SUFFIX = '_folder'
+ENVIRONMENT_PREFIX = 'SLICER_CLI_WEB_'
+
+# Batch jobs render the same few templates for every job, so compiled
+# templates are shared.
+_templateEnvironment = jinja2.Environment()
+_templateCache = LRUCache(256)
+
+_environmentTemplateParams = None
+_environmentLock = threading.Lock()
 
 
 def _to_file_volume(param, model):
@@ -56,17 +68,80 @@ def _to_girder_api(param, value):
     return value
 
 
-def _parseParamValue(param, value, user, token):
+def _loadGirderModels(params, user, index_params, opt_params, has_simple_return_file):
+    """
+    Load the Girder documents referenced by the cli inputs and output folders
+    with one query per model type.
+
+    :param params: a dictionary of arguments for the cli.
+    :param user: the authenticating user.
+    :param index_params: a list of cli parameters.
+    :param opt_params: a list of cli parameters.
+    :param has_simple_return_file: True if the cli has a return parameter
+        file.
+    :returns: a dictionary of the documents the user can read, keyed by
+        (girder model name, id string).  Values that are not valid ids or
+        that the user cannot read are omitted so that loading them later
+        reports the usual error.
+    """
+    ids = collections.defaultdict(set)
+    for param in index_params + opt_params:
+        param_id = param.identifier()
+        if param.channel == 'output':
+            if param.isExternalType() and param_id + FOLDER_SUFFIX in params:
+                ids['folder'].add(params[param_id + FOLDER_SUFFIX])
+        elif is_on_girder(param) and param_id in params:
+            ids[SLICER_TYPE_TO_GIRDER_MODEL_MAP[param.typ]].add(params[param_id])
+    if has_simple_return_file and return_parameter_file_name + FOLDER_SUFFIX in params:
+        ids['folder'].add(params[return_parameter_file_name + FOLDER_SUFFIX])
+
+    models = {}
+    for girder_type, values in ids.items():
+        values = [value.decode('utf8') if isinstance(value, bytes) else value
+                  for value in values]
+        objectIds = [ObjectId(value) for value in values if ObjectId.is_valid(value)]
+        if not objectIds:
+            continue
+        curModel = ModelImporter.model(girder_type)
+        cursor = curModel.find({'_id': {'$in': objectIds}})
+        for doc in curModel.filterResultsByPermission(cursor, user, AccessType.READ):
+            models[(girder_type, str(doc['_id']))] = doc
+    return models
+
+
+def _loadOutputFolder(folder, user, models=None):
+    """
+    Get an output folder that the user can write to.
+
+    :param folder: the folder id.
+    :param user: the authenticating user.
+    :param models: a dictionary of preloaded documents from _loadGirderModels.
+    :returns: the folder document.
+    """
+    instance = (models or {}).get(('folder', str(folder)))
+    if instance is None or not Folder().hasAccess(instance, user, AccessType.WRITE):
+        instance = Folder().load(folder, level=AccessType.WRITE, user=user)
+    if not instance:
+        raise RestException('Invalid Folder id (%s).' % (str(folder)))
+    return instance
+
+
+def _parseParamValue(param, value, user, token, models=None):
     if isinstance(value, bytes):
         value = value.decode('utf8')
 
     param_id = param.identifier()
     if is_on_girder(param):
         girder_type = SLICER_TYPE_TO_GIRDER_MODEL_MAP[param.typ]
+        key = (girder_type, str(value))
+        if models is not None and key in models:
+            return models[key]
         curModel = ModelImporter.model(girder_type)
         loaded = curModel.load(value, level=AccessType.READ, user=user)
         if not loaded:
             raise RestException('Invalid %s id (%s).' % (curModel.name, str(value)))
+        if models is not None:
+            models[key] = loaded
         return loaded
 
     try:
@@ -111,7 +186,8 @@ def _processTemplates(value, param=None, templateParams=None):
     """
     if value == '__default__' and param:
         value = param.default
-    if not templateParams:
+    # Every jinja2 tag starts with a brace
+    if not templateParams or '{' not in str(value):
         return value
     if param:
         templateParams = templateParams.copy()
@@ -126,7 +202,7 @@ def _processTemplates(value, param=None, templateParams=None):
             templateParams['reference'] = templateParams[key]
             templateParams['reference_base'] = templateParams[f'{key}_base']
     try:
-        newvalue = jinja2.Template(str(value)).render(templateParams)
+        newvalue = _getTemplate(str(value)).render(templateParams)
         if newvalue != str(value):
             logger.info('Replaced templated parameter %s with %s.', value, newvalue)
             return newvalue
@@ -135,10 +211,23 @@ def _processTemplates(value, param=None, templateParams=None):
     return value
 
 
-def _add_optional_input_param(param, args, user, token, templateParams):
+def _getTemplate(source):
+    """
+    Get a compiled jinja2 template, compiling it if it is not cached.
+
+    :param source: the template string.
+    :returns: a jinja2 Template.
+    """
+    template = _templateCache.get(source)
+    if template is None:
+        template = _templateCache.set(source, _templateEnvironment.from_string(source))
+    return template
+
+
+def _add_optional_input_param(param, args, user, token, templateParams, models=None):
     if param.identifier() not in args:
         return []
-    value = _parseParamValue(param, args[param.identifier()], user, token)
+    value = _parseParamValue(param, args[param.identifier()], user, token, models)
 
     container_args = []
     if param.longflag:
@@ -160,7 +249,8 @@ def _add_optional_input_param(param, args, user, token, templateParams):
     return container_args
 
 
-def _add_optional_output_param(param, args, user, result_hooks, reference, templateParams):
+def _add_optional_output_param(param, args, user, result_hooks, reference, templateParams,
+                               models=None):
     from girder_worker.docker.transforms import VolumePath
     from girder_worker.docker.transforms.girder import GirderUploadVolumePathToFolder
 
@@ -179,9 +269,7 @@ def _add_optional_output_param(param, args, user, result_hooks, reference, templ
     else:
         return []
 
-    instance = Folder().load(folder, level=AccessType.WRITE, user=user)
-    if not instance:
-        raise RestException('Invalid Folder id (%s).' % (str(folder)))
+    _loadOutputFolder(folder, user, models)
 
     # Output Binding !!
     path = VolumePath(value)
@@ -195,8 +283,8 @@ def _add_optional_output_param(param, args, user, result_hooks, reference, templ
     return container_args
 
 
-def _add_indexed_input_param(param, args, user, token, templateParams=None):
-    value = _parseParamValue(param, args[param.identifier()], user, token)
+def _add_indexed_input_param(param, args, user, token, templateParams=None, models=None):
+    value = _parseParamValue(param, args[param.identifier()], user, token, models)
 
     if is_on_girder(param):
         # Bindings
@@ -207,7 +295,8 @@ def _add_indexed_input_param(param, args, user, token, templateParams=None):
     return value, None
 
 
-def _add_indexed_output_param(param, args, user, result_hooks, reference, templateParams):
+def _add_indexed_output_param(param, args, user, result_hooks, reference, templateParams,
+                              models=None):
     from girder_worker.docker.transforms import VolumePath
     from girder_worker.docker.transforms.girder import GirderUploadVolumePathToFolder
 
@@ -217,9 +306,7 @@ def _add_indexed_output_param(param, args, user, result_hooks, reference, templa
         return value
     folder = args[param.identifier() + FOLDER_SUFFIX]
 
-    instance = Folder().load(folder, level=AccessType.WRITE, user=user)
-    if not instance:
-        raise RestException('Invalid Folder id (%s).' % (str(folder)))
+    _loadOutputFolder(folder, user, models)
 
     # Output Binding
     path = VolumePath(value)
@@ -230,7 +317,8 @@ def _add_indexed_output_param(param, args, user, result_hooks, reference, templa
     return path
 
 
-def _populateTemplateParams(params, user, token, index_params, opt_params, templateParams=None):
+def _populateTemplateParams(params, user, token, index_params, opt_params, templateParams=None,
+                            models=None):
     """
     Collect values and keys for processing templates.
 
@@ -241,6 +329,8 @@ def _populateTemplateParams(params, user, token, index_params, opt_params, templ
     :param opt_params: a list of cli parameters.
     :param templateParams: a dictionary of keys and values to always include in
         the template values, such as 'now', 'task', and 'title'.
+    :param models: a dictionary of preloaded documents from _loadGirderModels.
+        Documents that are loaded are added to it.
     :returns: the collected templateParams.  This will be the supplied template
         parameters plus 'parameter_<name>' and 'parameter_<name>_base' for the
         cli arguments.
@@ -249,7 +339,8 @@ def _populateTemplateParams(params, user, token, index_params, opt_params, templ
     for param in index_params + opt_params:
         if param.identifier() in params:
             try:
-                value = _parseParamValue(param, params[param.identifier()], user, token)
+                value = _parseParamValue(
+                    param, params[param.identifier()], user, token, models)
             except Exception:
                 continue
             value = value.get('name') if isinstance(value, dict) else value
@@ -263,20 +354,37 @@ def _addEnvironmentToTemplateParams(templateParams=None):
     """
     Add the local environment to the template parameters.  Only environment
     variables that start with SLICER_CLI_WEB_ are added, as to do otherwise
-    could expose private data.
+    could expose private data.  The environment is read once; call
+    _resetEnvironmentTemplateParams to pick up later changes.
 
     :param templateParams: a dictionary of keys and values to always include in
         the template values, such as 'now', 'task', and 'title'.
     :returns: the adjusted templateParams.
     """
+    global _environmentTemplateParams
+
     templateParams = templateParams.copy() if templateParams else {}
-    for key in os.environ:
-        parts = key.split('SLICER_CLI_WEB_', 1)
-        if len(parts) == 2:
-            templateParams[f'env_{parts[1]}'] = os.environ[key]
+    if _environmentTemplateParams is None:
+        with _environmentLock:
+            if _environmentTemplateParams is None:
+                _environmentTemplateParams = {
+                    f'env_{key.split(ENVIRONMENT_PREFIX, 1)[1]}': value
+                    for key, value in os.environ.items() if ENVIRONMENT_PREFIX in key}
+    templateParams.update(_environmentTemplateParams)
     return templateParams
 
 
+def _resetEnvironmentTemplateParams():
+    """
+    Discard the snapshot of the environment used for template parameters so
+    that it is read again on next use.
+    """
+    global _environmentTemplateParams
+
+    with _environmentLock:
+        _environmentTemplateParams = None
+
+
 def prepare_task(params, user, token, index_params, opt_params,
                  has_simple_return_file, reference, templateParams=None):
     import uuid
@@ -289,33 +397,36 @@ def prepare_task(params, user, token, index_params, opt_params,
     result_hooks = []
     primary_input_name = None
 
+    # Every Girder document the cli references is loaded once for the request
+    models = _loadGirderModels(params, user, index_params, opt_params, has_simple_return_file)
     templateParams = _addEnvironmentToTemplateParams(templateParams)
     templateParams = _populateTemplateParams(
-        params, user, token, index_params, opt_params, templateParams)
+        params, user, token, index_params, opt_params, templateParams, models)
 
     # Get primary name and reference
     for param in index_params:
-        if param.channel != 'output':
-            arg, name = _add_indexed_input_param(param, params, user, token)
-            if (name and not primary_input_name and
-                    SLICER_TYPE_TO_GIRDER_MODEL_MAP[param.typ] != 'folder'):
-                primary_input_name = name
+        if (param.channel != 'output' and is_on_girder(param) and
+                SLICER_TYPE_TO_GIRDER_MODEL_MAP[param.typ] != 'folder'):
+            value = _parseParamValue(param, params[param.identifier()], user, token, models)
+            if value['name']:
+                primary_input_name = value['name']
                 reference['userId'] = str(user['_id'])
-                value = _parseParamValue(param, params[param.identifier()], user, token)
                 itemId = value['_id']
                 if SLICER_TYPE_TO_GIRDER_MODEL_MAP[param.typ] == 'file':
                     reference['fileId'] = str(value['_id'])
                     itemId = value['itemId']
                 reference['itemId'] = str(itemId)
                 reference['uuid'] = uuidVal
+                break
 
     # optional params
     for param in opt_params:
         if param.channel == 'output':
             ca.extend(_add_optional_output_param(
-                param, params, user, result_hooks, reference, templateParams))
+                param, params, user, result_hooks, reference, templateParams, models))
         else:
-            ca.extend(_add_optional_input_param(param, params, user, token, templateParams))
+            ca.extend(_add_optional_input_param(
+                param, params, user, token, templateParams, models))
 
     if has_simple_return_file:
         param_id = return_parameter_file_name + FOLDER_SUFFIX
@@ -325,9 +436,7 @@ def prepare_task(params, user, token, index_params, opt_params,
             value = _processTemplates(value, templateParams=templateParams)
             folder = params[return_parameter_file_name + FOLDER_SUFFIX]
 
-            instance = Folder().load(folder, level=AccessType.WRITE, user=user)
-            if not instance:
-                raise RestException('Invalid Folder id (%s).' % (str(folder)))
+            _loadOutputFolder(folder, user, models)
 
             ca.append('--returnparameterfile')
 
@@ -343,9 +452,10 @@ def prepare_task(params, user, token, index_params, opt_params,
     for param in index_params:
         if param.channel == 'output':
             ca.append(_add_indexed_output_param(
-                param, params, user, result_hooks, reference, templateParams))
+                param, params, user, result_hooks, reference, templateParams, models))
         else:
-            arg, name = _add_indexed_input_param(param, params, user, token, templateParams)
+            arg, name = _add_indexed_input_param(
+                param, params, user, token, templateParams, models)
             ca.append(arg)
             if name and not primary_input_name:
                 primary_input_name = name
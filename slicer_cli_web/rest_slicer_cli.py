@@ -1,30 +1,49 @@
 import copy
+import datetime
+import functools
+import hashlib
 import itertools
 import json
-import threading
 import time
 
 import cherrypy
-import pymongo
-from bson.objectid import ObjectId
 from girder import logger
 from girder.api import access
 from girder.api.describe import Description, describeRoute
 from girder.api.rest import Resource, RestException, boundHandler, getApiUrl, getCurrentToken
-from girder.constants import AccessType, SortDir
+from girder.constants import AccessType
 from girder.models.item import Item
 from girder.models.setting import Setting
 from girder.models.token import Token
 from girder.models.user import User
-from girder.utility.progress import setResponseTimeLimit
-from girder_jobs.constants import JobStatus
+from girder_jobs.constants import JOB_HANDLER_LOCAL, JobStatus
 from girder_jobs.models.job import Job
 
-from .cli_utils import (as_model, generate_description, get_cli_parameters, is_on_girder,
+from .batch_job import (BATCH_CONCURRENCY_PARAM, BATCH_HEARTBEAT_FIELD, BATCH_INCREMENTAL_PARAM,
+                        BATCH_MANIFEST_SUFFIX, BATCH_PROGRESS_FIELD, BATCH_RECURSIVE_PARAM,
+                        BATCH_SWEEP_MODE_PARAM, BATCH_SWEEP_PARAM, HEARTBEAT_TIMEOUT,
+                        JOB_FINGERPRINT_FIELD, SWEEP_MODES, BatchJob, batchConcurrency, batchSweep,
+                        getScheduler, validateBatchInputs)
+from .cli_utils import (LRUCache, TTLCache, can_be_batched, can_be_swept, get_parameter_table,
+                        is_girder_api, is_on_girder, normalize_param_value,
                         return_parameter_file_name)
+from .config import PluginSettings
 from .models import CLIItem
 from .prepare_task import FOLDER_SUFFIX, OPENAPI_DIRECT_TYPES, prepare_task
 
+DATALIST_KEY_FIELD = 'slicerCLIDatalistKey'
+DATALIST_WAIT_PARAM = '_wait'
+# Datalist requests wait this many seconds for their job by default and never
+# more than the maximum, so that they don't hold a server thread for long.
+DATALIST_DEFAULT_WAIT = 10
+DATALIST_MAX_WAIT = 60
+
+# Values listed by successful datalist jobs, keyed by their datalist key.  The
+# ttl of each entry is the slicer_cli_web.datalist_cache_ttl setting.
+_datalistResults = TTLCache(256)
+# The most recent datalist job of each user and datalist key
+_datalistJobs = LRUCache(256)
+
 _return_parameter_file_desc = """
 Filename in which to write simple return parameters (integer, float,
 integer-vector, etc.) as opposed to bulk return parameters (image, file,
@@ -57,14 +76,6 @@ def _getParamDefaultVal(param):
             'optional parameters of type %s must provide a default value in the xml' % param.typ)
 
 
-def _canBeBatched(param):
-    return (
-        param.isExternalType() and
-        param.typ != 'directory' and
-        not getattr(param, 'multiple', None) and
-        param.channel != 'output')
-
-
 def _addInputParamToHandler(param, handlerDesc, required=True):
     # add to route description
     desc = param.description
@@ -73,7 +84,7 @@ def _addInputParamToHandler(param, handlerDesc, required=True):
     schema = None
 
     if param.isExternalType():
-        if _canBeBatched(param):
+        if can_be_batched(param):
             desc = (
                 'Girder ID of input %s (if batch input, this is a regex '
                 'for item names) - %s: %s'
@@ -108,12 +119,19 @@ def _addInputParamToHandler(param, handlerDesc, required=True):
         handlerDesc.param(param.identifier(), desc, dataType=dataType, enum=enum,
                           default=defaultValue,
                           required=required)
-    if _canBeBatched(param):
+    if can_be_batched(param):
         handlerDesc.param(
             param.identifier() + FOLDER_SUFFIX,
             'Girder ID of parent folder for batch input %s - %s: %s'
             % (param.typ, param.identifier(), param.description),
             dataType='string', required=False)
+        handlerDesc.param(
+            param.identifier() + BATCH_MANIFEST_SUFFIX,
+            'Items for batch input %s, in order, instead of matching names in a '
+            'folder.  Either a JSON list of item IDs or the Girder ID of a file '
+            'with a JSON list or one item ID per line - %s: %s'
+            % (param.typ, param.identifier(), param.description),
+            dataType='string', required=False)
 
 
 def _addOutputParamToHandler(param, handlerDesc, required=True):
@@ -168,7 +186,7 @@ def _addReturnParameterFileParamToHandler(handlerDesc):
         dataType='string', required=False)
 
 
-def batchCLIJob(cliItem, params, user, cliTitle):
+def batchCLIJob(cliItem, params, user, cliTitle, batchParams):
     """
     Create a local asynchronous job to run a batch of other jobs.
 
@@ -176,8 +194,12 @@ def batchCLIJob(cliItem, params, user, cliTitle):
     :param params: parameter dictionary passed to the endpoint.
     :param user: user model for the current user.
     :param cliTitle: title of the job.
+    :param batchParams: the CLI parameters that are batched.
     :returns: a job model.
     """
+    # validate these before there is a job
+    batchConcurrency(params)
+    validateBatchInputs(batchParams, params, user)
     # We have to flog the girder_worker setting if it isn't set, since the task
     # will be run outside of a cherrypy request context, and therefore
     # girder_worker cannot determine the api_url.  Further girder_worker
@@ -201,175 +223,256 @@ def batchCLIJob(cliItem, params, user, cliTitle):
         user=user,
         public=True,
         asynchronous=True,
+        otherFields={
+            '_original_params': params,
+            '_original_name': cliItem.name,
+            '_original_path': cliItem.restBasePath,
+        },
     )
-    job['_original_params'] = params
-    job['_original_name'] = cliItem.name
-    job['_original_path'] = cliItem.restBasePath
-    job = Job().save(job)
     Job().scheduleJob(job)
     return job
 
 
 def batchCLITask(job):
     """
-    Run a batch of jobs via a thread.
+    Run a batch of jobs via the batch scheduler.
 
     :param job: the job model.
     """
-    proc = threading.Thread(target=batchCLITaskProcess, args=(job,), daemon=True)
-    proc.start()
-    return job, proc
-
-
-def batchCLITaskProcess(job):  # noqa C901
-    """
-    Run a batch of jobs.  The job parameters contain the id of the cli item,
-    the parameters, including those for batching, and the user id.
-
-    :param job: the job model.
-    """
-    params = job['kwargs']['params']
-    cliTitle = job['kwargs']['cliTitle']
     user = User().load(job['kwargs']['userId'], force=True)
-    token = Token().createToken(user=user)
     cliItem = CLIItem.find(job['kwargs']['cliItemId'], user)
     handler = genHandlerToRunDockerCLI(cliItem)
-    batchParams = handler.getBatchParams(params)
-    job = Job().updateJob(
-        job, log='Started batch processing %s\n' % cliTitle,
-        status=JobStatus.RUNNING)
-    batchCursors = []
-    count = None
-    for param in batchParams:
-        q = {
-            'folderId': ObjectId(params.get(param.identifier() + FOLDER_SUFFIX)),
-            'name': {'$regex': params.get(param.identifier())}
-        }
-        if param.typ == 'image':
-            q['largeImage.fileId'] = {'$exists': True}
-        curparams = {'query': q, 'sort': [('lowerName', SortDir.ASCENDING)], 'user': user}
-        cursor = Item().findWithPermissions(**curparams)
-        batchCursors.append([cursor, curparams])
-        if count is None:
-            count = cursor.count()
-        elif cursor.count() != count:
-            job = Job().updateJob(
-                job, log='Failed batch processing %s - different number '
-                'of entries on batch inputs\n' % cliTitle,
-                status=JobStatus.ERROR)
-            return
-    scheduled = 0
-    done = False
-    lastSubJob = None
-    try:
-        while not done or (lastSubJob and lastSubJob['status'] not in {
-                JobStatus.CANCELED, JobStatus.ERROR, JobStatus.SUCCESS}):
-            job = Job().load(id=job['_id'], force=True)
-            if not job or job['status'] in {JobStatus.CANCELED, JobStatus.ERROR}:
-                return
-            lastSubJob = None if lastSubJob is None else Job().load(
-                id=lastSubJob['_id'], force=True)
-            if lastSubJob is None or lastSubJob['status'] not in {
-                    JobStatus.QUEUED, JobStatus.INACTIVE}:
-                jobParams = params.copy()
-                paramText = []
-                for idx, param in enumerate(batchParams):
-                    try:
-                        item = batchCursors[idx][0].next()  # noqa B305
-                    except pymongo.errors.CursorNotFound:
-                        # If the process takes long enough, the cursor is
-                        # removed.  In this case, redo the query and keep
-                        # going.
-                        logger.info('Requerying batch after cursor timeout')
-                        batchCursors[idx][0] = Item().findWithPermissions(
-                            offset=scheduled, **batchCursors[idx][1])
-                        try:
-                            item = batchCursors[idx][0].next()  # noqa B305
-                        except StopIteration:
-                            item = None
-                    except StopIteration:
-                        item = None
-                    if item is None:
-                        done = True
-                        break
-                    if param.typ == 'file':
-                        value = str(Item().childFiles(item, limit=1).next()['_id'])  # noqa B305
-                    elif param.typ == 'image':
-                        value = item['largeImage']['fileId']
-                    else:
-                        value = str(item['_id'])
-                    jobParams.pop(param.identifier() + FOLDER_SUFFIX)
-                    jobParams[param.identifier()] = value
-                    paramText.append(', %s=%s' % (param.identifier(), value))
-                if not done:
-                    # We are running in a girder context, but girder_worker
-                    # uses cherrypy.request.app to detect this, so we have to
-                    # fake it.
-                    _before = cherrypy.request.app
-                    cherrypy.request.app = 'fake_context'
-                    try:
-                        lastSubJob = handler.subHandler(cliItem, jobParams, user, token).job
-                    finally:
-                        cherrypy.request.app = _before
-                    scheduled += 1
-                    Job().updateJob(
-                        job, log='Scheduling job %s, %d/%d for %s%s\n' % (
-                            lastSubJob['_id'], scheduled, count, cliTitle, ''.join(paramText)))
-                    continue
-            time.sleep(0.1)
-    except Exception as exc:
-        Job().updateJob(
-            job, log='Error batch processing %s\n' % cliTitle,
-            status=JobStatus.ERROR)
-        logger.exception('Error batch processing %s\n' % cliTitle)
-        Job().updateJob(job, log='Exception: %r\n' % exc)
-        return
-    Job().updateJob(
-        job, log='Finished batch processing %s\n' % cliTitle,
-        status=JobStatus.SUCCESS)
+    scheduler = getScheduler()
+    scheduler.add(BatchJob(job, cliItem, handler, user))
+    return job, scheduler
 
 
-def genHandlerToRunDockerCLI(cliItem):  # noqa C901
+def resumeBatchJobs(updatedAfter=None):
     """
-    Generates a handler to run docker CLI using girder_worker
-
-    :param cliItem: a CLIItem model.
-    :returns: a function that runs the CLI using girder_worker
+    Resume batch jobs that were interrupted, such as by restarting Girder.
+    Each batch continues from its last checkpoint, so sub-jobs that were
+    already scheduled are not scheduled again.  Batches without a checkpoint
+    are not resumed, nor are batches whose scheduler recorded a heartbeat
+    recently, since it may still be running in another process.
+
+    :param updatedAfter: if not None, only resume batches that were updated
+        after this datetime.  Older batches are left alone so that they can
+        be canceled as stale.
+    :returns: the number of batch jobs that were resumed.
     """
-    itemId = cliItem._id
+    query = {
+        'handler': JOB_HANDLER_LOCAL,
+        'module': 'slicer_cli_web.rest_slicer_cli',
+        'function': 'batchCLITask',
+        'status': {'$in': [JobStatus.INACTIVE, JobStatus.QUEUED, JobStatus.RUNNING]},
+        BATCH_PROGRESS_FIELD: {'$exists': True},
+        '$or': [
+            {BATCH_HEARTBEAT_FIELD: {'$exists': False}},
+            {BATCH_HEARTBEAT_FIELD: {'$lt': datetime.datetime.utcnow() - datetime.timedelta(
+                seconds=HEARTBEAT_TIMEOUT)}},
+        ],
+    }
+    if updatedAfter is not None:
+        query['updated'] = {'$gte': updatedAfter}
+    count = 0
+    for jobId in Job().find(query, fields=['_id']):
+        job = Job().load(jobId['_id'], force=True)
+        try:
+            batchCLITask(job)
+            count += 1
+        except Exception as exc:
+            logger.exception('Failed to resume batch job %s' % job['_id'])
+            try:
+                Job().updateJob(
+                    job, log='Failed to resume batch job: %r\n' % exc,
+                    status=JobStatus.ERROR)
+            except Exception:
+                pass
+    return count
 
-    clim = as_model(cliItem.xml)
-    cliTitle = clim.title
 
-    # set a description for the REST endpoint for the CLI
-    handlerDesc = Description(clim.title) \
-        .notes(generate_description(clim)) \
-        .produces('application/json')
-
-    # get CLI parameters
-    index_params, opt_params, simple_out_params = get_cli_parameters(clim)
+def submitDockerJobs(specs, user):
+    """
+    Create and schedule many docker jobs at once.  Each job is created the
+    same way as by girder_worker's run.delay, so it is saved with its own job
+    token and sends the usual events and notifications, but the jobs share
+    one client token and their celery tasks are published over one broker
+    connection.
+
+    :param specs: a list of job descriptions as returned by the prepareJob
+        function of a CLI handler.
+    :param user: user model for the owner of the jobs.
+    :returns: a list of the ids of the jobs.
+    """
+    from .girder_worker_plugin.direct_docker_run import run
+
+    if not specs:
+        return []
+    clientToken = Token().createToken(scope='jobs.rest.create_job', user=user)
+    jobIds = []
+    with run.app.producer_or_acquire() as producer:
+        for spec in specs:
+            result = run.apply_async(
+                kwargs=dict(spec['kwargs']), producer=producer,
+                girder_user=user,
+                girder_job_type=spec['type'],
+                girder_job_title=spec['title'],
+                girder_job_other_fields=spec['original'],
+                girder_result_hooks=spec['result_hooks'],
+                girder_client_token=clientToken['_id'])
+            jobIds.append(result.job['_id'])
+    return jobIds
+
+
+def describeCLIHandler(table):
+    """
+    Build the API description of the run endpoint of a CLI.
 
-    datalist = {}
+    :param table: the CLI's ParameterTable.
+    :returns: a Description.
+    """
+    handlerDesc = Description(table.title) \
+        .notes(table.notes) \
+        .produces('application/json')
 
-    for param in index_params:
+    for param in table.index_params:
         if param.channel == 'output':
             _addOutputParamToHandler(param, handlerDesc, True)
         else:
             _addInputParamToHandler(param, handlerDesc, True)
-            if param.datalist:
-                datalist[param.name] = {'json': json.loads(param.datalist)}
-    for param in opt_params:
+    for param in table.opt_params:
         if param.channel == 'output':
             _addOutputParamToHandler(param, handlerDesc, False)
         else:
             _addInputParamToHandler(param, handlerDesc, False)
-            if param.datalist:
-                datalist[param.name] = {'json': json.loads(param.datalist)}
 
     # add returnparameterfile if there are simple output params
-    has_simple_return_file = len(simple_out_params) > 0
-    if has_simple_return_file:
+    if len(table.simple_out_params) > 0:
         _addReturnParameterFileParamToHandler(handlerDesc)
+    sweepable = any(can_be_swept(param) for param in itertools.chain(
+        table.index_params, table.opt_params))
+    if sweepable:
+        handlerDesc.param(
+            BATCH_SWEEP_PARAM, 'Run a batch job over combinations of parameter '
+            'values.  This is a JSON object whose keys are scalar or enumeration '
+            'parameters and whose values are either lists of values or objects '
+            'with start, stop, and step.',
+            dataType='string', required=False)
+        handlerDesc.param(
+            BATCH_SWEEP_MODE_PARAM, 'How swept values are combined with each '
+            'other and with batch inputs: every combination (product) or '
+            'pairwise (zip).',
+            dataType='string', enum=list(SWEEP_MODES), default=SWEEP_MODES[0],
+            required=False)
+    if len(table.batchable):
+        handlerDesc.param(
+            BATCH_RECURSIVE_PARAM, 'For batch inputs, also match items in all '
+            'subfolders of the batch folders.',
+            dataType='boolean', required=False, default=False)
+    if len(table.batchable) or sweepable:
+        handlerDesc.param(
+            BATCH_CONCURRENCY_PARAM, 'For batch jobs, the maximum number of jobs '
+            'that are queued or running at once.  If not set, the '
+            'slicer_cli_web.batch_concurrency setting is used.',
+            dataType='integer', required=False)
+        handlerDesc.param(
+            BATCH_INCREMENTAL_PARAM, 'For batch jobs, skip entries that already '
+            'have a successful job of the same user with the same CLI image '
+            'digest and inputs.',
+            dataType='boolean', required=False, default=False)
+    return handlerDesc
+
+
+def describeCLIDatalistHandler(table, key, datalist):
+    """
+    Build the API description of a datalist endpoint of a CLI.
+
+    :param table: the CLI's ParameterTable.
+    :param key: the name of the parameter with the datalist.
+    :param datalist: the parameter values used when listing values.
+    :returns: a Description.
+    """
+    datalistDesc = describeCLIHandler(table)
+    datalistDesc.notes(
+        'List values for %s.  If this takes longer than the %s parameter '
+        '(default %s seconds), the id and status of the job listing the '
+        'values are returned instead, and the values can be fetched from the '
+        'datalist/{id} endpoint.  Values are cached for the time set by '
+        'slicer_cli_web.datalist_cache_ttl.' % (
+            key, DATALIST_WAIT_PARAM, DATALIST_DEFAULT_WAIT)) \
+        .produces('text/plain')
+    datalistDesc._params = [
+        param for param in datalistDesc._params
+        if param['name'] not in datalist and
+        param['name'] not in {k + FOLDER_SUFFIX for k in datalist} and
+        param['name'] not in {k + BATCH_MANIFEST_SUFFIX for k in datalist}]
+    datalistDesc.param(
+        DATALIST_WAIT_PARAM, 'The longest time in seconds to wait for the '
+        'values (at most %d).' % DATALIST_MAX_WAIT,
+        dataType='number', required=False, default=DATALIST_DEFAULT_WAIT)
+    return datalistDesc
+
+
+def describeCLIRerunHandler(table):
+    """
+    Build the API description of the rerun endpoint of a CLI.
+
+    :param table: the CLI's ParameterTable.
+    :returns: a Description.
+    """
+    description = describeCLIHandler(table)
+    for param in description.params:
+        param['required'] = False
+        param.pop('default', None)
+    description.param('jobId', 'The previous job ID')
+    description._params = description._params[-1:] + description._params[:-1]
+    description._summary = 'Rerun ' + description._summary
+    if description._notes:
+        description._notes = 'Rerun a previous job: ' + description._notes
+    return description
+
+
+def describeCLIRunManyHandler(table):
+    """
+    Build the API description of the run_many endpoint of a CLI.
+
+    :param table: the CLI's ParameterTable.
+    :returns: a Description.
+    """
+    return Description('Run %s with many sets of parameters' % table.title) \
+        .notes(table.notes + '<br/><br/>Each set of parameters takes the same '
+               'values as the run endpoint.  Batch parameters are not allowed.  '
+               'The number of sets is limited by the slicer_cli_web.run_many_max '
+               'setting.') \
+        .jsonParam('body', 'A JSON list of parameter objects, one per job.',
+                   paramType='body', requireArray=True) \
+        .produces('application/json')
+
+
+def genHandlerToRunDockerCLI(cliItem):  # noqa C901
+    """
+    Generates a handler to run docker CLI using girder_worker.  The handler
+    only keeps the item id and the CLI's shared parameter table.  Its API
+    description is not attached to it; instead, its describe attribute builds
+    the description when needed.
+
+    :param cliItem: a CLIItem model.
+    :returns: a function that runs the CLI using girder_worker
+    """
+    itemId = cliItem._id
+
+    # get CLI parameters, preferably from the plan stored when the image was
+    # loaded
+    table = get_parameter_table(
+        cliItem.xml, cliItem.item.get('meta', {}).get('parameterPlan'))
+    cliTitle = table.title
+    index_params, opt_params = table.index_params, table.opt_params
+    has_simple_return_file = len(table.simple_out_params) > 0
+
+    datalist = {}
+    for param in itertools.chain(index_params, opt_params):
+        if param.channel != 'output' and param.datalist:
+            datalist[param.name] = {'json': json.loads(param.datalist)}
 
     def getBatchParams(params):
         """
@@ -381,13 +484,71 @@ def genHandlerToRunDockerCLI(cliItem):  # noqa C901
         """
         batchParams = []
         for param in itertools.chain(index_params, opt_params):
-            if _canBeBatched(param) and params.get(param.identifier() + FOLDER_SUFFIX):
+            if (param.identifier() in table.batchable and (
+                    params.get(param.identifier() + FOLDER_SUFFIX) or
+                    params.get(param.identifier() + BATCH_MANIFEST_SUFFIX))):
                 batchParams.append(param)
         return batchParams
 
-    def cliSubHandler(currentItem, params, user, token, datalist=None):
+    def isBatch(params):
         """
-        Create a job for a Slicer CLI item and schedule it.
+        Check if the parameters are for a batch job.
+
+        :param params: the parameters as passed to the endpoint.
+        :returns: True if there are batch inputs or a parameter sweep.
+        """
+        return bool(getBatchParams(params) or batchSweep(params, table)[0])
+
+    def fingerprint(currentItem, params):
+        """
+        Compute a hash that identifies the computation a job does.  Jobs with
+        the same CLI image digest and input parameters have the same
+        fingerprint regardless of their outputs.  Parameters that aren't
+        passed use their defaults, values are compared by what they stand
+        for rather than how they are written, and the Girder API url and
+        token are ignored.
+
+        :param currentItem: a CLIItem model.
+        :param params: parameter dictionary passed to the endpoint.
+        :returns: a hex digest string.
+        """
+        inputs = {}
+        for param in itertools.chain(index_params, opt_params):
+            if param.channel == 'output' or is_girder_api(param):
+                continue
+            value = params.get(param.identifier())
+            if value is None or value == '__default__':
+                value = param.default
+            inputs[param.identifier()] = normalize_param_value(param, value)
+        return hashlib.sha256(json.dumps(
+            [currentItem.digest, currentItem.name, inputs], sort_keys=True, default=str,
+        ).encode()).hexdigest()
+
+    def datalistKey(currentItem, params, user, datalist):
+        """
+        Compute the key used to cache the values listed by a datalist call.
+        This is the fingerprint of the parameters with the datalist overrides
+        applied.  If Girder resources are passed, it is specific to the user,
+        since other users may not be able to read them.
+
+        :param currentItem: a CLIItem model.
+        :param params: parameter dictionary passed to the endpoint.
+        :param user: user model for the current user.
+        :param datalist: an object with keys that override parameters.
+        :returns: a key string.
+        """
+        key = fingerprint(currentItem, dict(params, **datalist))
+        if any(is_on_girder(param) and param.name not in datalist and
+               params.get(param.identifier()) is not None
+               for param in itertools.chain(index_params, opt_params)
+               if param.channel != 'output'):
+            key += '-%s' % user['_id']
+        return key
+
+    def prepareJob(currentItem, params, user, token, datalist=None):
+        """
+        Validate the parameters of a job for a Slicer CLI item and work out
+        how to run it.
 
         :param currentItem: a CLIItem model.
         :param params: parameter dictionary passed to the endpoint.
@@ -395,26 +556,28 @@ def genHandlerToRunDockerCLI(cliItem):  # noqa C901
         :param token: allocated token for the job.
         :param datalist: if not None, an object with keys that override
             parameters.  No outputs are used.
+        :returns: a dictionary with the job 'title' and 'type', the
+            'result_hooks' and 'kwargs' of the docker task, and the
+            'original' fields used to rerun the job and to find jobs that
+            did the same computation.
         """
-        from .girder_worker_plugin.direct_docker_run import run
-
         original_params = copy.deepcopy(params)
         if hasattr(getCurrentToken, 'set'):
             getCurrentToken.set(token)
         if not getCurrentToken():
             cherrypy.request.headers['Girder-Token'] = token['_id']
 
-        container_args = [cliItem.name]
+        container_args = [currentItem.name]
         reference = {'slicer_cli_web': {
             'title': cliTitle,
-            'image': cliItem.image,
-            'name': cliItem.name,
+            'image': currentItem.image,
+            'name': currentItem.name,
         }}
         now = time.localtime()
         templateParams = {
             'title': cliTitle,  # e.g., "Detects Nuclei"
-            'task': cliItem.name,  # e.g., "NucleiDetection"
-            'image': cliItem.image,  # e.g., "dsarchive/histomicstk:latest"
+            'task': currentItem.name,  # e.g., "NucleiDetection"
+            'image': currentItem.image,  # e.g., "dsarchive/histomicstk:latest"
             'now': time.strftime('%Y%m%d-%H%M%S', now),
             'yyyy': time.strftime('%Y', now),
             'mm': time.strftime('%m', now),
@@ -448,33 +611,60 @@ def genHandlerToRunDockerCLI(cliItem):  # noqa C901
             reference, templateParams=templateParams)
         container_args.extend(args)
 
-        jobType = '%s#%s' % (cliItem.image, cliItem.name)
+        jobType = '%s#%s' % (currentItem.image, currentItem.name)
 
         if primary_input_name:
             jobTitle = '%s on %s' % (cliTitle, primary_input_name)
         else:
             jobTitle = cliTitle
 
-        job_kwargs = cliItem.item.get('meta', {}).get('docker-params', {})
+        job_kwargs = currentItem.item.get('meta', {}).get('docker-params', {})
+        original = {
+            '_original_params': original_params,
+            '_original_name': currentItem.name,
+            '_original_path': currentItem.restBasePath,
+        }
+        if not datalist:
+            original[JOB_FINGERPRINT_FIELD] = fingerprint(currentItem, original_params)
+        return {
+            'title': jobTitle,
+            'type': jobType,
+            'result_hooks': result_hooks,
+            'kwargs': dict(
+                image=currentItem.digest,
+                pull_image='if-not-present',
+                container_args=container_args,
+                **job_kwargs),
+            'original': original,
+        }
+
+    def cliSubHandler(currentItem, params, user, token, datalist=None, otherFields=None):
+        """
+        Create a job for a Slicer CLI item and schedule it.
+
+        :param currentItem: a CLIItem model.
+        :param params: parameter dictionary passed to the endpoint.
+        :param user: user model for the current user.
+        :param token: allocated token for the job.
+        :param datalist: if not None, an object with keys that override
+            parameters.  No outputs are used.
+        :param otherFields: if not None, additional fields to set on the job.
+        """
+        from .girder_worker_plugin.direct_docker_run import run
+
+        spec = prepareJob(currentItem, params, user, token, datalist)
         job = run.delay(
             girder_user=user,
-            girder_job_type=jobType,
-            girder_job_title=jobTitle,
-            girder_result_hooks=result_hooks,
-            image=cliItem.digest,
-            pull_image='if-not-present',
-            container_args=container_args,
-            **job_kwargs
+            girder_job_type=spec['type'],
+            girder_job_title=spec['title'],
+            girder_job_other_fields=dict(spec['original'], **(otherFields or {})),
+            girder_result_hooks=spec['result_hooks'],
+            **spec['kwargs']
         )
-        jobRecord = Job().load(job.job['_id'], force=True)
-        job.job['_original_params'] = jobRecord['_original_params'] = original_params
-        job.job['_original_name'] = jobRecord['_original_name'] = cliItem.name
-        job.job['_original_path'] = jobRecord['_original_path'] = cliItem.restBasePath
-        Job().save(jobRecord)
         return job
 
     @access.token
-    @describeRoute(handlerDesc)
+    @describeRoute(None)
     def cliHandler(resource, params):
         user = resource.getCurrentUser()
         token = resource.getCurrentToken()
@@ -494,9 +684,9 @@ def genHandlerToRunDockerCLI(cliItem):  # noqa C901
         # and the job would fail to finish.  We may want to override the
         # duration of this token (it defaults to the setting for cookie
         # lifetime).
-        batchParams = getBatchParams(params)
-        if len(batchParams):
-            job = batchCLIJob(currentItem, params, user, cliTitle)
+        if isBatch(params):
+            job = batchCLIJob(
+                currentItem, params, user, cliTitle, getBatchParams(params))
         else:
             token = Token().createToken(user=user)
             job = cliSubHandler(currentItem, params, user, token)
@@ -504,62 +694,130 @@ def genHandlerToRunDockerCLI(cliItem):  # noqa C901
         return job
 
     cliHandler.subHandler = cliSubHandler
+    cliHandler.prepareJob = prepareJob
+    cliHandler.fingerprint = fingerprint
+    cliHandler.datalistKey = datalistKey
     cliHandler.getBatchParams = getBatchParams
+    cliHandler.isBatch = isBatch
     cliHandler.cliTitle = cliTitle
+    cliHandler.parameterTable = table
+    cliHandler.describe = functools.partial(describeCLIHandler, table)
     if len(datalist):
         cliHandler.datalist = datalist
         for key, entry in datalist.items():
-
-            datalistDesc = Description(clim.title)
-            datalistDesc.__dict__ = handlerDesc.__dict__.copy()
-            datalistDesc.notes('List values for %s' % key) \
-                .produces('text/plain')
-            datalistDesc._params = [
-                param for param in datalistDesc._params
-                if param['name'] not in entry['json'] and
-                param['name'] not in {k + FOLDER_SUFFIX for k in entry['json']}]
-
-            @access.user
-            @describeRoute(datalistDesc)
-            def datalistHandler(resource, params):
-                setResponseTimeLimit(86400)
-                user = resource.getCurrentUser()
-                currentItem = CLIItem.find(itemId, user)
-                if not currentItem:
-                    raise RestException('Invalid CLI Item id (%s).' % (itemId))
-                token = Token().createToken(user=user)
-                job = cliSubHandler(
-                    currentItem, params, user, token, entry['json']).job  # noqa: B023
-                delay = 0.01
-                while job['status'] not in {JobStatus.SUCCESS, JobStatus.ERROR, JobStatus.CANCELED}:
-                    time.sleep(delay)
-                    delay = min(delay * 1.5, 1.0)
-                    job = Job().load(id=job['_id'], force=True, includeLog=True)
-                result = ''.join(job['log']) if 'log' in job else ''
-                if '<element' in result:
-                    result = result[result.index('<element'):]
-                if '</element>' in result:
-                    result = result[:result.rindex('</element>') + 10]
-                return result
-
-            entry['handler'] = datalistHandler
+            entry['handler'] = _genDatalistHandler(
+                itemId, cliSubHandler, datalistKey, entry['json'])
+            entry['handler'].describe = functools.partial(
+                describeCLIDatalistHandler, table, key, entry['json'])
     return cliHandler
 
 
+def datalistWait(value):
+    """
+    Parse how long a datalist request waits for its job to finish.
+
+    :param value: the requested number of seconds or None for the default.
+    :returns: a number of seconds between 0 and DATALIST_MAX_WAIT.
+    """
+    if value is None or value == '':
+        return DATALIST_DEFAULT_WAIT
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise RestException('%s must be a number.' % DATALIST_WAIT_PARAM)
+    return min(max(value, 0), DATALIST_MAX_WAIT)
+
+
+def datalistValues(job):
+    """
+    Get the values listed by a finished datalist job.
+
+    :param job: the job, including its log.
+    :returns: the part of the log from the first <element> to the last
+        </element>.
+    """
+    result = ''.join(job['log']) if 'log' in job else ''
+    if '<element' in result:
+        result = result[result.index('<element'):]
+    if '</element>' in result:
+        result = result[:result.rindex('</element>') + 10]
+    return result
+
+
+def datalistResponse(job, wait):
+    """
+    Wait a bounded time for a datalist job to finish.  The values listed by a
+    successful job are cached.
+
+    :param job: the datalist job.  This does not need to include the log.
+    :param wait: the longest time in seconds to wait.
+    :returns: the listed values if the job finished, otherwise a dictionary
+        with the jobId and status of the job.  The values can then be fetched
+        from the datalist/:id endpoint.
+    """
+    finished = {JobStatus.SUCCESS, JobStatus.ERROR, JobStatus.CANCELED}
+    deadline = time.time() + wait
+    delay = 0.01
+    while job['status'] not in finished and time.time() < deadline:
+        time.sleep(max(min(delay, deadline - time.time()), 0))
+        delay = min(delay * 1.5, 1.0)
+        job = Job().load(job['_id'], force=True, fields=['status', DATALIST_KEY_FIELD])
+    if job['status'] not in finished:
+        return {'jobId': str(job['_id']), 'status': job['status']}
+    job = Job().load(job['_id'], force=True, includeLog=True)
+    result = datalistValues(job)
+    ttl = PluginSettings.get_datalist_cache_ttl()
+    if job['status'] == JobStatus.SUCCESS and job.get(DATALIST_KEY_FIELD) and ttl:
+        _datalistResults.set(job[DATALIST_KEY_FIELD], result, ttl)
+    return result
+
+
+def _genDatalistHandler(itemId, cliSubHandler, datalistKey, datalist):
+    """
+    Generate a handler that lists the values of a CLI parameter.
+
+    :param itemId: the id of the CLI item.
+    :param cliSubHandler: the subHandler of the CLI's run handler.
+    :param datalistKey: the datalistKey function of the CLI's run handler.
+    :param datalist: the parameter values used when listing values.
+    :returns: a function that runs the CLI and returns the listed values or,
+        if the CLI doesn't finish in time, its job id.
+    """
+    @access.user
+    @describeRoute(None)
+    def datalistHandler(resource, params):
+        wait = datalistWait(params.pop(DATALIST_WAIT_PARAM, None))
+        user = resource.getCurrentUser()
+        currentItem = CLIItem.find(itemId, user)
+        if not currentItem:
+            raise RestException('Invalid CLI Item id (%s).' % (itemId))
+        key = datalistKey(currentItem, params, user, datalist)
+        result = _datalistResults.get(key)
+        if result is not None:
+            return result
+        # Reuse a job of this user that is still listing the same values.
+        # Finished jobs are not reused, so that values are listed again once
+        # they are no longer cached.
+        jobId = _datalistJobs.get((user['_id'], key))
+        job = Job().load(jobId, force=True, fields=['status', DATALIST_KEY_FIELD]) \
+            if jobId else None
+        if not job or job['status'] not in {
+                JobStatus.INACTIVE, JobStatus.QUEUED, JobStatus.RUNNING}:
+            token = Token().createToken(user=user)
+            job = cliSubHandler(
+                currentItem, params, user, token, datalist,
+                otherFields={DATALIST_KEY_FIELD: key}).job
+            _datalistJobs.set((user['_id'], key), job['_id'])
+        return datalistResponse(job, wait)
+
+    return datalistHandler
+
+
 def genHandlerToReRunDockerCLI(cliItem, cliHandler):
     itemId = cliItem._id
-    description = copy.deepcopy(cliHandler.description)
-    for param in description.params:
-        param['required'] = False
-        param.pop('default', None)
-    description.param('jobId', 'The previous job ID')
-    description._params = description._params[-1:] + description._params[:-1]
-    description._summary = 'Rerun ' + description._summary
-    if description._notes:
-        description._notes = 'Rerun a previous job: ' + description._notes
 
     @access.user
-    @describeRoute(description)
+    @describeRoute(None)
     def rerunHandler(resource, params):
         user = resource.getCurrentUser()
         currentItem = CLIItem.find(itemId, user)
@@ -569,25 +827,76 @@ def genHandlerToReRunDockerCLI(cliItem, cliHandler):
         newParams = originalJob.get('_original_params', {})
         originalName = originalJob.get('_original_name')
         originalPath = originalJob.get('_original_path')
-        if ((originalName and cliItem.name != originalName) or
-                (originalPath and cliItem.restBasePath != originalPath)):
+        if ((originalName and currentItem.name != originalName) or
+                (originalPath and currentItem.restBasePath != originalPath)):
             raise RestException('Original job was from %s/%s, not %s/%s.' % (
-                originalPath or cliItem.restBasePath,
-                originalName or cliItem.name, cliItem.restBasePath,
-                cliItem.name))
+                originalPath or currentItem.restBasePath,
+                originalName or currentItem.name, currentItem.restBasePath,
+                currentItem.name))
         newParams.update(params)
-        batchParams = cliHandler.getBatchParams(newParams)
-        if len(batchParams):
-            job = batchCLIJob(currentItem, newParams, user, cliHandler.cliTitle)
+        if cliHandler.isBatch(newParams):
+            job = batchCLIJob(
+                currentItem, newParams, user, cliHandler.cliTitle,
+                cliHandler.getBatchParams(newParams))
         else:
             token = Token().createToken(user=user)
             job = cliHandler.subHandler(currentItem, newParams, user, token)
             job = job.job
         return job
 
+    rerunHandler.describe = functools.partial(
+        describeCLIRerunHandler, cliHandler.parameterTable)
     return rerunHandler
 
 
+def genHandlerToRunManyDockerCLI(cliItem, cliHandler):
+    """
+    Generate a handler that runs a CLI once for each of a list of parameter
+    sets.  All of the parameter sets are validated before any job is created,
+    and the jobs are then created and scheduled together.
+
+    :param cliItem: a CLIItem model.
+    :param cliHandler: the CLI's run handler.
+    :returns: a function that returns a list of job ids.
+    """
+    itemId = cliItem._id
+
+    @access.user
+    @describeRoute(None)
+    def runManyHandler(resource, params):
+        paramsList = resource.getBodyJson()
+        if (not isinstance(paramsList, list) or
+                not all(isinstance(entry, dict) for entry in paramsList)):
+            raise RestException('The body must be a JSON list of parameter objects.')
+        maxSets = PluginSettings.get_run_many_max()
+        if len(paramsList) > maxSets:
+            raise RestException(
+                'At most %d parameter sets can be run at once; %d were given.' % (
+                    maxSets, len(paramsList)))
+        user = resource.getCurrentUser()
+        currentItem = CLIItem.find(itemId, user)
+        if not currentItem:
+            raise RestException('Invalid CLI Item id (%s).' % (itemId))
+        # One token is shared by all of the jobs
+        token = Token().createToken(user=user)
+        specs = []
+        for idx, entry in enumerate(paramsList):
+            entry = {key: value if isinstance(value, str) else json.dumps(value)
+                     for key, value in entry.items()}
+            if cliHandler.isBatch(entry):
+                raise RestException(
+                    'Parameter set %d: batch parameters are not allowed.' % idx)
+            try:
+                specs.append(cliHandler.prepareJob(currentItem, entry, user, token))
+            except RestException as exc:
+                raise RestException('Parameter set %d: %s' % (idx, exc.message), exc.code)
+        return [str(jobId) for jobId in submitDockerJobs(specs, user)]
+
+    runManyHandler.describe = functools.partial(
+        describeCLIRunManyHandler, cliHandler.parameterTable)
+    return runManyHandler
+
+
 def genRESTEndPointsForSlicerCLIsForItem(restResource, cliItem, registerNamedRoute=False):
     """Generates REST end points for slicer CLIs placed in subdirectories of a
     given root directory and attaches them to a REST resource with the given
@@ -617,23 +926,31 @@ def genRESTEndPointsForSlicerCLIsForItem(restResource, cliItem, registerNamedRou
     try:
         handler = genHandlerToRunDockerCLI(cliItem)
         rerunHandler = genHandlerToReRunDockerCLI(cliItem, handler)
+        runManyHandler = genHandlerToRunManyDockerCLI(cliItem, handler)
 
         # define CLI handler function
         cliRunHandler = boundHandler(restResource)(handler)
         cliReRunHandler = boundHandler(restResource)(rerunHandler)
+        cliRunManyHandler = boundHandler(restResource)(runManyHandler)
 
         cliRunHandlerName = 'run_%s' % cliItem._id
         cliReRunHandlerName = 'rerun_%s' % cliItem._id
+        cliRunManyHandlerName = 'run_many_%s' % cliItem._id
 
         restRunPath = ('cli', str(cliItem._id), 'run')
         routes = [('POST', restRunPath, cliRunHandler, cliRunHandlerName)]
         restReRunPath = ('cli', str(cliItem._id), 'rerun')
         routes.append(('POST', restReRunPath, cliReRunHandler, cliReRunHandlerName))
+        restRunManyPath = ('cli', str(cliItem._id), 'run_many')
+        routes.append(('POST', restRunManyPath, cliRunManyHandler, cliRunManyHandlerName))
         if registerNamedRoute:
             restNamedRunPath = (cliItem.restBasePath, cliItem.name, 'run')
             routes.append(('POST', restNamedRunPath, cliRunHandler, cliRunHandlerName))
             restNamedReRunPath = (cliItem.restBasePath, cliItem.name, 'rerun')
             routes.append(('POST', restNamedReRunPath, cliReRunHandler, cliReRunHandlerName))
+            restNamedRunManyPath = (cliItem.restBasePath, cliItem.name, 'run_many')
+            routes.append((
+                'POST', restNamedRunManyPath, cliRunManyHandler, cliRunManyHandlerName))
 
         if hasattr(handler, 'datalist'):
             for key, entry in handler.datalist.items():
@@ -648,11 +965,13 @@ def genRESTEndPointsForSlicerCLIsForItem(restResource, cliItem, registerNamedRou
         for routeMethod, routeName, routeHandler, routeHandlerName in routes:
             setattr(restResource, routeHandlerName, routeHandler)
             restResource.route(routeMethod, routeName, routeHandler)
+            restResource.deferRouteDocs(routeMethod, routeName, routeHandler)
 
         def undoFunction():
             try:
-                for routeMethod, routeName, routeHandler, routeHandlerName in routes:
-                    restResource.removeRoute(routeMethod, routeName, routeHandler)
+                for routeMethod, routeName, _, routeHandlerName in routes:
+                    restResource.removeRoute(routeMethod, routeName)
+                    restResource.removeRouteDocs(routeMethod, routeName)
                     if hasattr(restResource, routeHandlerName):
                         delattr(restResource, routeHandlerName)
             except Exception:
@@ -667,3 +986,259 @@ def genRESTEndPointsForSlicerCLIsForItem(restResource, cliItem, registerNamedRou
                          cliItem.name)
 
     return restResource
+
+
+def _generateHandlers(cliItem):
+    """
+    Generate the run, rerun, and datalist handlers for a slicer CLI.
+
+    :param cliItem: a CLIItem model or the id of a CLI item.
+    :returns: a dictionary with 'run', 'rerun', and 'run_many' handlers and a
+        'datalist' dictionary of handlers keyed by parameter name.
+    """
+    if not isinstance(cliItem, CLIItem):
+        item = Item().load(cliItem, force=True)
+        if not item:
+            raise RestException('Invalid CLI Item id (%s).' % (cliItem))
+        cliItem = CLIItem(item)
+    handler = genHandlerToRunDockerCLI(cliItem)
+    return {
+        'run': handler,
+        'rerun': genHandlerToReRunDockerCLI(cliItem, handler),
+        'run_many': genHandlerToRunManyDockerCLI(cliItem, handler),
+        'datalist': {
+            key: entry['handler']
+            for key, entry in getattr(handler, 'datalist', {}).items()},
+    }
+
+
+def _describeLazyRoutes(restResource, routes, handlers):
+    """
+    Replace the placeholder API documentation of lazily generated routes with
+    the full descriptions of the generated handlers.  Datalist routes are
+    registered with a wildcard key; they are documented per datalist key.
+
+    :param restResource: the resource the routes are attached to.
+    :param routes: a list of (method, route, proxy handler, kind) tuples.
+    :param handlers: the generated handlers for the CLI.
+    :returns: a list of (method, route) tuples of documentation that does not
+        correspond to a registered route.
+    """
+    extraDocs = []
+    for routeMethod, routeName, _, kind in routes:
+        if kind == 'datalist':
+            restResource.removeRouteDocs(routeMethod, routeName)
+            for key, dlHandler in handlers['datalist'].items():
+                dlRoute = routeName[:-1] + (key, )
+                restResource.deferRouteDocs(routeMethod, dlRoute, dlHandler)
+                extraDocs.append((routeMethod, dlRoute))
+        else:
+            restResource.deferRouteDocs(routeMethod, routeName, handlers[kind])
+    return extraDocs
+
+
+def _describeLazyProxy(summary, datalist=False):
+    """
+    Build the placeholder API description of a lazily generated route.
+
+    :param summary: the summary of the route.
+    :param datalist: True if this is a datalist route.
+    :returns: a Description.
+    """
+    description = Description(summary).notes(
+        'The parameters are documented after the CLI is first used.')
+    if datalist:
+        description.param(
+            'key', 'The name of the parameter with a datalist.', paramType='path'
+        ).produces('text/plain')
+    elif summary.startswith('Rerun '):
+        description.param('jobId', 'The previous job ID')
+    elif 'many sets of parameters' in summary:
+        description.jsonParam(
+            'body', 'A JSON list of parameter objects, one per job.',
+            paramType='body', requireArray=True)
+    return description
+
+
+def genLazyRESTEndPointsForSlicerCLIsForItem(restResource, cliItem, registerNamedRoute=False):
+    """
+    Register the REST end points for a slicer CLI without parsing its
+    specification.  This registers the same run and rerun routes as
+    genRESTEndPointsForSlicerCLIsForItem plus a datalist route with a wildcard
+    key.  The actual handlers are generated the first time any of the routes
+    is called and are kept in the resource's bounded handler cache; until
+    then, the routes have placeholder API documentation.
+
+    :param restResource: a DockerResource.  This must have a handlerCache.
+    :param cliItem: a CLIItem model.
+    :param registerNamedRoute: if True, also register the routes based on the
+        image and cli names.
+    """
+    if not isinstance(restResource, Resource):
+        raise Exception('restResource must be a Docker Resource')
+
+    itemId = cliItem._id
+    cliName = cliItem.name
+    cacheKey = (str(itemId), cliItem.item.get('updated'))
+    routes = []
+    # documentation added for concrete datalist routes once described
+    extraDocs = None
+
+    def getHandlers():
+        nonlocal extraDocs
+        handlers = restResource.handlerCache.get(cacheKey)
+        if handlers is None:
+            handlers = restResource.handlerCache.set(cacheKey, _generateHandlers(itemId))
+            if extraDocs is None:
+                extraDocs = _describeLazyRoutes(restResource, routes, handlers)
+            logger.debug('Generated REST handlers for %s', cliName)
+        return handlers
+
+    @access.token
+    @describeRoute(None)
+    def cliHandler(resource, params):
+        return getHandlers()['run'](resource, params)
+
+    @access.user
+    @describeRoute(None)
+    def rerunHandler(resource, params):
+        return getHandlers()['rerun'](resource, params)
+
+    @access.user
+    @describeRoute(None)
+    def runManyHandler(resource, params):
+        return getHandlers()['run_many'](resource, params)
+
+    @access.user
+    @describeRoute(None)
+    def datalistHandler(resource, key, params):
+        dlHandler = getHandlers()['datalist'].get(key)
+        if dlHandler is None:
+            raise RestException('Parameter %s of %s does not have a datalist.' % (
+                key, cliName))
+        return dlHandler(resource, params)
+
+    cliHandler.describe = functools.partial(_describeLazyProxy, 'Run %s' % cliName)
+    rerunHandler.describe = functools.partial(_describeLazyProxy, 'Rerun %s' % cliName)
+    runManyHandler.describe = functools.partial(
+        _describeLazyProxy, 'Run %s with many sets of parameters' % cliName)
+    datalistHandler.describe = functools.partial(
+        _describeLazyProxy, 'List values for a parameter of %s' % cliName, True)
+
+    try:
+        cliRunHandler = boundHandler(restResource)(cliHandler)
+        cliReRunHandler = boundHandler(restResource)(rerunHandler)
+        cliRunManyHandler = boundHandler(restResource)(runManyHandler)
+        dlHandler = boundHandler(restResource)(datalistHandler)
+
+        basePaths = [('cli', str(itemId))]
+        if registerNamedRoute:
+            basePaths.append((cliItem.restBasePath, cliName))
+        for basePath in basePaths:
+            routes.append(('POST', basePath + ('run', ), cliRunHandler, 'run'))
+            routes.append(('POST', basePath + ('rerun', ), cliReRunHandler, 'rerun'))
+            routes.append(('POST', basePath + ('run_many', ), cliRunManyHandler, 'run_many'))
+            routes.append(('POST', basePath + ('datalist', ':key'), dlHandler, 'datalist'))
+
+        for routeMethod, routeName, routeHandler, _ in routes:
+            restResource.route(routeMethod, routeName, routeHandler)
+            restResource.deferRouteDocs(routeMethod, routeName, routeHandler)
+
+        def undoFunction():
+            try:
+                for routeMethod, routeName, _, _ in routes:
+                    restResource.removeRoute(routeMethod, routeName)
+                    restResource.removeRouteDocs(routeMethod, routeName)
+                for routeMethod, routeName in extraDocs or []:
+                    restResource.removeRouteDocs(routeMethod, routeName)
+                restResource.handlerCache.pop(cacheKey)
+            except Exception:
+                logger.exception('Failed to remove route')
+
+        restResource.storeEndpoints(cliItem.image, cliName, undoFunction)
+
+        logger.debug('Registered lazy REST endpoints for %s', cliName)
+    except Exception:
+        logger.exception('Failed to create REST endpoints for %r',
+                         cliName)
+
+    return restResource
+
+
+def genDispatchRESTEndPointsForSlicerCLIsForItem(restResource, cliItem, registerNamedRoute=False):
+    """
+    Add a slicer CLI to the dispatch tables of a resource rather than
+    registering routes for it.  The resource's parametric run, rerun, and
+    datalist routes look the CLI's handlers up by item id or, if
+    registerNamedRoute is set, by image and cli name.  The CLI's endpoints are
+    still included in the API documentation.  If the resource uses lazy
+    endpoints, the handlers are generated and documented the first time the
+    CLI is called and are kept in the resource's bounded handler cache.
+
+    :param restResource: a DockerResource.  This must have dispatchHandlers,
+        dispatchNames, and handlerCache attributes.
+    :param cliItem: a CLIItem model.
+    :param registerNamedRoute: if True, also dispatch based on the image and
+        cli names.
+    """
+    if not isinstance(restResource, Resource):
+        raise Exception('restResource must be a Docker Resource')
+
+    itemId = str(cliItem._id)
+    cliName = cliItem.name
+    cacheKey = (itemId, cliItem.item.get('updated'))
+    namedKey = (cliItem.restBasePath, cliName)
+    basePaths = [('cli', itemId)]
+    if registerNamedRoute:
+        basePaths.append(namedKey)
+    # (method, route) of the documentation added for this CLI
+    docRoutes = []
+
+    def describe(handlers):
+        for basePath in basePaths:
+            for action in ('run', 'rerun', 'run_many'):
+                docRoutes.append(('POST', basePath + (action, ), handlers[action]))
+            for key, dlHandler in handlers['datalist'].items():
+                docRoutes.append(('POST', basePath + ('datalist', key), dlHandler))
+        for routeMethod, routeName, routeHandler in docRoutes:
+            restResource.deferRouteDocs(routeMethod, routeName, routeHandler)
+
+    def getHandlers():
+        if not restResource.lazyEndpoints:
+            return handlers
+        cached = restResource.handlerCache.get(cacheKey)
+        if cached is None:
+            cached = restResource.handlerCache.set(cacheKey, _generateHandlers(itemId))
+            if not docRoutes:
+                describe(cached)
+            logger.debug('Generated REST handlers for %s', cliName)
+        return cached
+
+    try:
+        if not restResource.lazyEndpoints:
+            handlers = _generateHandlers(cliItem)
+            describe(handlers)
+
+        restResource.dispatchHandlers[itemId] = getHandlers
+        if registerNamedRoute:
+            restResource.dispatchNames[namedKey] = itemId
+
+        def undoFunction():
+            try:
+                restResource.dispatchHandlers.pop(itemId, None)
+                if restResource.dispatchNames.get(namedKey) == itemId:
+                    del restResource.dispatchNames[namedKey]
+                for routeMethod, routeName, _ in docRoutes:
+                    restResource.removeRouteDocs(routeMethod, routeName)
+                restResource.handlerCache.pop(cacheKey)
+            except Exception:
+                logger.exception('Failed to remove route')
+
+        restResource.storeEndpoints(cliItem.image, cliName, undoFunction)
+
+        logger.debug('Added %s to the REST dispatch tables', cliName)
+    except Exception:
+        logger.exception('Failed to create REST endpoints for %r',
+                         cliName)
+
+    return restResource
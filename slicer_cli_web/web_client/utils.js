@@ -4,6 +4,20 @@ import { restRequest } from '@girder/core/rest';
 
 const utils = {};
 
+/**
+ * Datalist requests return the job listing the values rather than the values
+ * if it takes too long.  In that case, keep waiting for the job's values.
+ */
+utils.datalistValues = function (data) {
+    if (data && data.jobId) {
+        return restRequest({
+            url: 'slicer_cli_web/datalist/' + data.jobId,
+            method: 'GET'
+        }).then(utils.datalistValues);
+    }
+    return data;
+};
+
 utils.handleDatalist = function (elem, basePath, getParams) {
     if (!utils.handleDatalist._existing) {
         utils.handleDatalist._existing = $.Deferred().resolve();
@@ -22,7 +36,7 @@ utils.handleDatalist = function (elem, basePath, getParams) {
                 url: basePath + '/datalist/' + id,
                 method: 'POST',
                 data: params
-            }).then((data) => {
+            }).then(utils.datalistValues).then((data) => {
                 $(el).find('datalist').remove();
                 $(el).removeAttr('list');
                 const elements = $(data).filter('element');
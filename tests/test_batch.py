@@ -13,8 +13,8 @@ def waitForBatchJob(job):
         job = Job().load(id=job['_id'], force=True, includeLog=True)
     results = {'job': job}
     if job['status'] == JobStatus.SUCCESS:
-        log = ''.join(job['log']) if 'log' in job else ''
-        subjobIds = [entry.split(',', 1)[0] for entry in log.split('Scheduling job ')[1:]]
+        subjobIds = [subjob['_id'] for subjob in Job().find(
+            {'parentId': job['_id']}, sort=[('batchIndex', 1)])]
         subjobs = None
         subjobs = [Job().load(id=id, force=True, includeLog=True) for id in subjobIds]
         while any(subjob['status'] not in {
@@ -92,6 +92,25 @@ def testBatchTwoParams(boundServer, admin, girderWorker, smallDocker, fileset):
         assert 'item match' not in ''.join(subjob['log'])
 
 
+@pytest.mark.usefixtures('girderWorker')
+@pytest.mark.plugin('slicer_cli_web')
+def testBatchConcurrency(boundServer, admin, girderWorker, smallDocker, fileset):
+    req = scheduleBatchJob(boundServer, admin, data={
+        'file1': '',
+        'file1_folder': str(fileset['folder1']['_id']),
+        'image1': str(fileset['file1'][0]['_id']),
+        'item1': str(fileset['item1'][0]['_id']),
+        '_concurrency': 3,
+    })
+    assert req.status_code == 200
+    results = waitForBatchJob(req.json())
+    assert results['job']['status'] == JobStatus.SUCCESS
+    assert len(results['subjobs']) == len(fileset['file1'])
+    for subjob in results['subjobs']:
+        assert subjob['status'] == JobStatus.SUCCESS
+        assert '_concurrency' not in subjob['_original_params']
+
+
 @pytest.mark.plugin('slicer_cli_web')
 def testBatchMismatchedLists(boundServer, admin, girderWorker, smallDocker, fileset):
     req = scheduleBatchJob(boundServer, admin, data={
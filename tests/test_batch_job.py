@@ -0,0 +1,615 @@
+import datetime
+import io
+import json
+import os
+import time
+import types
+
+import pytest
+from bson.objectid import ObjectId
+from girder.api.rest import RestException
+from girder.models.folder import Folder
+from girder.models.item import Item
+from girder.models.setting import Setting
+from girder.models.upload import Upload
+from girder_jobs.constants import JobStatus
+from girder_jobs.models.job import Job
+from pytest_girder.assertions import assertStatus, assertStatusOk
+
+from slicer_cli_web import batch_job, rest_slicer_cli
+from slicer_cli_web.cli_utils import get_parameter_table
+from slicer_cli_web.models import CLIItem
+
+
+def addImage(name, admin, folder):
+    image = Item().createItem(name, admin, folder)
+    Item().collection.update_one(
+        {'_id': image['_id']}, {'$set': {'largeImage': {'fileId': str(image['_id'])}}})
+    return image
+
+
+@pytest.fixture
+def batchCLI(server, admin, folder):
+    # Sub-jobs are created outside of a request
+    Setting().set('worker.api_url', 'http://127.0.0.1/api/v1')
+    xmlpath = os.path.join(os.path.dirname(__file__), 'data', 'ExampleSpec.xml')
+    item = Item().createItem('data', admin, folder)
+    Item().setMetadata(item, dict(
+        slicerCLIType='task', type='python', image='dockerImage',
+        digest='dockerImage@sha256:abc', xml=open(xmlpath, 'rb').read()))
+    for idx in range(8):
+        addImage('image%d' % idx, admin, folder)
+    cliItem = CLIItem(item)
+    subjobs = []
+
+    def subHandler(currentItem, params, user, token, otherFields=None):
+        subjobs.append(Job().createJob(
+            title='subjob', type='test', user=user, kwargs=params, otherFields=otherFields))
+        return types.SimpleNamespace(job=subjobs[-1])
+
+    cliHandler = rest_slicer_cli.genHandlerToRunDockerCLI(cliItem)
+    handler = types.SimpleNamespace(
+        subHandler=subHandler,
+        getBatchParams=cliHandler.getBatchParams,
+        fingerprint=cliHandler.fingerprint,
+        parameterTable=cliHandler.parameterTable)
+    yield cliItem, handler, subjobs
+
+
+def waitFor(condition, timeout=5):
+    start = time.time()
+    while not condition():
+        assert time.time() - start < timeout
+        time.sleep(0.01)
+
+
+@pytest.mark.plugin('slicer_cli_web')
+@pytest.mark.parametrize('concurrency', [0, 3])
+def test_batchScheduler(admin, folder, batchCLI, concurrency):
+    cliItem, handler, subjobs = batchCLI
+    params = {
+        'inputImageFile': 'image',
+        'inputImageFile_folder': str(folder['_id']),
+        '_concurrency': str(concurrency),
+    }
+    job = Job().createJob(title='batch', type='test', user=admin, kwargs={
+        'params': params, 'cliTitle': 'test', 'userId': admin['_id'],
+        'cliItemId': str(cliItem._id)})
+    scheduler = batch_job.getScheduler()
+    scheduler.add(batch_job.BatchJob(job, cliItem, handler, admin))
+
+    finished = 0
+    while finished < 8:
+        waitFor(lambda finished=finished: len(subjobs) > finished)
+        if not finished:
+            # items added after the batch starts aren't processed
+            addImage('image8', admin, folder)
+        # nothing more is scheduled until a sub-job is updated
+        time.sleep(0.05)
+        active = len(subjobs) - finished
+        assert active == min(concurrency or 1, 8 - finished)
+        subjob = Job().updateJob(
+            Job().load(subjobs[finished]['_id'], force=True), status=JobStatus.RUNNING)
+        Job().updateJob(subjob, status=JobStatus.SUCCESS)
+        finished += 1
+        if concurrency and len(subjobs) < 8:
+            waitFor(lambda finished=finished: len(subjobs) - finished == concurrency)
+    # without a sweep, the batch finishes as soon as its last sub-job does
+    waitFor(lambda: Job().load(job['_id'], force=True)['status'] == JobStatus.SUCCESS)
+    assert len(subjobs) == 8
+    images = Item().find({'name': {'$ne': 'image8'}, 'largeImage': {'$exists': True}},
+                         sort=[('lowerName', 1)])
+    assert Job().load(job['_id'], force=True)[batch_job.BATCH_INPUTS_FIELD] == [
+        [image['largeImage']['fileId'] for image in images]]
+    waitFor(lambda: job['_id'] not in scheduler.batches)
+    assert job['_id'] not in scheduler.subJobs.values()
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def test_batchSchedulerCancel(admin, folder, batchCLI):
+    cliItem, handler, subjobs = batchCLI
+    params = {'inputImageFile': 'image', 'inputImageFile_folder': str(folder['_id'])}
+    job = Job().createJob(title='batch', type='test', user=admin, kwargs={
+        'params': params, 'cliTitle': 'test', 'userId': admin['_id'],
+        'cliItemId': str(cliItem._id)})
+    scheduler = batch_job.getScheduler()
+    scheduler.add(batch_job.BatchJob(job, cliItem, handler, admin))
+    waitFor(lambda: len(subjobs) == 1)
+    Job().cancelJob(Job().load(job['_id'], force=True))
+    waitFor(lambda: job['_id'] not in scheduler.batches)
+    Job().updateJob(Job().load(subjobs[0]['_id'], force=True), status=JobStatus.RUNNING)
+    time.sleep(0.05)
+    assert len(subjobs) == 1
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def test_batchSchedulerRecovers(admin, folder, batchCLI, monkeypatch):
+    cliItem, handler, subjobs = batchCLI
+    params = {'inputImageFile': 'image', 'inputImageFile_folder': str(folder['_id'])}
+    job = Job().createJob(title='batch', type='test', user=admin, kwargs={
+        'params': params, 'cliTitle': 'test', 'userId': admin['_id'],
+        'cliItemId': str(cliItem._id)})
+    # failing a batch whose job was deleted doesn't raise
+    batch = batch_job.BatchJob(job, cliItem, handler, admin)
+    Job().remove(job)
+    batch.fail(Exception('deleted'))
+
+    # errors while checking a batch don't stop the scheduler
+    monkeypatch.setattr(batch_job, 'SWEEP_INTERVAL', 0.05)
+    scheduler = batch_job.BatchScheduler()
+    steps = []
+
+    def step(scheduler):
+        steps.append(time.time())
+        raise Exception('step failed')
+
+    def fail(exc):
+        raise Exception('fail failed')
+
+    broken = types.SimpleNamespace(
+        jobId='broken', inFlight={}, claim=lambda owner: True, step=step, fail=fail)
+    checked = types.SimpleNamespace(
+        jobId='checked', inFlight={}, claim=lambda owner: True,
+        step=lambda scheduler: steps.append(None) and False)
+    scheduler.start()
+    try:
+        scheduler.add(broken)
+        waitFor(lambda: 'broken' not in scheduler.batches)
+        assert scheduler.is_alive()
+        # a steady stream of checks doesn't delay the periodic sweep
+        scheduler.add(checked)
+        start = time.time()
+        while steps.count(None) < 4:
+            assert time.time() - start < 5
+            with scheduler.cond:
+                scheduler.pending.add('other')
+                scheduler.cond.notify()
+            time.sleep(0.005)
+    finally:
+        scheduler.stop()
+        scheduler.join()
+
+    # a scheduler whose thread stopped is replaced and its batches taken over
+    previous = batch_job.getScheduler()
+    with previous.cond:
+        previous.batches['checked'] = checked
+    previous.stop()
+    previous.join()
+    restarted = batch_job.getScheduler()
+    assert restarted is not previous
+    assert restarted.is_alive()
+    assert restarted.owner == previous.owner
+    waitFor(lambda: 'checked' not in restarted.batches or steps.count(None) > 4)
+    with restarted.cond:
+        restarted.batches.pop('checked', None)
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def test_resumeBatchJobs(admin, folder, batchCLI, monkeypatch):
+    cliItem, handler, subjobs = batchCLI
+    monkeypatch.setattr(rest_slicer_cli, 'genHandlerToRunDockerCLI', lambda cliItem: handler)
+    params = {'inputImageFile': 'image', 'inputImageFile_folder': str(folder['_id'])}
+    inputs = [[str(image['_id']) for image in Item().find(
+        {'largeImage': {'$exists': True}}, sort=[('lowerName', 1)])]]
+    # a batch that was interrupted with three sub-jobs scheduled and the third
+    # one still queued
+    queued = Job().createJob(title='subjob', type='test', user=admin)
+    queued = Job().updateJob(queued, status=JobStatus.QUEUED)
+    job = Job().createLocalJob(
+        module='slicer_cli_web.rest_slicer_cli', function='batchCLITask',
+        title='batch', type='test', user=admin, kwargs={
+            'params': params, 'cliTitle': 'test', 'userId': admin['_id'],
+            'cliItemId': str(cliItem._id)})
+    job = Job().updateJob(job, status=JobStatus.RUNNING, otherFields={
+        batch_job.BATCH_INPUTS_FIELD: inputs,
+        batch_job.BATCH_PROGRESS_FIELD: {
+            'owner': 'previous', 'scheduled': 3, 'completed': 2,
+            'inFlight': [queued['_id']]}})
+
+    # batches without a checkpoint and stale batches are not resumed
+    kwargs = {'params': params, 'cliTitle': 'test', 'userId': admin['_id'],
+              'cliItemId': str(cliItem._id)}
+    unchecked = Job().createLocalJob(
+        module='slicer_cli_web.rest_slicer_cli', function='batchCLITask',
+        title='batch', type='test', user=admin, kwargs=kwargs)
+    stale = Job().createLocalJob(
+        module='slicer_cli_web.rest_slicer_cli', function='batchCLITask',
+        title='batch', type='test', user=admin, kwargs=kwargs)
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=7)
+    Job().collection.update_one({'_id': stale['_id']}, {'$set': {
+        'updated': cutoff - datetime.timedelta(days=1),
+        batch_job.BATCH_PROGRESS_FIELD: {'owner': 'previous', 'scheduled': 0}}})
+
+    assert rest_slicer_cli.resumeBatchJobs(updatedAfter=cutoff) == 1
+    for other in (unchecked, stale):
+        other = Job().load(other['_id'], force=True)
+        assert other['status'] == JobStatus.INACTIVE
+        assert other.get(batch_job.BATCH_PROGRESS_FIELD, {}).get('owner') in (None, 'previous')
+    progress = Job().load(job['_id'], force=True)[batch_job.BATCH_PROGRESS_FIELD]
+    assert progress['owner'] == batch_job.getScheduler().owner
+    # the next sub-job waits for the queued one to start
+    time.sleep(0.05)
+    assert not subjobs
+    Job().updateJob(Job().load(queued['_id'], force=True), status=JobStatus.RUNNING)
+    waitFor(lambda: len(subjobs) == 1)
+    assert subjobs[0]['kwargs']['inputImageFile'] == inputs[0][3]
+    for idx in range(5):
+        waitFor(lambda idx=idx: len(subjobs) > idx)
+        subjob = Job().updateJob(
+            Job().load(subjobs[idx]['_id'], force=True), status=JobStatus.RUNNING)
+        Job().updateJob(subjob, status=JobStatus.SUCCESS)
+    Job().updateJob(Job().load(queued['_id'], force=True), status=JobStatus.SUCCESS)
+    waitFor(lambda: Job().load(job['_id'], force=True)['status'] == JobStatus.SUCCESS)
+    assert len(subjobs) == 5
+    progress = Job().load(job['_id'], force=True)[batch_job.BATCH_PROGRESS_FIELD]
+    assert progress['scheduled'] == 8
+    assert progress['completed'] == 8
+    assert progress['inFlight'] == []
+    # a resumed batch isn't resumed again
+    assert rest_slicer_cli.resumeBatchJobs(updatedAfter=cutoff) == 0
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def test_resumeBatchJobsOwnership(admin, folder, batchCLI, monkeypatch):
+    cliItem, handler, subjobs = batchCLI
+    monkeypatch.setattr(rest_slicer_cli, 'genHandlerToRunDockerCLI', lambda cliItem: handler)
+    params = {'inputImageFile': 'image', 'inputImageFile_folder': str(folder['_id']),
+              '_concurrency': '2'}
+    inputs = [[str(image['_id']) for image in Item().find(
+        {'largeImage': {'$exists': True}}, sort=[('lowerName', 1)])]]
+
+    def batchJob(heartbeat):
+        job = Job().createLocalJob(
+            module='slicer_cli_web.rest_slicer_cli', function='batchCLITask',
+            title='batch', type='test', user=admin, kwargs={
+                'params': params, 'cliTitle': 'test', 'userId': admin['_id'],
+                'cliItemId': str(cliItem._id)})
+        return Job().updateJob(job, status=JobStatus.RUNNING, otherFields={
+            batch_job.BATCH_INPUTS_FIELD: inputs,
+            batch_job.BATCH_PROGRESS_FIELD: {
+                'owner': 'other', 'scheduled': 2, 'completed': 2, 'inFlight': [],
+                'heartbeat': heartbeat}})
+
+    now = datetime.datetime.utcnow()
+    live = batchJob(now)
+    orphan = batchJob(now - datetime.timedelta(seconds=batch_job.HEARTBEAT_TIMEOUT + 1))
+    # the orphaned batch submitted a sub-job but stopped before recording it
+    submitted = Job().createJob(title='subjob', type='test', user=admin, otherFields={
+        'parentId': orphan['_id'], batch_job.BATCH_INDEX_FIELD: 2})
+
+    # only the batch whose scheduler stopped is resumed
+    assert rest_slicer_cli.resumeBatchJobs() == 1
+    live = Job().load(live['_id'], force=True)
+    assert live[batch_job.BATCH_PROGRESS_FIELD]['owner'] == 'other'
+    assert not batch_job.getScheduler().add(batch_job.BatchJob(live, cliItem, handler, admin))
+    # the submitted sub-job is adopted rather than submitted again
+    waitFor(lambda: len(subjobs) == 1)
+    assert subjobs[0][batch_job.BATCH_INDEX_FIELD] == 3
+    assert subjobs[0]['kwargs']['inputImageFile'] == inputs[0][3]
+    waitFor(lambda: Job().load(orphan['_id'], force=True)[
+        batch_job.BATCH_PROGRESS_FIELD]['scheduled'] == 4)
+    progress = Job().load(orphan['_id'], force=True)[batch_job.BATCH_PROGRESS_FIELD]
+    assert progress['owner'] == batch_job.getScheduler().owner
+    assert progress['inFlight'] == [submitted['_id'], subjobs[0]['_id']]
+    Job().updateJob(Job().load(orphan['_id'], force=True), status=JobStatus.CANCELED)
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def test_fingerprint(admin, folder, batchCLI):
+    cliItem, handler, subjobs = batchCLI
+    fingerprint = handler.fingerprint(cliItem, {'inputImageFile': 'abc', 'gamma': '1'})
+    assert fingerprint == handler.fingerprint(cliItem, {
+        'inputImageFile': 'abc', 'gamma': '1.0', 'beta': '0.5',
+        'stainColor_2': '[1, 1, 1]', 'girderToken': 'token', '_concurrency': '8',
+        'outputStainImageFile_1': 'output.tiff'})
+    assert fingerprint != handler.fingerprint(cliItem, {'inputImageFile': 'abc', 'gamma': '2'})
+    assert fingerprint != handler.fingerprint(cliItem, {'inputImageFile': 'def', 'gamma': '1'})
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def test_batchIncremental(admin, user, folder, batchCLI):
+    cliItem, handler, subjobs = batchCLI
+    images = list(Item().find({'largeImage': {'$exists': True}}, sort=[('lowerName', 1)]))
+    # images 0 and 1 were processed, image 2 failed, image 3 was processed with
+    # other parameters and image 4 was processed by another user
+    for idx, status, owner, gamma in [
+            (0, JobStatus.SUCCESS, admin, None), (1, JobStatus.SUCCESS, admin, None),
+            (2, JobStatus.ERROR, admin, None), (3, JobStatus.SUCCESS, admin, '0.7'),
+            (4, JobStatus.SUCCESS, user, None)]:
+        prior = Job().createJob(title='prior', type='test', user=owner, otherFields={
+            batch_job.JOB_FINGERPRINT_FIELD: handler.fingerprint(cliItem, {
+                'inputImageFile': images[idx]['largeImage']['fileId'],
+                'gamma': gamma,
+                'outputStainImageFile_1': 'prior.tiff'})})
+        Job().collection.update_one({'_id': prior['_id']}, {'$set': {'status': status}})
+    params = {
+        'inputImageFile': 'image',
+        'inputImageFile_folder': str(folder['_id']),
+        'outputStainImageFile_1': 'output.tiff',
+        '_concurrency': '8',
+        '_incremental': 'true',
+    }
+    job = Job().createJob(title='batch', type='test', user=admin, kwargs={
+        'params': params, 'cliTitle': 'test', 'userId': admin['_id'],
+        'cliItemId': str(cliItem._id)})
+    batch_job.getScheduler().add(batch_job.BatchJob(job, cliItem, handler, admin))
+    waitFor(lambda: len(subjobs) == 6)
+    assert [subjob['kwargs']['inputImageFile'] for subjob in subjobs] == [
+        image['largeImage']['fileId'] for image in images[2:]]
+    assert '_incremental' not in subjobs[0]['kwargs']
+    job = Job().load(job['_id'], force=True, includeLog=True)
+    assert 'Skipping 2 of 8 entries that were already processed\n' in job['log']
+    assert job[batch_job.BATCH_ENTRIES_FIELD] == list(range(2, 8))
+
+
+@pytest.mark.parametrize(('pattern', 'query'), [
+    ('', {}),
+    ('.*', {}),
+    ('image', {'name': {'$regex': 'image'}}),
+    ('^image1$', {'name': 'image1'}),
+    ('^image', {'name': {'$gte': 'image', '$lt': 'imagf'}}),
+    ('^image.*$', {'name': {'$gte': 'image', '$lt': 'imagf'}}),
+    ('^im\\.ag', {'name': {'$gte': 'im.ag', '$lt': 'im.ah'}}),
+    ('^image[0-3]', {'name': {'$gte': 'image', '$lt': 'imagf', '$regex': '^image[0-3]'}}),
+    ('^images?', {'name': {'$gte': 'image', '$lt': 'imagf', '$regex': '^images?'}}),
+    ('(?i)^Image', {'lowerName': {'$gte': 'image', '$lt': 'imagf'},
+                    'name': {'$regex': '(?i)^Image'}}),
+    ('^image|^other', {'name': {'$regex': '^image|^other'}}),
+    ('^[ab]', {'name': {'$regex': '^[ab]'}}),
+])
+def test_planNameQuery(pattern, query):
+    assert batch_job.planNameQuery(pattern)[0] == query
+
+
+@pytest.mark.plugin('slicer_cli_web')
+@pytest.mark.parametrize('source', ['folder', 'list', 'file'])
+def test_batchInputSources(admin, folder, fsAssetstore, batchCLI, source):
+    cliItem, handler, subjobs = batchCLI
+    images = list(Item().find({'largeImage': {'$exists': True}}, sort=[('lowerName', 1)]))
+    params = {'_concurrency': '8', 'inputImageFile': '^image[2-4]'}
+    expected = images[2:5]
+    if source == 'folder':
+        params['inputImageFile_folder'] = str(folder['_id'])
+        plan = "index range on name starting with 'image'"
+    else:
+        expected = expected[::-1]
+        ids = [str(image['_id']) for image in expected]
+        if source == 'list':
+            params['inputImageFile_manifest'] = json.dumps(ids)
+            plan = '3 items listed'
+        else:
+            data = '\n'.join(ids).encode()
+            manifest = Upload().uploadFromFile(
+                io.BytesIO(data), len(data), 'manifest.txt', parentType='folder',
+                parent=folder, user=admin)
+            params['inputImageFile_manifest'] = str(manifest['_id'])
+            plan = '3 items in manifest manifest.txt'
+    job = Job().createJob(title='batch', type='test', user=admin, kwargs={
+        'params': params, 'cliTitle': 'test', 'userId': admin['_id'],
+        'cliItemId': str(cliItem._id)})
+    batch_job.getScheduler().add(batch_job.BatchJob(job, cliItem, handler, admin))
+    waitFor(lambda: len(subjobs) == 3)
+    assert [subjob['kwargs']['inputImageFile'] for subjob in subjobs] == [
+        image['largeImage']['fileId'] for image in expected]
+    assert 'inputImageFile_manifest' not in subjobs[0]['kwargs']
+    job = Job().load(job['_id'], force=True, includeLog=True)
+    assert any(line.startswith('Batch input inputImageFile: 3 entries from %s' % plan)
+               for line in job['log'])
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def test_batchManifestMissingItems(admin, folder, batchCLI):
+    cliItem, handler, subjobs = batchCLI
+    params = {'inputImageFile': '', 'inputImageFile_manifest': json.dumps([str(folder['_id'])])}
+    job = Job().createJob(title='batch', type='test', user=admin, kwargs={
+        'params': params, 'cliTitle': 'test', 'userId': admin['_id'],
+        'cliItemId': str(cliItem._id)})
+    batch_job.getScheduler().add(batch_job.BatchJob(job, cliItem, handler, admin))
+    waitFor(lambda: Job().load(job['_id'], force=True)['status'] == JobStatus.ERROR)
+    job = Job().load(job['_id'], force=True, includeLog=True)
+    assert '1 manifest entries are not usable image items' in job['log'][-1]
+    assert not subjobs
+
+
+@pytest.mark.plugin('slicer_cli_web')
+@pytest.mark.parametrize(('params', 'error'), [
+    ({'inputImageFile_folder': str(ObjectId())}, 'Batch input inputImageFile: No such folder'),
+    ({'inputImageFile_folder': 'not an id'}, 'Invalid ObjectId'),
+    ({'inputImageFile_manifest': '["not an id"]'}, 'must be a list of item ids'),
+    ({'inputImageFile_manifest': str(ObjectId())}, 'No such file'),
+])
+def test_batchInputsValidatedBeforeJob(admin, batchCLI, params, error):
+    cliItem, handler, subjobs = batchCLI
+    params = dict(params, inputImageFile='image')
+    numJobs = Job().collection.count_documents({})
+    with pytest.raises(RestException, match=error):
+        rest_slicer_cli.batchCLIJob(
+            cliItem, params, admin, 'test', handler.getBatchParams(params))
+    assert Job().collection.count_documents({}) == numJobs
+
+
+@pytest.mark.parametrize(('sweep', 'mode', 'values'), [
+    ({'gamma': [0.25, 0.5]}, None, {'gamma': ['0.25', '0.5']}),
+    ('{"gamma": {"start": 0.1, "stop": 0.3, "step": 0.1}}', None, {'gamma': ['0.1', '0.2', '0.3']}),
+    ({'gamma': {'start': 3, 'stop': 1, 'step': -1}}, 'zip', {'gamma': ['3', '2', '1']}),
+    ({'gamma': ['0.25', 1]}, 'product', {'gamma': ['0.25', '1']}),
+    ({'gamma': 0.25}, None, 'must be a non-empty list or a range'),
+    ({'gamma': {'start': 0, 'stop': 1, 'step': 0}}, None, 'must have numeric start'),
+    ({'gamma': {'start': 0, 'stop': 1e6, 'step': 1}}, None, 'must have between 1'),
+    ({'gamma': list(range(100001))}, None, 'at most 100000 combinations'),
+    ({'inputImageFile': ['a']}, None, 'cannot be swept'),
+    ({'outputStainImageFile_1': ['a']}, None, 'cannot be swept'),
+    ({'unknown': ['a']}, None, 'cannot be swept'),
+    ('[1]', None, 'must be a JSON object'),
+    ({'gamma': [1]}, 'other', 'must be one of product, zip'),
+])
+def test_batchSweep(sweep, mode, values):
+    xmlpath = os.path.join(os.path.dirname(__file__), 'data', 'ExampleSpec.xml')
+    table = get_parameter_table(open(xmlpath).read())
+    params = {'_sweep': sweep}
+    if mode:
+        params['_sweep_mode'] = mode
+    if isinstance(values, str):
+        with pytest.raises(RestException, match=values):
+            batch_job.batchSweep(params, table)
+    else:
+        assert batch_job.batchSweep(params, table) == (values, mode or 'product')
+
+
+def test_batchEntry():
+    sweep = {'b': ['1', '2'], 'a': ['x', 'y']}
+
+    def entries(inputs, sweep, mode):
+        count = batch_job.sweepEntryCount(inputs, sweep, mode)
+        return [batch_job.batchEntry(inputs, sweep, mode, idx) for idx in range(count)]
+
+    assert entries([['i', 'j']], {}, 'product') == [['i'], ['j']]
+    assert entries([], sweep, 'product') == [['x', '1'], ['x', '2'], ['y', '1'], ['y', '2']]
+    assert entries([['i', 'j']], sweep, 'product') == [
+        ['i', 'x', '1'], ['i', 'x', '2'], ['i', 'y', '1'], ['i', 'y', '2'],
+        ['j', 'x', '1'], ['j', 'x', '2'], ['j', 'y', '1'], ['j', 'y', '2']]
+    assert entries([['i', 'j']], sweep, 'zip') == [['i', 'x', '1'], ['j', 'y', '2']]
+    with pytest.raises(ValueError, match='zipped sweeps have 2 values'):
+        batch_job.sweepEntryCount([['i', 'j', 'k']], sweep, 'zip')
+    big = {'a': [str(idx) for idx in range(1000)], 'b': [str(idx) for idx in range(1000)]}
+    assert batch_job.sweepEntryCount([['i', 'j']], big, 'product') == 2000000
+    assert batch_job.batchEntry([['i', 'j']], big, 'product', 1999999) == ['j', '999', '999']
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def test_batchSweepJob(admin, folder, batchCLI):
+    cliItem, handler, subjobs = batchCLI
+    images = list(Item().find({'largeImage': {'$exists': True}}, sort=[('lowerName', 1)]))
+    params = {
+        'inputImageFile': '^image[01]$',
+        'inputImageFile_folder': str(folder['_id']),
+        '_sweep': json.dumps({'gamma': [0.25, 0.75]}),
+        '_concurrency': '8',
+    }
+    job = Job().createJob(title='batch', type='test', user=admin, kwargs={
+        'params': params, 'cliTitle': 'test', 'userId': admin['_id'],
+        'cliItemId': str(cliItem._id)})
+    batch_job.getScheduler().add(batch_job.BatchJob(job, cliItem, handler, admin))
+    waitFor(lambda: len(subjobs) == 4)
+    assert [(subjob['kwargs']['inputImageFile'], subjob['kwargs']['gamma'])
+            for subjob in subjobs] == [
+        (image['largeImage']['fileId'], gamma)
+        for image in images[:2] for gamma in ['0.25', '0.75']]
+    assert '_sweep' not in subjobs[0]['kwargs']
+    job = Job().load(job['_id'], force=True, includeLog=True)
+    assert 'Batch sweep of gamma (product): 4 entries\n' in job['log']
+    assert job[batch_job.BATCH_INPUTS_FIELD] == [
+        [image['largeImage']['fileId'] for image in images[:2]]]
+    assert job[batch_job.BATCH_SWEEP_FIELD] == {
+        'mode': 'product', 'values': {'gamma': ['0.25', '0.75']}}
+
+
+@pytest.mark.plugin('slicer_cli_web')
+@pytest.mark.parametrize('recursive', [False, True])
+def test_batchRecursive(admin, user, folder, batchCLI, recursive):
+    cliItem, handler, subjobs = batchCLI
+    folder = Folder().setPublic(folder, True, save=True)
+    case = Folder().createFolder(folder, 'case', public=True, creator=admin)
+    addImage('image8', admin, case)
+    nested = Folder().createFolder(case, 'nested', public=True, creator=admin)
+    addImage('image9', admin, nested)
+    private = Folder().createFolder(folder, 'private', public=False, creator=admin)
+    addImage('image10', admin, private)
+    hidden = Folder().createFolder(private, 'hidden', public=True, creator=admin)
+    addImage('image11', admin, hidden)
+    params = {
+        'inputImageFile': '^image',
+        'inputImageFile_folder': str(folder['_id']),
+        '_recursive': str(recursive).lower(),
+        '_concurrency': '20',
+    }
+    job = Job().createJob(title='batch', type='test', user=user, kwargs={
+        'params': params, 'cliTitle': 'test', 'userId': user['_id'],
+        'cliItemId': str(cliItem._id)})
+    batch_job.getScheduler().add(batch_job.BatchJob(job, cliItem, handler, user))
+    expected = 10 if recursive else 8
+    waitFor(lambda: len(subjobs) == expected)
+    images = {
+        image['largeImage']['fileId']: image['name'] for image in Item().find(
+            {'largeImage': {'$exists': True}})}
+    names = sorted(images[subjob['kwargs']['inputImageFile']] for subjob in subjobs)
+    assert names == sorted(['image%d' % idx for idx in range(expected)])
+    job = Job().load(job['_id'], force=True, includeLog=True)
+    if recursive:
+        assert any(line.endswith('and 2 subfolders\n') for line in job['log'])
+
+
+@pytest.mark.plugin('slicer_cli_web')
+@pytest.mark.parametrize('mode', ['product', 'zip'])
+def test_loadBatchEntries(server, admin, mode):
+    server.request('/system/version')
+    inputs = [['a', 'b', 'c', 'd'], ['e', 'f', 'g', 'h']]
+    sweep = {'gamma': ['1', '2'], 'x': ['p', 'q']}
+    if mode == 'zip':
+        sweep = {'gamma': ['1', '2', '3', '4'], 'x': ['p', 'q', 'r', 's']}
+    count = batch_job.sweepEntryCount(inputs, sweep, mode)
+    entries = list(range(1, count, 2))
+    job = Job().createJob(title='batch', type='test', user=admin, otherFields={
+        batch_job.BATCH_INPUTS_FIELD: inputs,
+        batch_job.BATCH_INPUT_KEYS_FIELD: ['in', 'other', 'gamma', 'x'],
+        batch_job.BATCH_SWEEP_FIELD: {'mode': mode, 'values': sweep},
+        batch_job.BATCH_ENTRIES_FIELD: entries})
+    assert batch_job.loadBatchEntries(job, []) == {}
+    assert batch_job.loadBatchEntries(job, [0, len(entries) - 1]) == {
+        idx: batch_job.batchEntry(inputs, sweep, mode, entries[idx])
+        for idx in [0, len(entries) - 1]}
+    Job().collection.update_one(
+        {'_id': job['_id']}, {'$unset': {batch_job.BATCH_ENTRIES_FIELD: True}})
+    assert batch_job.loadBatchEntries(job, range(count)) == {
+        idx: batch_job.batchEntry(inputs, sweep, mode, idx) for idx in range(count)}
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def test_batchJobIndex(server, admin, user, folder, batchCLI):
+    cliItem, handler, subjobs = batchCLI
+    params = {
+        'inputImageFile': 'image',
+        'inputImageFile_folder': str(folder['_id']),
+        '_concurrency': '8',
+    }
+    job = Job().createJob(title='batch', type='test', user=admin, public=True, kwargs={
+        'params': params, 'cliTitle': 'test', 'userId': admin['_id'],
+        'cliItemId': str(cliItem._id)})
+    batch_job.getScheduler().add(batch_job.BatchJob(job, cliItem, handler, admin))
+    waitFor(lambda: len(subjobs) == 8)
+    for idx in range(3):
+        subjob = Job().updateJob(Job().load(subjobs[idx]['_id'], force=True),
+                                 status=JobStatus.RUNNING)
+        Job().updateJob(subjob, status=JobStatus.SUCCESS if idx else JobStatus.ERROR)
+    waitFor(lambda: Job().load(job['_id'], force=True)[
+        batch_job.BATCH_PROGRESS_FIELD]['completed'] == 3)
+
+    resp = server.request('/slicer_cli_web/batch/%s/status' % job['_id'], user=admin)
+    assertStatusOk(resp)
+    assert resp.json == {
+        'status': JobStatus.RUNNING, 'total': 8, 'scheduled': 8, 'completed': 3,
+        'statuses': {str(JobStatus.INACTIVE): 5, str(JobStatus.SUCCESS): 2,
+                     str(JobStatus.ERROR): 1}}
+    resp = server.request('/slicer_cli_web/batch/%s/jobs' % job['_id'], user=admin, params={
+        'limit': 3, 'offset': 2})
+    assertStatusOk(resp)
+    assert [entry['_id'] for entry in resp.json] == [str(subjob['_id']) for subjob in subjobs[2:5]]
+    assert [entry['batchIndex'] for entry in resp.json] == [2, 3, 4]
+    assert resp.json[0]['inputs'] == {
+        'inputImageFile': subjobs[2]['kwargs']['inputImageFile']}
+    resp = server.request('/slicer_cli_web/batch/%s/jobs' % job['_id'], user=admin, params={
+        'status': JobStatus.SUCCESS})
+    assertStatusOk(resp)
+    assert [entry['_id'] for entry in resp.json] == [str(subjob['_id']) for subjob in subjobs[1:3]]
+    # other users can't see the jobs of a public batch
+    for path in ('status', 'jobs'):
+        resp = server.request('/slicer_cli_web/batch/%s/%s' % (job['_id'], path), user=user)
+        assertStatus(resp, 403)
+
+    for subjob in subjobs[3:]:
+        subjob = Job().updateJob(Job().load(subjob['_id'], force=True), status=JobStatus.RUNNING)
+        Job().updateJob(subjob, status=JobStatus.SUCCESS)
+    waitFor(lambda: Job().load(job['_id'], force=True)['status'] == JobStatus.SUCCESS)
+    job = Job().load(job['_id'], force=True, includeLog=True)
+    assert not any(line.startswith('Scheduling') for line in job['log'])
+    assert job['log'][-1] == 'Finished batch processing test - 8 jobs: 7 success, 1 error\n'
@@ -0,0 +1,96 @@
+import json
+import os
+
+from slicer_cli_web import cli_utils
+
+
+def read_file(name):
+    with open(os.path.join(os.path.dirname(__file__), 'data', name), 'rb') as f:
+        return f.read()
+
+
+def test_lru_cache():
+    cache = cli_utils.LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert len(cache) == 2
+    assert cache.pop('a') == 1
+    assert cache.get('a', 'missing') == 'missing'
+
+
+def test_ttl_cache():
+    cache = cli_utils.TTLCache(2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=-1)
+    assert cache.get('a') == 1
+    assert 'b' not in cache
+    assert cache.get('b', 'expired') == 'expired'
+    assert cache.pop('a') == 1
+    assert len(cache) == 0
+
+
+def test_normalize_param_value():
+    clim = cli_utils.as_model(read_file('ExampleSpec.xml'))
+    index_params, opt_params, _ = cli_utils.get_cli_parameters(clim)
+    params = {param.identifier(): param for param in index_params + opt_params}
+    normalize = cli_utils.normalize_param_value
+    assert normalize(params['gamma'], '1') == normalize(params['gamma'], '1.0') == 1.0
+    assert normalize(params['gamma'], 0.5) == normalize(params['gamma'], '0.5')
+    assert normalize(params['stainColor_1'], '[1, 0.5, 0]') == [1.0, 0.5, 0.0]
+    assert normalize(params['stainColor_1'], '1,0.5,0') == [1.0, 0.5, 0.0]
+    assert normalize(params['inputImageFile'], 'abc') == 'abc'
+    assert normalize(params['gamma'], 'abc') == 'abc'
+    assert normalize(params['gamma'], None) is None
+
+
+def test_as_model_is_cached():
+    xml = read_file('ExampleSpec.xml')
+    clim = cli_utils.as_model(xml)
+    assert cli_utils.as_model(xml.decode('utf8')) is clim
+    assert cli_utils.as_model(read_file('parser_simple.xml')) is not clim
+    assert cli_utils.xml_digest(xml) == cli_utils.xml_digest(xml.decode('utf8'))
+
+
+def test_get_cli_parameters_is_cached():
+    clim = cli_utils.as_model(read_file('ExampleSpec.xml'))
+    index_params, opt_params, simple_out_params = cli_utils.get_cli_parameters(clim)
+    assert [param.index for param in index_params] == sorted(
+        param.index for param in index_params)
+    index_params.pop()
+    again = cli_utils.get_cli_parameters(clim)
+    assert len(again[0]) == len(index_params) + 1
+    assert all(a is b for a, b in zip(again[1], opt_params))
+
+
+def test_parameter_plan():
+    xml = read_file('ExampleSpec.xml')
+    plan = json.loads(json.dumps(cli_utils.build_parameter_plan(xml)))
+    assert plan['version'] == cli_utils.PARAMETER_PLAN_VERSION
+
+    clim, index_params, opt_params, simple_out_params, batchable = \
+        cli_utils.load_parameter_plan(xml)
+    assert clim is cli_utils.as_model(xml)
+    planned = cli_utils.load_parameter_plan(xml, plan)
+    assert planned[0] is not clim
+    assert planned[0].title == clim.title
+    assert cli_utils.generate_description(planned[0]) == cli_utils.generate_description(clim)
+    for params, plannedParams in zip(
+            (index_params, opt_params, simple_out_params), planned[1:4]):
+        assert len(params) == len(plannedParams)
+        for param, plannedParam in zip(params, plannedParams):
+            for key in param.__slots__:
+                if key != 'constraints':
+                    assert getattr(param, key, None) == getattr(plannedParam, key, None)
+            assert plannedParam.isExternalType() == param.isExternalType()
+    assert planned[4] == batchable
+    assert 'inputImageFile' in batchable
+
+    # stale plans are ignored
+    plan['version'] -= 1
+    assert cli_utils.load_parameter_plan(xml, plan)[0] is clim
+    plan = cli_utils.build_parameter_plan(read_file('parser_simple.xml'))
+    assert cli_utils.load_parameter_plan(xml, plan)[0] is clim
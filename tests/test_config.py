@@ -20,3 +20,119 @@ def test_default_task_folder(server, admin, folder):
 
     assert PluginSettings.has_task_folder()
     assert PluginSettings.get_task_folder()['_id'] == folder['_id']
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def test_endpoint_settings(server, admin):
+    assert PluginSettings.get_lazy_endpoints() is False
+    resp = server.request('/system/setting', method='PUT', params={
+        'key': PluginSettings.SLICER_CLI_WEB_LAZY_ENDPOINTS,
+        'value': 'not a boolean'
+    }, user=admin)
+    assertStatus(resp, 400)
+    resp = server.request('/system/setting', method='PUT', params={
+        'key': PluginSettings.SLICER_CLI_WEB_LAZY_ENDPOINTS,
+        'value': 'true'
+    }, user=admin)
+    assertStatusOk(resp)
+    assert PluginSettings.get_lazy_endpoints() is True
+
+    resp = server.request('/system/setting', method='PUT', params={
+        'key': PluginSettings.SLICER_CLI_WEB_ENDPOINT_CACHE_SIZE,
+        'value': 0
+    }, user=admin)
+    assertStatus(resp, 400)
+    resp = server.request('/system/setting', method='PUT', params={
+        'key': PluginSettings.SLICER_CLI_WEB_ENDPOINT_CACHE_SIZE,
+        'value': 10
+    }, user=admin)
+    assertStatusOk(resp)
+    assert PluginSettings.get_endpoint_cache_size() == 10
+
+    assert PluginSettings.get_dispatch_endpoints() is False
+    resp = server.request('/system/setting', method='PUT', params={
+        'key': PluginSettings.SLICER_CLI_WEB_DISPATCH_ENDPOINTS,
+        'value': 'true'
+    }, user=admin)
+    assertStatusOk(resp)
+    assert PluginSettings.get_dispatch_endpoints() is True
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def test_batch_concurrency_setting(server, admin):
+    assert PluginSettings.get_batch_concurrency() == 0
+    resp = server.request('/system/setting', method='PUT', params={
+        'key': PluginSettings.SLICER_CLI_WEB_BATCH_CONCURRENCY,
+        'value': -1
+    }, user=admin)
+    assertStatus(resp, 400)
+    resp = server.request('/system/setting', method='PUT', params={
+        'key': PluginSettings.SLICER_CLI_WEB_BATCH_CONCURRENCY,
+        'value': 4
+    }, user=admin)
+    assertStatusOk(resp)
+    assert PluginSettings.get_batch_concurrency() == 4
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def test_datalist_cache_ttl_setting(server, admin):
+    assert PluginSettings.get_datalist_cache_ttl() == 300
+    resp = server.request('/system/setting', method='PUT', params={
+        'key': PluginSettings.SLICER_CLI_WEB_DATALIST_CACHE_TTL,
+        'value': 'soon'
+    }, user=admin)
+    assertStatus(resp, 400)
+    resp = server.request('/system/setting', method='PUT', params={
+        'key': PluginSettings.SLICER_CLI_WEB_DATALIST_CACHE_TTL,
+        'value': 0
+    }, user=admin)
+    assertStatusOk(resp)
+    assert PluginSettings.get_datalist_cache_ttl() == 0
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def test_pull_concurrency_setting(server, admin):
+    assert PluginSettings.get_pull_concurrency() == 4
+    resp = server.request('/system/setting', method='PUT', params={
+        'key': PluginSettings.SLICER_CLI_WEB_PULL_CONCURRENCY,
+        'value': 0
+    }, user=admin)
+    assertStatus(resp, 400)
+    resp = server.request('/system/setting', method='PUT', params={
+        'key': PluginSettings.SLICER_CLI_WEB_PULL_CONCURRENCY,
+        'value': 2
+    }, user=admin)
+    assertStatusOk(resp)
+    assert PluginSettings.get_pull_concurrency() == 2
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def test_run_many_max_setting(server, admin):
+    assert PluginSettings.get_run_many_max() == 1000
+    resp = server.request('/system/setting', method='PUT', params={
+        'key': PluginSettings.SLICER_CLI_WEB_RUN_MANY_MAX,
+        'value': 0
+    }, user=admin)
+    assertStatus(resp, 400)
+    resp = server.request('/system/setting', method='PUT', params={
+        'key': PluginSettings.SLICER_CLI_WEB_RUN_MANY_MAX,
+        'value': 50
+    }, user=admin)
+    assertStatusOk(resp)
+    assert PluginSettings.get_run_many_max() == 50
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def test_spec_extraction_setting(server, admin):
+    assert PluginSettings.get_spec_extraction() == 'run'
+    resp = server.request('/system/setting', method='PUT', params={
+        'key': PluginSettings.SLICER_CLI_WEB_SPEC_EXTRACTION,
+        'value': 'labels'
+    }, user=admin)
+    assertStatus(resp, 400)
+    resp = server.request('/system/setting', method='PUT', params={
+        'key': PluginSettings.SLICER_CLI_WEB_SPEC_EXTRACTION,
+        'value': 'files'
+    }, user=admin)
+    assertStatusOk(resp)
+    assert PluginSettings.get_spec_extraction() == 'files'
@@ -1,11 +1,24 @@
+import io
 import json
+import os
+import tarfile
+import threading
+import time
+import types
 
 import docker
 import pytest
+from girder.models.folder import Folder
+from girder.models.setting import Setting
 from girder_jobs.constants import JobStatus
+from girder_jobs.models.job import Job
 from pytest_girder.assertions import assertStatus
 from pytest_girder.utils import getResponseBody
 
+from slicer_cli_web import image_job
+from slicer_cli_web.config import PluginSettings
+from slicer_cli_web.models import DockerImageError, DockerImageItem, DockerImageNotFoundError
+
 from .conftest import splitName
 
 
@@ -62,6 +75,12 @@ def testDockerAddBadParam(server, admin, folder):
     assertStatus(resp, 400)
     assert 'does not have a tag' in resp.json['message']
 
+    kwargs['params']['name'] = json.dumps(['girder/slicer_cli_web:small'])
+    kwargs['params']['pull_concurrency'] = 0
+    resp = server.request(**kwargs)
+    assertStatus(resp, 400)
+    assert 'must be a positive integer' in resp.json['message']
+
 
 @pytest.mark.plugin('slicer_cli_web')
 def testDockerAddList(images):
@@ -183,3 +202,252 @@ def testAddBadImage(images):
     images.assertNoImages()
     images.addImage(img_name, JobStatus.ERROR)
     images.assertNoImages()
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def testPullDockerImageConcurrently(server):
+    lock = threading.Lock()
+    pulling = set()
+    peak = []
+
+    def pull(name, stream, decode):
+        with lock:
+            pulling.add(name)
+            peak.append(len(pulling))
+        yield {'id': 'layer', 'status': 'Downloading',
+               'progressDetail': {'current': 1, 'total': 2}}
+        time.sleep(0.05)
+        yield {'id': 'layer', 'status': 'Pull complete'}
+        with lock:
+            pulling.discard(name)
+
+    def get(name):
+        if name.startswith('missing'):
+            raise docker.errors.ImageNotFound(name)
+
+    client = types.SimpleNamespace(
+        api=types.SimpleNamespace(pull=pull), images=types.SimpleNamespace(get=get))
+    names = ['image%d:latest' % idx for idx in range(6)]
+    image_job.pullDockerImage(client, names, concurrency=3)
+    assert max(peak) == 3
+    peak[:] = []
+    with pytest.raises(DockerImageNotFoundError) as exc:
+        image_job.pullDockerImage(client, ['missing1:latest'] + names + ['missing2:latest'])
+    assert exc.value.imageName == ['missing1:latest', 'missing2:latest']
+    # the setting is used by default
+    assert max(peak) == 4
+
+    stats = {
+        'a': {'status': 'Downloading', 'current': 1, 'total': 4},
+        'b': {'status': 'Pull complete', 'total': 4},
+    }
+    assert image_job._pullProgressMessage(['one:latest', 'two:latest'], stats) == \
+        'Pulling 2 images (one:latest, two:latest): downloaded 5/8 (62.50%)'
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def testGetCliDataInOneContainer(server, admin):
+    specs = {
+        ('--list_cli', ): json.dumps({
+            'Example1': {'type': 'python'},
+            'Example2': {'type': 'python', 'desc-type': 'json'}}),
+        ('Example1', '--xml'): 'Loading\n<executable><title>1</title></executable>\n',
+        ('Example2', '--json'): 'Loading\n{"title": "2"}\n',
+    }
+    containers = []
+
+    class Container:
+        status = 'created'
+
+        def __init__(self, **kwargs):
+            self.kwargs = kwargs
+            self.commands = []
+            self.removed = False
+            containers.append(self)
+
+        def start(self):
+            self.status = 'running'
+
+        def reload(self):
+            pass
+
+        def exec_run(self, cmd, stdout, stderr):
+            self.commands.append(cmd)
+            assert cmd[:2] == ['python', 'cli_list.py']
+            return 0, specs[tuple(cmd[2:])].encode()
+
+        def remove(self, force=False):
+            self.removed = True
+
+    def get(name):
+        return types.SimpleNamespace(attrs={'Config': {'Entrypoint': entrypoint}})
+
+    entrypoint = ['python', 'cli_list.py']
+    client = types.SimpleNamespace(
+        images=types.SimpleNamespace(get=get),
+        containers=types.SimpleNamespace(create=lambda **kwargs: Container(**kwargs)))
+    server.request('/system/version')
+    job = Job().createJob(title='load', type='load', user=admin)
+    cli_dict = image_job.getCliData('image:latest', client, job)
+    assert cli_dict == {
+        'Example1': {'type': 'python', 'xml': '<executable><title>1</title></executable>'},
+        'Example2': {'type': 'python', 'desc-type': 'json', 'json': '{"title": "2"}'},
+    }
+    assert len(containers) == 1
+    assert len(containers[0].commands) == 3
+    assert containers[0].removed
+
+    # without an entrypoint, each command is run in its own container
+    entrypoint = None
+    runs = []
+
+    def getDockerOutput(imgName, command, client):
+        runs.append(command)
+        return specs[(command, ) if isinstance(command, str) else tuple(command)]
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(image_job, 'getDockerOutput', getDockerOutput)
+        assert image_job.getCliData('image:latest', client, job) == cli_dict
+    assert len(containers) == 1
+    assert len(runs) == 3
+
+    # exec failures name the image
+    cont = types.SimpleNamespace(exec_run=lambda cmd, stdout, stderr: (1, b''))
+    with pytest.raises(DockerImageError, match=r'image name: image:latest'):
+        image_job.getExecOutput('image:latest', cont, ['python'], '--list_cli')
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def testSkipUnchangedImages(server, admin, folder, monkeypatch):
+    server.request('/system/version')
+    xmlpath = os.path.join(os.path.dirname(__file__), 'data', 'ExampleSpec.xml')
+    cli_dict = {'Example1': {'type': 'python', 'xml': open(xmlpath).read()}}
+    dockerImage = types.SimpleNamespace(
+        id='sha256:1', labels={}, attrs={'RepoDigests': ['image@sha256:abc']})
+    extracted = []
+
+    def getCliData(name, client, job):
+        extracted.append(name)
+        return cli_dict
+
+    monkeypatch.setattr(image_job, 'getCliData', getCliData)
+    client = types.SimpleNamespace(
+        api=types.SimpleNamespace(pull=lambda name, stream, decode: iter([])),
+        images=types.SimpleNamespace(get=lambda name: dockerImage),
+        close=lambda: None)
+    monkeypatch.setattr(image_job.docker, 'from_env', lambda version: client)
+
+    def load(force=False):
+        job = Job().createJob(
+            title='load', type='load', user=admin,
+            kwargs={'nameList': ['image:latest'], 'folder': folder['_id'], 'pull': 'true',
+                    'force': force})
+        image_job.jobPullAndLoad(job)
+        return Job().load(job['_id'], force=True, includeLog=True)
+
+    assert load()['status'] == JobStatus.SUCCESS
+    assert extracted == ['image:latest']
+    image = DockerImageItem.findUnchanged('image:latest', dockerImage, admin, folder)
+    assert image.tagFolder['meta']['imageId'] == 'sha256:1'
+    assert [cli.name for cli in image.getCLIs()] == ['Example1']
+    # pulling the same image again doesn't extract or save anything
+    job = load()
+    assert job['status'] == JobStatus.SUCCESS
+    assert 'Skipping unchanged images\nimage:latest\n' in job['log']
+    assert extracted == ['image:latest']
+    # unless this is forced
+    job = load(force=True)
+    assert 'Skipping unchanged images' not in job['log']
+    assert extracted == ['image:latest'] * 2
+    # a changed image is extracted again
+    dockerImage.id = 'sha256:2'
+    assert load()['status'] == JobStatus.SUCCESS
+    assert extracted == ['image:latest'] * 3
+    # tag folders without an image id are compared by digest
+    Folder().setMetadata(image.tagFolder, {'imageId': None})
+    assert DockerImageItem.findUnchanged('image:latest', dockerImage, admin, folder)
+    dockerImage.attrs['RepoDigests'] = ['image@sha256:def']
+    assert not DockerImageItem.findUnchanged('image:latest', dockerImage, admin, folder)
+    # an image that can't be checked is treated as changed
+    dockerImage.id = 'sha256:1'
+    Folder().setMetadata(image.tagFolder, {'imageId': 'sha256:1'})
+
+    def findUnchanged(*args):
+        raise Exception('Cannot check')
+
+    monkeypatch.setattr(DockerImageItem, 'findUnchanged', findUnchanged)
+    assert load()['status'] == JobStatus.SUCCESS
+    assert extracted == ['image:latest'] * 4
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def testGetCliDataFromFiles(server, admin):
+    server.request('/system/version')
+    Setting().set(PluginSettings.SLICER_CLI_WEB_SPEC_EXTRACTION, 'files')
+    files = {
+        '/opt/cli_list.json': json.dumps({
+            'Example1': {'type': 'python'},
+            'Example1json': {'type': 'python', 'alias': 'Example1', 'desc-type': 'json'},
+            'Compiled': {'type': 'cxx'}}),
+        '/opt/Example1/Example1.xml': '<executable><title>1</title></executable>\n',
+        '/opt/Example1/Example1.json': '{"title": "1"}\n',
+    }
+    containers = []
+
+    class Container:
+        status = 'created'
+
+        def __init__(self, **kwargs):
+            self.kwargs = kwargs
+            self.commands = []
+            containers.append(self)
+
+        def start(self):
+            self.status = 'running'
+
+        def reload(self):
+            pass
+
+        def get_archive(self, path):
+            assert self.status == 'created'
+            if path not in files:
+                raise docker.errors.NotFound(path)
+            data = files[path].encode()
+            output = io.BytesIO()
+            with tarfile.open(fileobj=output, mode='w') as archive:
+                info = tarfile.TarInfo(os.path.basename(path))
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+            return iter([output.getvalue()]), {}
+
+        def exec_run(self, cmd, stdout, stderr):
+            self.commands.append(cmd)
+            assert cmd == ['./cli_list.py', 'Compiled', '--xml']
+            return 0, b'<executable><title>2</title></executable>'
+
+        def remove(self, force=False):
+            pass
+
+    client = types.SimpleNamespace(
+        images=types.SimpleNamespace(get=lambda name: types.SimpleNamespace(attrs={
+            'Config': {'Entrypoint': ['./cli_list.py'], 'WorkingDir': '/opt'}})),
+        containers=types.SimpleNamespace(create=lambda **kwargs: Container(**kwargs)))
+    job = Job().createJob(title='load', type='load', user=admin)
+    cli_dict = image_job.getCliData('image:latest', client, job)
+    assert cli_dict['Example1']['xml'] == '<executable><title>1</title></executable>'
+    assert cli_dict['Example1json']['json'] == '{"title": "1"}'
+    assert cli_dict['Compiled']['xml'] == '<executable><title>2</title></executable>'
+    # only the CLI without a spec file is run
+    assert len(containers) == 2
+    assert containers[0].status == 'created'
+    assert containers[1].commands == [['./cli_list.py', 'Compiled', '--xml']]
+    job = Job().load(job['_id'], force=True, includeLog=True)
+    assert 'Read the cli list of image image:latest from cli_list.json\n' in job['log']
+
+    # with every spec in a file, the image is never run
+    del files['/opt/cli_list.json']
+    files['/opt/slicer_cli_list.json'] = json.dumps({'Example1': {'type': 'python'}})
+    containers[:] = []
+    assert list(image_job.getCliData('image:latest', client, job)) == ['Example1']
+    assert len(containers) == 1
+    assert containers[0].status == 'created'
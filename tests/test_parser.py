@@ -3,6 +3,7 @@ import re
 
 import pytest
 
+from slicer_cli_web.cli_utils import PARAMETER_PLAN_VERSION
 from slicer_cli_web.models.parser import parse_json_desc, parse_xml_desc, parse_yaml_desc
 
 
@@ -53,6 +54,7 @@ class TestParserSimple:
         assert meta.get('acknowledgements') == 'A'
 
         assert item.get('description') == '**T**\n\nD'
+        assert meta['parameterPlan']['version'] == PARAMETER_PLAN_VERSION
 
         files = list(Item().childFiles(item))
         assert len(files) == 1
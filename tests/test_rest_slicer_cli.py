@@ -2,17 +2,24 @@ import functools
 import json
 import os
 import time
+import types
 
 import cherrypy
 import pytest
-from girder.api import rest
+from girder import events
+from girder.api import docs, rest
 from girder.models.collection import Collection
+from girder.models.file import File
 from girder.models.folder import Folder
 from girder.models.item import Item
+from girder.models.setting import Setting
 from girder.models.token import Token
-from pytest_girder.assertions import assertStatusOk
+from girder_jobs.constants import JobStatus
+from girder_jobs.models.job import Job
+from pytest_girder.assertions import assertStatus, assertStatusOk
 
-from slicer_cli_web import docker_resource, rest_slicer_cli
+from slicer_cli_web import docker_resource, prepare_task, rest_slicer_cli
+from slicer_cli_web.config import PluginSettings
 from slicer_cli_web.models import CLIItem
 
 
@@ -87,6 +94,57 @@ def test_genHandlerToRunDockerCLI(folder, file, handlerFunc):
     assert container_args[0] == 'data'
 
 
+@pytest.mark.plugin('slicer_cli_web')
+def test_inputsLoadedOnce(folder, file, handlerFunc, monkeypatch):
+    loads = []
+    origLoad = File.load
+
+    def load(self, id, *args, **kwargs):
+        loads.append(str(id))
+        return origLoad(self, id, *args, **kwargs)
+
+    monkeypatch.setattr(File, 'load', load)
+    job = handlerFunc(params={
+        'inputImageFile': str(file['_id']),
+        'secondImageFile': str(file['_id']),
+        'outputStainImageFile_1_folder': str(folder['_id']),
+        'outputStainImageFile_1': 'sample1.png',
+        'outputStainImageFile_2_folder': str(folder['_id']),
+        'outputStainImageFile_2_name': 'sample2.png',
+        'stainColor_1': '[0.5, 0.5, 0.5]',
+        'stainColor_2': '[0.2, 0.3, 0.4]',
+        'returnparameterfile_folder': str(folder['_id']),
+        'returnparameterfile': 'output.data',
+    })
+    # The inputs are fetched with one query rather than loaded per use
+    assert str(file['_id']) not in loads
+    kwargs = json.loads(job['kwargs'])
+    assert str(file['_id']) in repr(kwargs['container_args'])
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def test_jobSavedOnce(folder, file, handlerFunc):
+    saved = []
+    with events.bound('model.job.save.after', 'test_jobSavedOnce',
+                      lambda event: saved.append(event.info['_id'])):
+        job = handlerFunc(params={
+            'inputImageFile': str(file['_id']),
+            'secondImageFile': str(file['_id']),
+            'outputStainImageFile_1_folder': str(folder['_id']),
+            'outputStainImageFile_1': 'sample1.png',
+            'outputStainImageFile_2_folder': str(folder['_id']),
+            'outputStainImageFile_2_name': 'sample2.png',
+            'stainColor_1': '[0.5, 0.5, 0.5]',
+            'stainColor_2': '[0.2, 0.3, 0.4]',
+            'returnparameterfile_folder': str(folder['_id']),
+            'returnparameterfile': 'output.data',
+        })
+    assert saved == [job['_id']]
+    assert job['_original_name'] == 'data'
+    assert Job().load(job['_id'], force=True)['_original_params']['stainColor_1'] == (
+        '[0.5, 0.5, 0.5]')
+
+
 @pytest.mark.plugin('slicer_cli_web')
 def test_get_matching_resource(server, admin):
     # Make some resources
@@ -223,6 +281,7 @@ def test_girderApiUrl(handlerFunc, folder, file):
 @pytest.mark.plugin('slicer_cli_web')
 def test_templateParams(handlerFunc, folder, file, testParams, results):
     os.environ['SLICER_CLI_WEB_GAMMA'] = '0.4'
+    prepare_task._resetEnvironmentTemplateParams()
     job = handlerFunc(params=dict({
         'inputImageFile': str(file['_id']),
         'secondImageFile': str(file['_id']),
@@ -269,3 +328,310 @@ def test_genHandlerToReRunDockerCLI(folder, file, handlerRerunFuncs):
     assert kwargs['pull_image'] == 'if-not-present'
     container_args = kwargs['container_args']
     assert container_args[0] == 'data'
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def test_runMany(server, admin, folder, file, monkeypatch):
+    server.request('/system/version')
+    rest.setCurrentUser(admin)
+    cherrypy.request.params['token'] = Token().createToken(admin)['_id']
+
+    xmlpath = os.path.join(os.path.dirname(__file__), 'data', 'ExampleSpec.xml')
+    girderCLIItem = Item().createItem('data', admin, folder)
+    Item().setMetadata(girderCLIItem, dict(
+        slicerCLIType='task', type='python', image='dockerImage',
+        digest='dockerImage@sha256:abc', xml=open(xmlpath, 'rb').read()))
+    itemId = str(girderCLIItem['_id'])
+    resource = docker_resource.DockerResource('test')
+
+    params = {
+        'inputImageFile': str(file['_id']),
+        'secondImageFile': str(file['_id']),
+        'outputStainImageFile_1_folder': str(folder['_id']),
+        'outputStainImageFile_1': 'sample1.png',
+        'outputStainImageFile_2_folder': str(folder['_id']),
+        'outputStainImageFile_2_name': 'sample2.png',
+        'stainColor_1': '[0.5, 0.5, 0.5]',
+        'stainColor_2': '[0.2, 0.3, 0.4]',
+        'returnparameterfile_folder': str(folder['_id']),
+        'returnparameterfile': 'output.data',
+    }
+    monkeypatch.setattr(resource, 'getBodyJson', lambda: [
+        params, dict(params, stainColor_1=[0.1, 0.2, 0.3])])
+    jobIds = resource.handleRoute('POST', ('cli', itemId, 'run_many'), {})
+    assert len(jobIds) == 2
+    jobs = [Job().load(jobId, force=True) for jobId in jobIds]
+    assert jobs[0]['_original_params'] == params
+    assert jobs[0]['_original_name'] == 'data'
+    assert jobs[0]['celeryTaskId'] != jobs[1]['celeryTaskId']
+    assert (jobs[0]['jobInfoSpec']['headers']['Girder-Token'] !=
+            jobs[1]['jobInfoSpec']['headers']['Girder-Token'])
+    assert jobs[0]['userId'] == admin['_id']
+    assert jobs[0]['kwargs']['container_args'][0] == 'data'
+    assert '0.1, 0.2, 0.3' in repr(jobs[1]['kwargs']['container_args'])
+    assert jobs[1]['title'] == 'Performs Adaptive Color Deconvolution on Sample'
+
+    # if any parameter set is invalid, no jobs are created
+    numJobs = Job().collection.count_documents({})
+    monkeypatch.setattr(resource, 'getBodyJson', lambda: [
+        params, dict(params, inputImageFile=str(folder['_id']))])
+    with pytest.raises(rest.RestException, match='Parameter set 1: Invalid file id'):
+        resource.handleRoute('POST', ('cli', itemId, 'run_many'), {})
+    assert Job().collection.count_documents({}) == numJobs
+
+    # too many parameter sets are refused before any are validated
+    Setting().set(PluginSettings.SLICER_CLI_WEB_RUN_MANY_MAX, 2)
+    monkeypatch.setattr(resource, 'getBodyJson', lambda: [params] * 3)
+    with pytest.raises(rest.RestException, match='At most 2 parameter sets'):
+        resource.handleRoute('POST', ('cli', itemId, 'run_many'), {})
+    assert Job().collection.count_documents({}) == numJobs
+    resource.deleteImageEndpoints()
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def test_lazyEndpoints(server, admin, folder, file):
+    server.request('/system/version')
+    rest.setCurrentUser(admin)
+    cherrypy.request.params['token'] = Token().createToken(admin)['_id']
+    Setting().set(PluginSettings.SLICER_CLI_WEB_LAZY_ENDPOINTS, True)
+
+    xmlpath = os.path.join(os.path.dirname(__file__), 'data', 'ExampleSpec.xml')
+    girderCLIItem = Item().createItem('data', admin, folder)
+    Item().setMetadata(girderCLIItem, dict(
+        slicerCLIType='task', type='python', image='dockerImage',
+        digest='dockerImage@sha256:abc', xml=open(xmlpath, 'rb').read()))
+
+    resource = docker_resource.DockerResource('test')
+    assert resource.lazyEndpoints
+    assert len(resource.handlerCache) == 0
+    runHandler = resource.getRouteHandler('POST', ('cli', str(girderCLIItem['_id']), 'run'))
+    resource.getRouteHandler('POST', ('dockerImage', 'data', 'rerun'))
+    assert len(resource.handlerCache) == 0
+
+    job = runHandler(params={
+        'inputImageFile': str(file['_id']),
+        'secondImageFile': str(file['_id']),
+        'outputStainImageFile_1_folder': str(folder['_id']),
+        'outputStainImageFile_1': 'sample1.png',
+        'outputStainImageFile_2_folder': str(folder['_id']),
+        'outputStainImageFile_2_name': 'sample2.png',
+        'stainColor_1': '[0.5, 0.5, 0.5]',
+        'stainColor_2': '[0.2, 0.3, 0.4]',
+        'returnparameterfile_folder': str(folder['_id']),
+        'returnparameterfile': 'output.data',
+    })
+    assert len(resource.handlerCache) == 1
+    kwargs = json.loads(job['kwargs'])
+    assert kwargs['image'] == 'dockerImage@sha256:abc'
+    assert kwargs['container_args'][0] == 'data'
+
+    resource.deleteImageEndpoints()
+    assert len(resource.handlerCache) == 0
+    with pytest.raises(Exception, match='Could not find route'):
+        resource.getRouteHandler('POST', ('cli', str(girderCLIItem['_id']), 'run'))
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def test_incrementalRefresh(server, admin, folder):
+    xmlpath = os.path.join(os.path.dirname(__file__), 'data', 'ExampleSpec.xml')
+    xml = open(xmlpath, 'rb').read()
+
+    def makeItem(image, name='data', parent=folder):
+        item = Item().createItem(name, admin, parent)
+        return Item().setMetadata(item, dict(
+            slicerCLIType='task', type='python', image=image, xml=xml))
+
+    itemA = makeItem('imageA:latest')
+    makeItem('imageB:latest', parent=Folder().createFolder(folder, 'B'))
+    resource = docker_resource.DockerResource('test')
+    handlerA = resource.getRouteHandler('POST', ('cli', str(itemA['_id']), 'run'))
+    handlerB = resource.getRouteHandler('POST', ('imageB_latest', 'data', 'run'))
+
+    newItemA = makeItem('imageA:latest', 'other')
+    job = {
+        'type': resource.jobType,
+        'status': JobStatus.SUCCESS,
+        'kwargs': {'nameList': ['imageA:latest']},
+    }
+    resource.addRestEndpoints(events.Event('jobs.job.update.after', {'job': job}))
+    # the endpoints of the unaffected image are untouched
+    assert resource.getRouteHandler('POST', ('imageB_latest', 'data', 'run')) is handlerB
+    assert resource.getRouteHandler('POST', ('cli', str(itemA['_id']), 'run')) is not handlerA
+    resource.getRouteHandler('POST', ('cli', str(newItemA['_id']), 'run'))
+    resource.getRouteHandler('POST', ('imageA_latest', 'other', 'run'))
+
+    # a second item of the same image doesn't leave stale routes behind
+    dupItemA = makeItem('imageA:latest', parent=Folder().createFolder(folder, 'dup'))
+    job['kwargs'] = {'nameList': ['imageA:latest']}
+    resource.addRestEndpoints(events.Event('jobs.job.update.after', {'job': job}))
+    Item().remove(dupItemA)
+    Item().remove(itemA)
+    job['kwargs'] = {'deleteList': ['imageA:latest']}
+    resource.addRestEndpoints(events.Event('jobs.job.update.after', {'job': job}))
+    with pytest.raises(Exception, match='Could not find route'):
+        resource.getRouteHandler('POST', ('imageA_latest', 'data', 'run'))
+    with pytest.raises(Exception, match='Could not find route'):
+        resource.getRouteHandler('POST', ('cli', str(dupItemA['_id']), 'run'))
+    resource.getRouteHandler('POST', ('imageA_latest', 'other', 'run'))
+    assert resource.getRouteHandler('POST', ('imageB_latest', 'data', 'run')) is handlerB
+    resource.deleteImageEndpoints()
+
+
+@pytest.mark.plugin('slicer_cli_web')
+@pytest.mark.parametrize('lazy', [False, True])
+def test_dispatchEndpoints(server, admin, folder, file, lazy):
+    server.request('/system/version')
+    rest.setCurrentUser(admin)
+    cherrypy.request.params['token'] = Token().createToken(admin)['_id']
+    Setting().set(PluginSettings.SLICER_CLI_WEB_DISPATCH_ENDPOINTS, True)
+    Setting().set(PluginSettings.SLICER_CLI_WEB_LAZY_ENDPOINTS, lazy)
+
+    xmlpath = os.path.join(os.path.dirname(__file__), 'data', 'ExampleSpec.xml')
+    girderCLIItem = Item().createItem('data', admin, folder)
+    Item().setMetadata(girderCLIItem, dict(
+        slicerCLIType='task', type='python', image='dockerImage',
+        digest='dockerImage@sha256:abc', xml=open(xmlpath, 'rb').read()))
+    itemId = str(girderCLIItem['_id'])
+
+    resource = docker_resource.DockerResource('test')
+    numRoutes = sum(len(routes) for routes in resource._routes['post'].values())
+    # the item has no routes of its own
+    resource.getRouteHandler('POST', ('cli', ':id', ':action'))
+    with pytest.raises(Exception, match='Could not find route'):
+        resource.getRouteHandler('POST', ('cli', itemId, 'run'))
+    # the API documentation is built when requested
+    assert '/test/cli/%s/run' % itemId not in docs.routes['test']
+    resource.describeDeferredRoutes()
+    assert ('/test/cli/%s/run' % itemId in docs.routes['test']) is not lazy
+
+    params = {
+        'inputImageFile': str(file['_id']),
+        'secondImageFile': str(file['_id']),
+        'outputStainImageFile_1_folder': str(folder['_id']),
+        'outputStainImageFile_1': 'sample1.png',
+        'outputStainImageFile_2_folder': str(folder['_id']),
+        'outputStainImageFile_2_name': 'sample2.png',
+        'stainColor_1': '[0.5, 0.5, 0.5]',
+        'stainColor_2': '[0.2, 0.3, 0.4]',
+        'returnparameterfile_folder': str(folder['_id']),
+        'returnparameterfile': 'output.data',
+    }
+    job = resource.handleRoute('POST', ('cli', itemId, 'run'), dict(params))
+    assert json.loads(job['kwargs'])['container_args'][0] == 'data'
+    job = resource.handleRoute('POST', ('dockerImage', 'data', 'run'), dict(params))
+    assert json.loads(job['kwargs'])['container_args'][0] == 'data'
+    resource.describeDeferredRoutes()
+    assert '/test/cli/%s/run' % itemId in docs.routes['test']
+    assert len(resource.handlerCache) == (1 if lazy else 0)
+    with pytest.raises(rest.RestException, match='Unknown CLI action'):
+        resource.handleRoute('POST', ('cli', itemId, 'other'), {})
+    with pytest.raises(rest.RestException, match='does not have a datalist'):
+        resource.handleRoute('POST', ('cli', itemId, 'datalist', 'other'), {})
+
+    resource.deleteImageEndpoints()
+    assert sum(len(routes) for routes in resource._routes['post'].values()) == numRoutes
+    assert '/test/cli/%s/run' % itemId not in docs.routes['test']
+    with pytest.raises(rest.RestException, match='No such CLI'):
+        resource.handleRoute('POST', ('cli', itemId, 'run'), dict(params))
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def test_deferredDocs(server, admin, folder):
+    xmlpath = os.path.join(os.path.dirname(__file__), 'data', 'ExampleSpec.xml')
+    items = []
+    for name in ('data', 'other'):
+        item = Item().createItem(name, admin, folder)
+        items.append(Item().setMetadata(item, dict(
+            slicerCLIType='task', type='python', image='dockerImage:latest',
+            xml=open(xmlpath, 'rb').read())))
+    handlers = [rest_slicer_cli.genHandlerToRunDockerCLI(CLIItem(item)) for item in items]
+    # identical specs share their parameters
+    assert handlers[0].parameterTable is handlers[1].parameterTable
+    assert handlers[0].description is None
+
+    resource = docker_resource.DockerResource('test')
+    path = '/test/cli/%s/rerun' % items[0]['_id']
+    assert path not in docs.routes['test']
+    with events.bound('rest.get.describe.before', 'test', resource.describeDeferredRoutes):
+        resp = server.request('/describe', user=admin)
+    assertStatusOk(resp)
+    assert path in resp.json['paths']
+    assert not resource.deferredDocs
+    params = [param['name'] for param in docs.routes['test'][path]['POST']['parameters']]
+    assert params[0] == 'jobId'
+    assert 'inputImageFile' in params
+    assert '/test/dockerImage_latest/data/run' in docs.routes['test']
+
+    resource.deleteImageEndpoints()
+    assert path not in docs.routes['test']
+
+
+@pytest.mark.plugin('slicer_cli_web')
+def test_datalistHandler(server, admin, user, folder, file):
+    server.request('/system/version')
+    rest.setCurrentUser(admin)
+    xmlpath = os.path.join(os.path.dirname(__file__), 'data', 'ExampleSpec.xml')
+    girderCLIItem = Item().createItem('data', admin, folder)
+    Item().setMetadata(girderCLIItem, dict(
+        slicerCLIType='task', type='python', image='dockerImage',
+        digest='dockerImage@sha256:abc', xml=open(xmlpath, 'rb').read()))
+    cliItem = CLIItem(girderCLIItem)
+    cliHandler = rest_slicer_cli.genHandlerToRunDockerCLI(cliItem)
+    jobs = []
+
+    def subHandler(currentItem, params, user, token, datalist, otherFields=None):
+        job = Job().createJob(
+            title='datalist', type='datalist', user=user, otherFields=otherFields)
+        jobs.append(job)
+        return types.SimpleNamespace(job=job)
+
+    datalist = {'stainColor_2': None}
+    handler = functools.partial(rest_slicer_cli._genDatalistHandler(
+        str(girderCLIItem['_id']), subHandler, cliHandler.datalistKey, datalist),
+        docker_resource.DockerResource('test'))
+    rest_slicer_cli._datalistResults.clear()
+    rest_slicer_cli._datalistJobs.clear()
+
+    # the job handle is returned if the job doesn't finish in time
+    result = handler({'stainColor_1': '[1, 1, 1]', '_wait': '0'})
+    assert result == {'jobId': str(jobs[0]['_id']), 'status': JobStatus.INACTIVE}
+    # a request for the same values waits for the same job
+    assert handler({'stainColor_1': '[1, 1, 1]', '_wait': '0'})['jobId'] == result['jobId']
+    assert len(jobs) == 1
+    job = Job().updateJob(jobs[0], log='listing\n<element>a</element>\n', status=JobStatus.RUNNING)
+    Job().updateJob(job, log='<element>b</element>\ndone', status=JobStatus.SUCCESS)
+    resp = server.request('/slicer_cli_web/datalist/%s' % result['jobId'], user=admin)
+    assertStatusOk(resp)
+    assert resp.json == '<element>a</element>\n<element>b</element>'
+    # the values are cached
+    assert handler({'stainColor_1': '[1, 1, 1]'}) == resp.json
+    assert len(jobs) == 1
+    # once the values expire, a new job lists them again
+    rest_slicer_cli._datalistResults.clear()
+    assert handler({'stainColor_1': '[1, 1, 1]', '_wait': '0'})['jobId'] == str(jobs[1]['_id'])
+    # without a cache ttl, every call lists the values again
+    Setting().set(PluginSettings.SLICER_CLI_WEB_DATALIST_CACHE_TTL, 0)
+    for idx in range(2):
+        job = Job().updateJob(jobs[-1], status=JobStatus.RUNNING)
+        Job().updateJob(job, log='<element>c</element>', status=JobStatus.SUCCESS)
+        result = handler({'stainColor_1': '[1, 1, 1]', '_wait': '0'})
+        assert len(jobs) == 3 + idx
+        assert result['jobId'] == str(jobs[-1]['_id'])
+    Setting().set(PluginSettings.SLICER_CLI_WEB_DATALIST_CACHE_TTL, 300)
+    # different values start a new job
+    assert handler({'stainColor_1': '[0, 0, 0]', '_wait': '0'})['jobId'] == str(jobs[-1]['_id'])
+    with pytest.raises(rest.RestException, match='must be a number'):
+        handler({'_wait': 'soon'})
+    resp = server.request('/slicer_cli_web/datalist/%s' % jobs[-1]['_id'], user=user)
+    assertStatus(resp, 403)
+    other = Job().createJob(title='other', type='other', user=admin)
+    resp = server.request('/slicer_cli_web/datalist/%s' % other['_id'], user=admin)
+    assertStatus(resp, 400)
+
+    # keys only depend on the user when Girder resources are passed
+    params = {'stainColor_1': '[1, 1, 1]'}
+    assert cliHandler.datalistKey(cliItem, params, admin, datalist) == \
+        cliHandler.datalistKey(cliItem, params, user, datalist)
+    params['inputImageFile'] = str(file['_id'])
+    assert cliHandler.datalistKey(cliItem, params, admin, datalist) != \
+        cliHandler.datalistKey(cliItem, params, user, datalist)
@@ -0,0 +1,360 @@
+# Benchmark how endpoint generation scales with the number of CLIs.
+#
+# This requires a MongoDB server; the database named in the uri is dropped
+# and recreated for every catalog size.  The uri defaults to a scratch
+# database rather than GIRDER_MONGO_URI, and only empty databases or ones
+# this script created are dropped.  For example:
+#
+#   python utils/benchmark_catalog.py --sizes 10,100,1000 --mode lazy
+#
+# Add --memory to report the memory retained per CLI.
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+DEFAULT_URI = 'mongodb://localhost:27017/slicer_cli_web_benchmark'
+# The collection that marks a database as created by this script
+MARKER_COLLECTION = 'slicer_cli_web_benchmark'
+DEFAULT_SIZES = '10,100,1000,10000'
+MODES = ('eager', 'lazy', 'dispatch', 'lazy+dispatch')
+
+# By default, each CLI gets its own copy of this spec with a distinct title,
+# so that no parsing can be shared between CLIs.  It has the same mix of
+# parameters as a typical analysis CLI, including a datalist parameter.
+CLI_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<executable>
+  <category>Benchmark</category>
+  <title>Benchmark CLI {index}</title>
+  <description>A synthetic CLI used to benchmark endpoint generation.</description>
+  <version>0.1.0</version>
+  <license>Apache 2.0</license>
+  <contributor>Benchmark</contributor>
+  <parameters>
+    <label>IO</label>
+    <description>Input/output parameters</description>
+    <image reference="_girder_id_">
+      <name>inputImageFile</name>
+      <label>Input Image</label>
+      <description>Input image</description>
+      <channel>input</channel>
+      <index>0</index>
+    </image>
+    <region>
+      <name>analysisRegion</name>
+      <label>Analysis ROI</label>
+      <description>Region of interest as left, top, width, height</description>
+      <longflag>analysis_roi</longflag>
+      <default>-1,-1,-1,-1</default>
+    </region>
+    <string datalist='{{"stain": "__datalist__", "inputImageFile": "skip"}}'>
+      <name>stain</name>
+      <label>Stain</label>
+      <description>Name of the stain; the options are listed by the CLI</description>
+      <longflag>stain</longflag>
+      <default>hematoxylin</default>
+    </string>
+    <string-enumeration>
+      <name>method</name>
+      <label>Method</label>
+      <description>Detection method</description>
+      <longflag>method</longflag>
+      <element>watershed</element>
+      <element>threshold</element>
+      <default>watershed</default>
+    </string-enumeration>
+    <image fileExtensions=".anot" reference="inputImageFile">
+      <name>outputAnnotationFile</name>
+      <label>Output Annotation File</label>
+      <description>Output annotation file</description>
+      <channel>output</channel>
+      <index>1</index>
+    </image>
+  </parameters>
+  <parameters advanced="true">
+    <label>Options</label>
+    <description>Processing options</description>
+    <double-vector>
+      <name>stainColor</name>
+      <label>Stain Color</label>
+      <description>Stain color as RGB</description>
+      <longflag>stain_color</longflag>
+      <default>0.5,0.5,0.5</default>
+    </double-vector>
+    <integer>
+      <name>minRadius</name>
+      <label>Minimum Radius</label>
+      <description>Minimum radius</description>
+      <longflag>min_radius</longflag>
+      <default>6</default>
+    </integer>
+    <double>
+      <name>threshold</name>
+      <label>Threshold</label>
+      <description>Threshold</description>
+      <longflag>threshold</longflag>
+      <default>0.5</default>
+    </double>
+    <boolean>
+      <name>verbose</name>
+      <label>Verbose</label>
+      <description>Log more information</description>
+      <longflag>verbose</longflag>
+      <default>false</default>
+    </boolean>
+  </parameters>
+  <parameters advanced="true">
+    <label>Outputs</label>
+    <description>Simple outputs</description>
+    <integer>
+      <name>count</name>
+      <label>Count</label>
+      <description>Number of detected objects</description>
+      <channel>output</channel>
+      <longflag>count</longflag>
+    </integer>
+  </parameters>
+</executable>
+"""
+
+
+def peakRSS():
+    """Return the peak resident set size of this process in MiB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return rss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+
+
+def routeCount(restResource):
+    return sum(len(routes) for methodRoutes in restResource._routes.values()
+               for routes in methodRoutes.values())
+
+
+def docCount(resourceName):
+    from girder.api import docs
+
+    return sum(len(methods) for methods in docs.routes[resourceName].values())
+
+
+def createCatalog(size, specs=0, imagesPerFolder=10):
+    """
+    Create a catalog of CLI items the way an image load job stores them.
+
+    :param size: the number of CLI items.
+    :param specs: the number of distinct CLI specs.  0 to use a distinct spec
+        for every CLI.
+    :param imagesPerFolder: the number of CLIs in each image.
+    """
+    from girder.models.collection import Collection
+    from girder.models.folder import Folder
+    from girder.models.item import Item
+    from girder.models.user import User
+
+    from slicer_cli_web.cli_utils import build_parameter_plan
+    from slicer_cli_web.models import DockerImageItem
+
+    DockerImageItem.prepare()
+    user = User().createUser(
+        'benchmark', 'password', 'Benchmark', 'User', 'benchmark@girder.test', admin=True)
+    collection = Collection().createCollection('Tasks', user)
+    now = time.time()
+    docs = []
+    tagFolder = None
+    for index in range(size):
+        if not index % imagesPerFolder:
+            image = 'benchmark/image%d' % (index // imagesPerFolder)
+            imageFolder = Folder().createFolder(collection, image, parentType='collection')
+            tagFolder = Folder().createFolder(imageFolder, 'latest')
+        xml = CLI_XML.format(index=index % specs if specs else index)
+        name = 'Cli%d' % index
+        docs.append({
+            'name': name,
+            'lowerName': name.lower(),
+            'description': '',
+            'folderId': tagFolder['_id'],
+            'baseParentType': 'collection',
+            'baseParentId': collection['_id'],
+            'creatorId': user['_id'],
+            'created': now,
+            'updated': now,
+            'size': 0,
+            'meta': {
+                'slicerCLIType': 'task',
+                'type': 'python',
+                'image': '%s:latest' % image,
+                'xml': xml,
+                'parameterPlan': build_parameter_plan(xml),
+            },
+        })
+        if len(docs) >= 1000:
+            Item().collection.insert_many(docs)
+            docs = []
+    if docs:
+        Item().collection.insert_many(docs)
+
+
+def resetDatabase():
+    """
+    Drop and recreate the benchmark database.  A database that has data but
+    wasn't created by this script is never dropped.
+    """
+    from girder.models import getDbConnection
+
+    client = getDbConnection()
+    db = client.get_default_database()
+    collections = db.list_collection_names()
+    if collections and MARKER_COLLECTION not in collections:
+        raise RuntimeError(
+            'The %s database was not created by this benchmark and will not '
+            'be dropped.  Use --uri to choose a scratch database.' % db.name)
+    client.drop_database(db.name)
+    db[MARKER_COLLECTION].insert_one({'created': time.time()})
+
+
+def runBenchmark(size, mode, cacheSize, specs=0, memory=False):
+    """
+    Benchmark endpoint generation for a single catalog size.  This is run in
+    its own process so that the peak memory use is not shared between sizes.
+
+    :param size: the number of CLI items.
+    :param mode: one of MODES.
+    :param cacheSize: the size of the handler cache for lazy endpoints.
+    :param specs: the number of distinct CLI specs.  0 to use a distinct spec
+        for every CLI.
+    :param memory: if True, trace memory allocations to report the memory
+        retained per CLI.  This slows down everything else.
+    :returns: a dictionary of results.
+    """
+    from girder.models.setting import Setting
+
+    from slicer_cli_web.config import PluginSettings
+
+    resetDatabase()
+    Setting().set(PluginSettings.SLICER_CLI_WEB_LAZY_ENDPOINTS, 'lazy' in mode)
+    Setting().set(PluginSettings.SLICER_CLI_WEB_DISPATCH_ENDPOINTS, 'dispatch' in mode)
+    Setting().set(PluginSettings.SLICER_CLI_WEB_ENDPOINT_CACHE_SIZE, cacheSize)
+
+    from slicer_cli_web.docker_resource import DockerResource
+    from slicer_cli_web.models import CLIItem
+    from slicer_cli_web.rest_slicer_cli import genHandlerToReRunDockerCLI, genHandlerToRunDockerCLI
+
+    results = {'size': size, 'mode': mode, 'baseRSS': peakRSS()}
+    start = time.time()
+    createCatalog(size, specs)
+    results['createTime'] = time.time() - start
+
+    if memory:
+        tracemalloc.start()
+    start = time.time()
+    restResource = DockerResource('slicer_cli_web')
+    results['startupTime'] = time.time() - start
+    if memory:
+        results['startupKiBPerCLI'] = tracemalloc.get_traced_memory()[0] / size / 1024
+    results['startupRSS'] = peakRSS()
+    results['routes'] = routeCount(restResource)
+    results['docs'] = docCount(restResource.resourceName)
+
+    start = time.time()
+    restResource.deleteImageEndpoints()
+    restResource._generateAllItemEndPoints()
+    results['refreshTime'] = time.time() - start
+    results['refreshRSS'] = peakRSS()
+
+    items = CLIItem.findAllItems()
+    if memory:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+    start = time.time()
+    handlers = []
+    for item in items:
+        handler = genHandlerToRunDockerCLI(item)
+        handlers.append((handler, genHandlerToReRunDockerCLI(item, handler)))
+    results['handlerTime'] = time.time() - start
+    results['handlerRSS'] = peakRSS()
+    if memory:
+        results['handlerKiBPerCLI'] = (tracemalloc.get_traced_memory()[0] - base) / size / 1024
+        tracemalloc.stop()
+    return results
+
+
+def report(results):
+    columns = [
+        ('size', 'CLIs', '%d'),
+        ('mode', 'mode', '%s'),
+        ('startupTime', 'startup s', '%.3f'),
+        ('refreshTime', 'refresh s', '%.3f'),
+        ('handlerTime', 'handlers s', '%.3f'),
+        ('routes', 'routes', '%d'),
+        ('docs', 'docs', '%d'),
+        ('baseRSS', 'base MiB', '%.1f'),
+        ('startupRSS', 'startup MiB', '%.1f'),
+        ('refreshRSS', 'refresh MiB', '%.1f'),
+        ('handlerRSS', 'handlers MiB', '%.1f'),
+        ('startupKiBPerCLI', 'startup KiB/CLI', '%.2f'),
+        ('handlerKiBPerCLI', 'handlers KiB/CLI', '%.2f'),
+    ]
+    columns = [column for column in columns if column[0] in results[0]]
+    rows = [[title for _, title, _ in columns]]
+    for result in results:
+        rows.append([fmt % result[key] for key, _, fmt in columns])
+    widths = [max(len(row[idx]) for row in rows) for idx in range(len(columns))]
+    for row in rows:
+        print('  '.join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+if __name__ == '__main__':  # noqa
+    parser = argparse.ArgumentParser(
+        prog='benchmark_catalog',
+        description='Benchmark slicer_cli_web endpoint generation against '
+        'synthetic CLI catalogs.  The database in the uri is dropped if it is '
+        'empty or was created by this script.')
+    parser.add_argument(
+        '--uri', default=DEFAULT_URI,
+        help='MongoDB uri of a scratch database.  GIRDER_MONGO_URI is not '
+        'used.  Default %s.' % DEFAULT_URI)
+    parser.add_argument(
+        '--sizes', default=DEFAULT_SIZES,
+        help='Comma-separated catalog sizes.  Default %s.' % DEFAULT_SIZES)
+    parser.add_argument(
+        '--mode', action='append', choices=MODES,
+        help='Endpoint mode to benchmark.  This may be specified multiple '
+        'times.  Default eager.')
+    parser.add_argument(
+        '--cache-size', type=int, default=256,
+        help='Handler cache size for lazy endpoints.  Default 256.')
+    parser.add_argument(
+        '--specs', type=int, default=0,
+        help='Number of distinct CLI specs.  Default 0 for a distinct spec '
+        'for every CLI.')
+    parser.add_argument(
+        '--memory', action='store_true',
+        help='Report the memory retained per CLI at startup and by its '
+        'handlers.  This uses tracemalloc, which slows down the timings.')
+    parser.add_argument(
+        '--json', action='store_true', help='Output the results as json.')
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    os.environ['GIRDER_MONGO_URI'] = args.uri
+    if args.single is not None:
+        print(json.dumps(runBenchmark(
+            args.single, args.mode[0], args.cache_size, args.specs, args.memory)))
+        sys.exit(0)
+
+    results = []
+    for mode in args.mode or ['eager']:
+        for size in [int(size) for size in args.sizes.split(',')]:
+            output = subprocess.check_output([
+                sys.executable, __file__, '--uri', args.uri, '--mode', mode,
+                '--cache-size', str(args.cache_size), '--specs', str(args.specs),
+                '--single', str(size)] + (['--memory'] if args.memory else []))
+            results.append(json.loads(output.decode().strip().split('\n')[-1]))
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)